@@ -0,0 +1,24 @@
+"""Gunicorn server hooks of the app.
+
+Gunicorn loads this file automatically when it is started from the
+repository root (eg. through the Procfile).
+"""
+import os
+
+
+def _metrics_dir():
+  return os.environ.get("METRICS_DIR")
+
+
+def on_starting(server):
+  """Removes the metric snapshots of the previous deployment."""
+  if _metrics_dir() is not None:
+    from tools import metrics
+    metrics.REGISTRY.clear(_metrics_dir())
+
+
+def child_exit(server, worker):
+  """Merges the metrics of an exited worker into the retired totals."""
+  if _metrics_dir() is not None:
+    from tools import metrics
+    metrics.REGISTRY.retire(_metrics_dir(), worker.pid)
@@ -1,6 +1,5 @@
 import os
 import flask
-import shutil
 import tools
 import werkzeug
 from typing import Optional
@@ -8,10 +7,45 @@ from typing import Optional
 
 app = flask.Flask(__name__)
 # Storage directory
-app.config["STORAGE_PATH"] = "D:/TripAdvisorReviews/app_storage"
+app.config["STORAGE_PATH"] = os.environ.get(
+    "STORAGE_PATH", "D:/TripAdvisorReviews/app_storage")
 #app.config["STORAGE_PATH"] = "/home/stavros/DATA/TripAdvisorReviews/app_storage"
+# Optional object store shared by multiple web nodes (see `tools.storage`)
+# If given, STORAGE_PATH is used as a local cache of the hotels
+app.config["STORAGE_URL"] = os.environ.get("STORAGE_URL")
+app.config["STORAGE_CACHE_MB"] = int(os.environ.get("STORAGE_CACHE_MB", 4096))
+app.config["STORAGE"] = tools.storage.create(app.config["STORAGE_PATH"],
+                                             app.config["STORAGE_URL"],
+                                             app.config["STORAGE_CACHE_MB"])
 # Number of aspects to show in `analysis` page
 app.config["NUM_ASPECTS"] = 58
+# Maximum size of uploaded zips (compressed and uncompressed)
+app.config["MAX_UPLOAD_MB"] = 200
+app.config["MAX_CONTENT_LENGTH"] = app.config["MAX_UPLOAD_MB"] * 2 ** 20
+# Optional on-disk cache of the pages downloaded by the scraper
+app.config["HTTP_CACHE_DIR"] = os.environ.get("HTTP_CACHE_DIR")
+# Directory shared by gunicorn workers for aggregating `/metrics`
+# If None each worker only reports its own metrics
+app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR")
+# Per request tracing and profiling of slow requests (see `/debug/requests`)
+app.config["TRACING"] = os.environ.get("TRACING", "0") == "1"
+# Requests slower than this are stack sampled by the profiler
+app.config["TRACING_SLOW_MS"] = 500
+tools.tracing.init_app(app)
+# Number of review pages in the preview shown while a hotel is scraped
+app.config["PREVIEW_PAGES"] = 10
+# Number of scraped reviews that are processed by spaCy at a time
+app.config["NLP_BATCH_SIZE"] = 200
+# JSON API (see `tools.api`), responses are cached by clients for this long
+app.config["API_MAX_AGE"] = 300
+app.register_blueprint(tools.api.blueprint)
+# Cache of rendered page fragments: "memory" (per worker), "disk" (shared
+# by the workers of a node) or "" to disable it
+app.config["FRAGMENT_CACHE"] = os.environ.get("FRAGMENT_CACHE", "memory")
+app.config["FRAGMENT_CACHE_MB"] = int(os.environ.get("FRAGMENT_CACHE_MB", 64))
+app.config["FRAGMENT_CACHE_DIR"] = os.environ.get(
+    "FRAGMENT_CACHE_DIR", os.path.join(app.config["STORAGE_PATH"], "_fragments"))
+tools.fragments.init_app(app)
 
 
 def scrape(url: str, max_pages: Optional[int] = None):
@@ -20,41 +54,72 @@ def scrape(url: str, max_pages: Optional[int] = None):
   Args:
     url: URL of the Trip Advisor main page of the hotel.
     max_pages: Maximum number of review pages to scrape.
-      If None all available reviews are scraped. It is advisable to use a small
-      number for testing because spaCy may take some time to run and we do not
-      have a nice loading screen implemented yet.
+      If None all available reviews are scraped.
   """
   import scraping
-  # TODO: Fix case where we already have data for the given URL
-  # (currently this should give an error)
-
   # Add {} url to access review pages
-  n = url.find("Reviews") + len("Reviews")
-  url = "".join([url[:n], "{}", url[n:]])
-  # Scrape reviews
-  scraper = scraping.scraper.TripAdvisorScraper(url)
+  url = scraping.scraper.format_url(url)
+  if app.config["HTTP_CACHE_DIR"] is not None:
+    cache = scraping.cache.ResponseCache(app.config["HTTP_CACHE_DIR"])
+  else:
+    cache = None
+  scraper = scraping.scraper.TripAdvisorScraper(url, cache=cache)
   # FIXME: Fix the scraper to take max_pages instead of max_reviews as Trip
   # Advisor may change in the future and no longer have 5 reviews per page
-  scraper.scrape_reviews(max_reviews=max_pages * 5)
-  scraper.save(app.config["STORAGE_PATH"])
-  # Find aspects
-  scraping.aspects.find_aspects(scraper.csv_path)
-  scraper.remove_csv()
-  return flask.redirect(flask.url_for("analysis", hotelname=scraper.lower_name))
+  if max_pages is None:
+    max_reviews = None
+  else:
+    max_reviews = max_pages * scraper.reviews_per_page
+  # Reviews are scraped and analyzed in the background and the analysis
+  # page shows a preview until all reviews are processed
+  try:
+    hotelname = tools.ingest.submit_scrape(
+        scraper, app.config["STORAGE"], max_reviews=max_reviews,
+        preview_pages=app.config["PREVIEW_PAGES"],
+        batch_size=app.config["NLP_BATCH_SIZE"])
+  except FileExistsError:
+    # The hotel was already scraped, so show its existing analysis
+    hotelname = scraper.lower_name
+  return flask.redirect(flask.url_for("analysis", hotelname=hotelname))
+
+
+@app.after_request
+def flush_metrics(response: flask.Response):
+  """Periodically shares the metrics of this worker with the others."""
+  tools.metrics.REGISTRY.maybe_flush(app.config["METRICS_DIR"])
+  return response
+
+
+@app.route("/metrics")
+def metrics():
+  """Exposes pipeline and app metrics in Prometheus text format."""
+  text = tools.metrics.REGISTRY.render(app.config["METRICS_DIR"])
+  return flask.Response(text, mimetype="text/plain; version=0.0.4")
+
+
+def _local_folder(hotelname: str) -> str:
+  """Local folder of a hotel from the storage backend or 404."""
+  try:
+    return app.config["STORAGE"].local_folder(hotelname)
+  except FileNotFoundError:
+    flask.abort(404)
 
 
 @app.route("/analysis/<hotelname>/download")
 def download(hotelname: str):
   """Downloads zip file with processed reviews pkl and hotel metadata txt."""
+  hotel_path = _local_folder(hotelname)
+  # The zip is saved next to the (local or cached) hotel folder
+  folder_dir = os.path.dirname(hotel_path)
   zip_name = ".".join([hotelname, "zip"])
-  zip_path = os.path.join(app.config["STORAGE_PATH"], zip_name)
+  zip_path = os.path.join(folder_dir, zip_name)
   if not os.path.exists(zip_path):
-    created_zip_path = tools.utils.zipdir(hotelname, app.config["STORAGE_PATH"])
+    with tools.tracing.span("build"):
+      created_zip_path = tools.utils.zipdir(hotelname, folder_dir)
     assert created_zip_path == zip_path
 
-  return flask.send_from_directory(directory=app.config["STORAGE_PATH"],
-                                   filename=zip_name,
-                                   as_attachment=True)
+  # Positional arguments, since Flask 2 renamed `filename` to `path`
+  return flask.send_from_directory(folder_dir, zip_name, as_attachment=True)
 
 
 @app.route("/analysis/<hotelname>/delete")
@@ -63,15 +128,7 @@ def delete(hotelname: str):
 
   Deletes both the folder and the zip file of the hotel.
   """
-  zip_name = ".".join([hotelname, "zip"])
-  zip_path = os.path.join(app.config["STORAGE_PATH"], zip_name)
-  if os.path.exists(zip_path):
-    os.remove(zip_path)
-
-  folder_path = os.path.join(app.config["STORAGE_PATH"], hotelname)
-  if os.path.exists(folder_path):
-    shutil.rmtree(folder_path)
-
+  app.config["STORAGE"].delete(hotelname)
   return flask.redirect(flask.url_for("main"))
 
 
@@ -91,8 +148,12 @@ def view_reviews(word_mode: str, hotel: tools.hotel.Hotel):
   """
   word, mode = word_mode.split("__")
   color = tools.containers.get_color(mode == "pos")
-  return flask.render_template("reviews.html", hotel=hotel,
-                               word=word, mode=mode, color=color)
+  review_list = tools.fragments.render(hotel, "review_list",
+                                       word=word, mode=mode)
+  with tools.tracing.span("render"):
+    return flask.render_template("reviews.html", hotel=hotel,
+                                 word=word, mode=mode, color=color,
+                                 review_list=review_list)
 
 
 @app.route("/analysis/<hotelname>?word=<word>")
@@ -100,6 +161,9 @@ def view_reviews(word_mode: str, hotel: tools.hotel.Hotel):
 def analysis(hotelname: str, word: Optional[str] = None):
   """Generates the analysis page (with aspects and visualizations).
 
+  The aspects can be restricted to reviews with given metadata through
+  facet query parameters (see `tools.facets`).
+
   Args:
     hotelname: The hotel id which is the name of the folder that contains
       hotel's data in the STORAGE PATH.
@@ -107,21 +171,46 @@ def analysis(hotelname: str, word: Optional[str] = None):
       See `word_mode` description in `view_reviews` for more details.
   """
   # hotelname is the name of the folder that contains all hotel files
-  hotel_path = os.path.join(app.config["STORAGE_PATH"], hotelname)
-  hotel = tools.hotel.Hotel.load_from_folder(hotel_path)
+  storage = app.config["STORAGE"]
+  if not storage.exists(hotelname):
+    status = tools.ingest.get_status(storage.work_dir, hotelname)
+    if status is None:
+      flask.abort(404)
+    preview = tools.preview.Preview.load(
+        os.path.join(storage.work_dir, tools.ingest.FOLDER_NAME), hotelname)
+    if preview is not None and status["state"] == "processing":
+      with tools.tracing.span("render"):
+        return flask.render_template("preview.html", hotel=preview,
+                                     n_aspects=app.config["NUM_ASPECTS"]), 202
+    return flask.render_template("ingest.html", hotelname=hotelname,
+                                 status=status), 202
+  hotel = tools.hotel.Hotel.load_from_folder(_local_folder(hotelname))
+  # Optional facet filters, eg. ?tripType=Business&rating=1&rating=2
+  hotel.apply_filters(tools.facets.parse_filters(flask.request.args))
   # TODO: Implement word merging
   if word is not None:
     return view_reviews(word, hotel)
-  return flask.render_template("analysis.html", hotel=hotel,
-                               n_aspects=app.config["NUM_ASPECTS"])
+  # Aspect tables and charts are cached per hotel data version and filters
+  aspect_tables = tools.fragments.render(
+      hotel, "aspect_tables", n_aspects=app.config["NUM_ASPECTS"])
+  charts = tools.fragments.render(hotel, "charts")
+  with tools.tracing.span("render"):
+    return flask.render_template("analysis.html", hotel=hotel,
+                                 aspect_tables=aspect_tables, charts=charts,
+                                 facet_labels=tools.facets.LABELS)
 
 
 def upload_zip(file: werkzeug.datastructures.FileStorage):
-  """Saves and unzips a zip file uploaded by the user."""
-  file_path = os.path.join(app.config["STORAGE_PATH"], file.filename)
-  file.save(file_path)
-  hotel_path = tools.utils.unzip(file_path)
-  hotelname = os.path.split(hotel_path)[-1]
+  """Saves a zip file uploaded by the user and schedules its ingest.
+
+  The hotel analysis page shows the ingest progress until the data are
+  converted in the background (see `tools.ingest`).
+  """
+  max_bytes = app.config["MAX_UPLOAD_MB"] * 2 ** 20
+  try:
+    hotelname = tools.ingest.submit(file, app.config["STORAGE"], max_bytes)
+  except tools.ingest.UploadError as exception:
+    flask.abort(400, str(exception))
   return flask.redirect(flask.url_for("analysis", hotelname=hotelname))
 
 
@@ -146,13 +235,11 @@ def main():
     if flask.request.files:
       return upload_zip(flask.request.files["data"])
 
-  hotels = []
-  for file in os.listdir(app.config["STORAGE_PATH"]):
-    full_path = os.path.join(app.config["STORAGE_PATH"], file)
-    if os.path.isdir(full_path):
-      hotels.append(tools.hotel.Hotel.load_from_folder(full_path))
+  hotels = [tools.hotel.Hotel.load_from_folder(_local_folder(hotelname))
+            for hotelname in app.config["STORAGE"].list_hotels()]
 
-  return flask.render_template("home.html", hotels=hotels)
+  with tools.tracing.span("render"):
+    return flask.render_template("home.html", hotels=hotels)
 
 
 if __name__ == "__main__":
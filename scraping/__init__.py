@@ -1,3 +1,5 @@
 from scraping import aspects
+from scraping import cache
 from scraping import scraper
-from scraping import preprocessing
\ No newline at end of file
+from scraping import preprocessing
+from scraping import pipeline
\ No newline at end of file
@@ -1,9 +1,13 @@
 import os
+import time
 import collections
+import numpy as np
 import pandas as pd
 from spacy import tokens
+from scraping import language
 from scraping import preprocessing
-from typing import Iterable, List, Set
+from tools import corpus, mapped, metrics
+from typing import Any, Iterable, List, Optional, Set, Tuple
 
 
 def load_words(lexicon_dir: str) -> Set[str]:
@@ -101,41 +105,89 @@ def sentiment_aspects(docs: Iterable[tokens.Doc]) -> List[collections.Counter]:
                   noun = subchild.text.lower() + " " + noun
                   sent_dict[noun] += sentiment
     sent_dict_list.append(collections.Counter(sent_dict))
+    metrics.ASPECTS_EXTRACTED.inc(len(sent_dict))
 
   print("\nFound aspects on {} reviews.".format(len(sent_dict_list)))
   return sent_dict_list
 
 
-def find_aspects(csv_path: str) -> pd.DataFrame:
-  reviews = pd.read_csv(csv_path)
-  n_reviews = len(reviews)
-  print("Loaded {} reviews from {}".format(n_reviews, csv_path))
+def _expand(values: Iterable, mask: pd.Series) -> List[Optional[Any]]:
+  """Maps values of the masked rows back to all rows using None for the rest."""
+  values = iter(values)
+  return [next(values) if keep else None for keep in mask]
+
+
+def process_reviews(reviews: pd.DataFrame
+                    ) -> Tuple[pd.DataFrame, corpus.TokenCorpus]:
+  """Finds the aspects of scraped reviews.
 
-  # TODO: Consider adding langdetect
+  Args:
+    reviews: DataFrame with the scraped reviews (as saved by the scraper).
+
+  Returns:
+    valid_reviews: DataFrame with the valid reviews and the additional
+      `processed_text`, `aspects` and `lemmatized_text` columns.
+    token_corpus: `TokenCorpus` with the lemmas of the English reviews.
+  """
   # Keep reviews with more than 2 characters
   valid_reviews = reviews[reviews.text.map(lambda x: len(x)) > 2]
   n_reviews = len(valid_reviews)
   print("Kept {} reviews with more than 2 characters.".format(n_reviews))
 
+  # Only English reviews go through the English spaCy pipeline.
+  # The rest are kept (eg. for rating counts) without aspects.
+  is_english, language_report = language.gate_languages(valid_reviews)
+  english_reviews = valid_reviews[is_english]
+  metrics.REVIEWS_SKIPPED.inc(language_report.skipped, reason="language")
+
   # Basic preprocessing
-  texts = preprocessing.basic_preprocessing(valid_reviews.text)
+  with metrics.STAGE_SECONDS.time(stage="preprocessing"):
+    texts = preprocessing.basic_preprocessing(english_reviews.text)
 
   # Create spacy docs using `nlp.pipe`
-  spacy_docs = preprocessing.apply_spacy(texts)
+  with metrics.STAGE_SECONDS.time(stage="spacy"):
+    start_time = time.perf_counter()
+    spacy_docs = preprocessing.apply_spacy(texts)
+    parse_time = time.perf_counter() - start_time
+  metrics.PARSE_SECONDS_SKIPPED.inc(
+      language_report.estimate_skipped_time(parse_time))
+  print(language_report)
   # Use docs to find aspects
-  aspects = sentiment_aspects(spacy_docs)
+  with metrics.STAGE_SECONDS.time(stage="aspects"):
+    aspects = sentiment_aspects(spacy_docs)
   # Lemmatize text after finding aspects
-  lemmatized_texts = preprocessing.lemmatize(spacy_docs)
+  with metrics.STAGE_SECONDS.time(stage="lemmatize"):
+    token_corpus = corpus.TokenCorpus.from_docs(
+        spacy_docs, doc_rows=np.flatnonzero(is_english.to_numpy()))
+    lemmatized_texts = token_corpus.texts()
 
   # Add columns to the DataFrame
   pd.options.mode.chained_assignment = None
-  valid_reviews["processed_text"] = texts
-  valid_reviews["aspects"] = aspects
-  valid_reviews["lemmatized_text"] = lemmatized_texts
+  valid_reviews["processed_text"] = _expand(texts, is_english)
+  valid_reviews["aspects"] = _expand(aspects, is_english)
+  valid_reviews["lemmatized_text"] = _expand(lemmatized_texts, is_english)
+  return valid_reviews, token_corpus
+
+
+def save_processed(reviews: pd.DataFrame, folder: str, name: str,
+                   token_corpus: Optional[corpus.TokenCorpus] = None):
+  """Saves processed reviews as pkl, memory-mapped store and corpus."""
+  reviews.to_pickle(os.path.join(folder, "{}_withaspects.pkl".format(name)))
+  # Memory-mapped representation shared by the app workers
+  mapped.write_store(folder, reviews)
+  if token_corpus is not None:
+    token_corpus.save(folder)
+
+
+def find_aspects(csv_path: str) -> pd.DataFrame:
+  reviews = pd.read_csv(csv_path)
+  n_reviews = len(reviews)
+  print("Loaded {} reviews from {}".format(n_reviews, csv_path))
+
+  valid_reviews, token_corpus = process_reviews(reviews)
 
   # Save to pickle
   assert len(csv_path.split(".")) == 2
-  save_path = csv_path.split(".")[0]
-  valid_reviews.to_pickle("{}_withaspects.pkl".format(save_path))
-
-  return valid_reviews
\ No newline at end of file
+  folder, name = os.path.split(csv_path.split(".")[0])
+  save_processed(valid_reviews, folder, name, token_corpus)
+  return valid_reviews
@@ -0,0 +1,202 @@
+"""Scrapes and analyzes many hotels from the command line.
+
+Example use:
+  python -m scraping.batch hotels.txt --storage /data/app_storage \
+      --rps 2 --hotel-workers 4 --page-workers 2 --report report.json
+
+where `hotels.txt` contains one Trip Advisor hotel URL per line (empty lines
+and lines starting with # are ignored). All hotels share a single pooled
+HTTP session and a global requests-per-second budget. Each hotel is scraped
+and processed with `scraping.pipeline` and published through the storage
+backend of the app (see `tools.storage`), so with `--storage-url` (or
+`$STORAGE_URL`) it is uploaded to the object store that the web nodes read.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import requests
+from concurrent import futures
+from requests import adapters
+from urllib3.util import retry
+from scraping import cache, pipeline, scraper
+from tools import metrics, storage as storage_lib
+from typing import Dict, List, Optional
+
+def create_session(pool_size: int = 10, max_retries: int = 3
+                   ) -> requests.Session:
+  """Creates an HTTP session with a connection pool shared by all scrapers.
+
+  Requests that fail with a connection error are retried with exponential
+  backoff. Responses with a 429/5xx status are retried by the scraper
+  instead (see `TripAdvisorScraper._request`), so that every retry goes
+  through the shared `RateLimiter`.
+  """
+  session = requests.Session()
+  retries = retry.Retry(total=max_retries, backoff_factor=1.0, status=0,
+                        raise_on_status=False)
+  adapter = adapters.HTTPAdapter(pool_connections=pool_size,
+                                 pool_maxsize=pool_size,
+                                 max_retries=retries)
+  session.mount("https://", adapter)
+  session.mount("http://", adapter)
+  return session
+
+
+def read_urls(path: str) -> List[str]:
+  with open(path, "r") as file:
+    lines = (line.strip() for line in file.readlines())
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def scrape_hotel(url: str, storage, session: requests.Session,
+                 rate_limiter: Optional[scraper.RateLimiter] = None,
+                 max_pages: Optional[int] = None,
+                 page_workers: int = 1,
+                 response_cache: Optional[cache.ResponseCache] = None) -> Dict:
+  """Scrapes and finds the aspects of a single hotel and publishes it.
+
+  Args:
+    url: Trip Advisor URL of the hotel.
+    storage: `tools.storage` backend that the hotel is published to.
+
+  Returns:
+    Dictionary with the hotel name, the number of scraped pages and processed
+    reviews, the failed pages and the time spent. If the hotel failed, the
+    dictionary contains the error message instead.
+  """
+  result = {"url": url, "pages": 0, "reviews": 0, "failed_pages": []}
+  start_time = time.perf_counter()
+  staging = None
+  try:
+    hotel_scraper = scraper.TripAdvisorScraper(
+        scraper.format_url(url), session=session, rate_limiter=rate_limiter,
+        cache=response_cache)
+    hotelname = hotel_scraper.lower_name
+    result["name"] = hotelname
+    # Fail before scraping instead of when publishing
+    if storage.exists(hotelname):
+      raise FileExistsError("Hotel {} already exists in storage.".format(
+          hotelname))
+    if max_pages is None:
+      max_reviews = None
+    else:
+      max_reviews = max_pages * hotel_scraper.reviews_per_page
+    staging = storage.staging_dir()
+    reviews = pipeline.run(hotel_scraper, staging, max_reviews=max_reviews,
+                           n_workers=page_workers)
+    result["failed_pages"] = sorted(hotel_scraper.failed_pages)
+    result["pages"] = len(hotel_scraper.scraped_pages)
+    result["reviews"] = len(reviews)
+    storage.publish(hotelname, os.path.join(staging, hotelname))
+  except Exception as exception:
+    print("Failed to scrape {}: {!r}".format(url, exception))
+    result["error"] = repr(exception)
+  finally:
+    if staging is not None:
+      shutil.rmtree(staging, ignore_errors=True)
+  result["seconds"] = time.perf_counter() - start_time
+  return result
+
+
+def summarize(results: List[Dict], wall_time: float) -> Dict:
+  """Aggregates the per hotel results to a throughput and failure report."""
+  succeeded = [r for r in results if "error" not in r]
+  pages = sum(r["pages"] for r in succeeded)
+  reviews = sum(r["reviews"] for r in succeeded)
+  return {"hotels": len(results),
+          "succeeded": len(succeeded),
+          "failed": [{"url": r["url"], "error": r["error"]}
+                     for r in results if "error" in r],
+          "failed_pages": {r["name"]: r["failed_pages"]
+                           for r in succeeded if r["failed_pages"]},
+          "pages": pages,
+          "reviews": reviews,
+          "wall_seconds": wall_time,
+          "pages_per_second": pages / wall_time if wall_time else 0.0,
+          "reviews_per_second": reviews / wall_time if wall_time else 0.0,
+          "results": results}
+
+
+def run(urls: List[str], storage, rps: float = 1.0,
+        hotel_workers: int = 2, page_workers: int = 1,
+        max_pages: Optional[int] = None,
+        response_cache: Optional[cache.ResponseCache] = None) -> Dict:
+  """Scrapes all hotels to a `tools.storage` backend and returns the report."""
+  session = create_session(pool_size=hotel_workers * page_workers)
+  rate_limiter = scraper.RateLimiter(rps, burst=max(1, int(rps)))
+
+  start_time = time.perf_counter()
+  with futures.ThreadPoolExecutor(hotel_workers) as executor:
+    jobs = [executor.submit(scrape_hotel, url, storage, session,
+                            rate_limiter, max_pages, page_workers,
+                            response_cache)
+            for url in urls]
+    results = [job.result() for job in jobs]
+  return summarize(results, time.perf_counter() - start_time)
+
+
+def main(argv: Optional[List[str]] = None):
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("urls", help="Text file with one hotel URL per line.")
+  parser.add_argument("--storage", default=os.environ.get("STORAGE_PATH"),
+                      help="App storage directory (default: $STORAGE_PATH).")
+  parser.add_argument("--storage-url", default=os.environ.get("STORAGE_URL"),
+                      help="Object store that hotels are published to "
+                           "(default: $STORAGE_URL).")
+  parser.add_argument("--max-pages", type=int, default=None,
+                      help="Maximum number of review pages per hotel.")
+  parser.add_argument("--rps", type=float, default=1.0,
+                      help="Global budget of requests per second.")
+  parser.add_argument("--hotel-workers", type=int, default=2,
+                      help="Number of hotels scraped concurrently.")
+  parser.add_argument("--page-workers", type=int, default=1,
+                      help="Number of pages of each hotel fetched concurrently.")
+  parser.add_argument("--cache-dir", default=os.environ.get("HTTP_CACHE_DIR"),
+                      help="Directory of the HTTP response cache.")
+  parser.add_argument("--cache-mode", default="normal", choices=cache.MODES,
+                      help="Use 'replay' to scrape only from the cache.")
+  parser.add_argument("--cache-ttl", type=float, default=24 * 3600,
+                      help="Seconds before a cached page is revalidated.")
+  parser.add_argument("--cache-max-mb", type=float, default=1024,
+                      help="Maximum size of the cache in MB.")
+  parser.add_argument("--report", default=None,
+                      help="Path to save the json summary report.")
+  parser.add_argument("--metrics-dir", default=os.environ.get("METRICS_DIR"),
+                      help="Directory to flush the pipeline metrics to.")
+  args = parser.parse_args(argv)
+  if args.storage is None:
+    parser.error("--storage or $STORAGE_PATH is required.")
+
+  if args.cache_dir is not None:
+    response_cache = cache.ResponseCache(
+        args.cache_dir, mode=args.cache_mode, ttl=args.cache_ttl,
+        max_bytes=int(args.cache_max_mb * 2 ** 20))
+  else:
+    response_cache = None
+
+  storage = storage_lib.create(args.storage, args.storage_url)
+  report = run(read_urls(args.urls), storage, rps=args.rps,
+               hotel_workers=args.hotel_workers,
+               page_workers=args.page_workers, max_pages=args.max_pages,
+               response_cache=response_cache)
+  if args.metrics_dir is not None:
+    metrics.REGISTRY.flush(args.metrics_dir)
+
+  print("\nScraped {} / {} hotels: {} pages, {} reviews in {:.1f}s "
+        "({:.2f} pages/s, {:.2f} reviews/s).".format(
+            report["succeeded"], report["hotels"], report["pages"],
+            report["reviews"], report["wall_seconds"],
+            report["pages_per_second"], report["reviews_per_second"]))
+  for failure in report["failed"]:
+    print("FAILED {}: {}".format(failure["url"], failure["error"]))
+  if args.report is not None:
+    with open(args.report, "w") as file:
+      json.dump(report, file, indent=2)
+  return 0 if not report["failed"] else 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,272 @@
+"""Content-addressed on-disk cache of the HTTP responses of the scraper.
+
+Layout of the cache directory:
+  * index/ab/<sha256 of url>.json: Metadata of each cached URL (ETag,
+    Last-Modified, fetch time and the hash of the response body).
+  * blobs/cd/<sha256 of body>.gz: Gzip compressed response bodies. Identical
+    pages are stored only once.
+
+The modification time of the index files is used as the last access time
+for evicting the least recently used entries when the cache exceeds its size.
+
+Modes:
+  * "normal": Serves fresh entries from the cache, revalidates stale entries
+    with If-None-Match / If-Modified-Since and fetches misses.
+  * "record": Always fetches from the network and updates the cache.
+  * "replay": Serves only from the cache regardless of age and never touches
+    the network. Misses raise `CacheMiss`.
+"""
+import os
+import gzip
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import requests
+from tools import metrics
+from typing import Callable, Dict, List, Optional, Tuple
+
+MODES = ("normal", "record", "replay")
+
+
+class CacheMiss(KeyError):
+  """Raised in replay mode when a URL is not found in the cache."""
+
+
+def _hash(data: bytes) -> str:
+  return hashlib.sha256(data).hexdigest()
+
+
+def _atomic_write(path: str, data: bytes):
+  folder = os.path.dirname(path)
+  os.makedirs(folder, exist_ok=True)
+  fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+  with os.fdopen(fd, "wb") as file:
+    file.write(data)
+  os.replace(tmp_path, path)
+
+
+class ResponseCache:
+  """On-disk HTTP response cache used by `TripAdvisorScraper.fetch`.
+
+  Args:
+    directory: Directory to store the cache in.
+    mode: One of `MODES`.
+    ttl: Number of seconds for which a cached response is served without
+      revalidation.
+    max_bytes: Maximum total size of the compressed bodies. Least recently
+      used entries are evicted when this is exceeded.
+  """
+
+  def __init__(self, directory: str, mode: str = "normal",
+               ttl: float = 24 * 3600, max_bytes: int = 2 ** 30):
+    if mode not in MODES:
+      raise ValueError("Unknown cache mode {}. Available modes are {}."
+                       "".format(mode, MODES))
+    self.directory = directory
+    self.mode = mode
+    self.ttl = ttl
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    self._size = self._disk_size()
+
+  @staticmethod
+  def key(url: str) -> str:
+    # The fragment is never sent to the server
+    return _hash(url.split("#")[0].encode("utf-8"))
+
+  def _index_path(self, key: str) -> str:
+    return os.path.join(self.directory, "index", key[:2],
+                        "{}.json".format(key))
+
+  def _blob_path(self, digest: str) -> str:
+    return os.path.join(self.directory, "blobs", digest[:2],
+                        "{}.gz".format(digest))
+
+  def _files(self, folder: str):
+    root = os.path.join(self.directory, folder)
+    if not os.path.isdir(root):
+      return
+    for subfolder in os.listdir(root):
+      for file in os.listdir(os.path.join(root, subfolder)):
+        if not file.endswith(".tmp"):
+          yield os.path.join(root, subfolder, file)
+
+  def _blob_paths(self):
+    return self._files("blobs")
+
+  def _entries(self) -> List[Tuple[float, str, Dict]]:
+    """Index entries with their last access time, least recent first."""
+    entries = []
+    for path in self._files("index"):
+      try:
+        with open(path, "r") as file:
+          entries.append((os.path.getmtime(path), path, json.load(file)))
+      except (OSError, ValueError):
+        continue
+    entries.sort(key=lambda x: x[0])
+    return entries
+
+  def _remove_blob(self, digest: str) -> int:
+    """Removes a blob and returns its size (0 if it was already removed)."""
+    blob_path = self._blob_path(digest)
+    try:
+      size = os.path.getsize(blob_path)
+      os.remove(blob_path)
+    except FileNotFoundError:
+      return 0
+    return size
+
+  def _disk_size(self) -> int:
+    """Total size of the blobs, including those written by other processes."""
+    size = 0
+    for path in self._blob_paths():
+      try:
+        size += os.path.getsize(path)
+      except FileNotFoundError:
+        continue
+    return size
+
+  def lookup(self, url: str) -> Optional[Dict]:
+    """Returns the metadata of a cached URL or None if it is not cached."""
+    try:
+      with open(self._index_path(self.key(url)), "r") as file:
+        return json.load(file)
+    except (OSError, ValueError):
+      return None
+
+  def read_body(self, entry: Dict) -> Optional[str]:
+    """Returns the body of an entry or None if its blob was evicted."""
+    try:
+      with gzip.open(self._blob_path(entry["body"]), "rb") as file:
+        return file.read().decode(entry.get("encoding") or "utf-8")
+    except FileNotFoundError:
+      # Evicted by another process after the index lookup
+      return None
+
+  def store(self, url: str, response: requests.Response) -> Dict:
+    """Stores a 200 response in the cache and returns its metadata."""
+    body = response.content
+    digest = _hash(body)
+    blob_path = self._blob_path(digest)
+    if not os.path.exists(blob_path):
+      compressed = gzip.compress(body)
+      _atomic_write(blob_path, compressed)
+      with self._lock:
+        self._size += len(compressed)
+
+    previous = self.lookup(url)
+    entry = {"url": url, "body": digest,
+             "encoding": response.encoding,
+             "etag": response.headers.get("ETag"),
+             "last_modified": response.headers.get("Last-Modified"),
+             "fetched_at": time.time()}
+    self._write_entry(url, entry)
+    if previous is not None and previous["body"] != digest:
+      # The page changed, remove its old body unless another page has it
+      if not any(other["body"] == previous["body"]
+                 for _, _, other in self._entries()):
+        size = self._remove_blob(previous["body"])
+        with self._lock:
+          self._size -= size
+    if self._size > self.max_bytes:
+      self.evict()
+    return entry
+
+  def _write_entry(self, url: str, entry: Dict):
+    _atomic_write(self._index_path(self.key(url)),
+                  json.dumps(entry).encode("utf-8"))
+
+  def _touch(self, url: str):
+    try:
+      os.utime(self._index_path(self.key(url)))
+    except OSError:
+      pass
+
+  def get(self, url: str,
+          request: Callable[[str, Optional[Dict]], requests.Response]) -> str:
+    """Returns the body of `url` from the cache or the network.
+
+    Args:
+      url: URL to get.
+      request: Function that performs the HTTP GET request given the URL and
+        optional extra headers.
+    """
+    entry = self.lookup(url)
+    if self.mode == "replay":
+      body = None if entry is None else self.read_body(entry)
+      if body is None:
+        metrics.CACHE_REQUESTS.inc(result="miss")
+        raise CacheMiss("{} not found in cache {}.".format(url, self.directory))
+      metrics.CACHE_REQUESTS.inc(result="hit")
+      self._touch(url)
+      return body
+
+    response = None
+    if entry is not None and self.mode == "normal":
+      if time.time() - entry["fetched_at"] < self.ttl:
+        body = self.read_body(entry)
+        if body is not None:
+          metrics.CACHE_REQUESTS.inc(result="hit")
+          self._touch(url)
+          return body
+      else:
+        headers = {}
+        if entry.get("etag"):
+          headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+          headers["If-Modified-Since"] = entry["last_modified"]
+        response = request(url, headers)
+        if response.status_code == 304:
+          body = self.read_body(entry)
+          if body is not None:
+            metrics.CACHE_REQUESTS.inc(result="revalidated")
+            entry["fetched_at"] = time.time()
+            self._write_entry(url, entry)
+            return body
+          response = None
+    if response is None:
+      response = request(url, None)
+
+    metrics.CACHE_REQUESTS.inc(result="miss")
+    assert response.status_code == 200
+    self.store(url, response)
+    return response.text
+
+  def evict(self, target_fraction: float = 0.9):
+    """Evicts least recently used entries until the cache is small enough.
+
+    Blobs are removed when no remaining entry refers to them. The size is
+    recomputed from disk first, since other processes that share the cache
+    directory also add and evict entries, and blobs that no entry refers
+    to (eg. left by a crashed process) are removed.
+    """
+    with self._lock:
+      entries = self._entries()
+      references = {}
+      for _, _, entry in entries:
+        references[entry["body"]] = references.get(entry["body"], 0) + 1
+
+      self._size = 0
+      for path in list(self._blob_paths()):
+        digest = os.path.basename(path).split(".")[0]
+        if digest in references:
+          try:
+            self._size += os.path.getsize(path)
+          except FileNotFoundError:
+            continue
+        else:
+          self._remove_blob(digest)
+
+      target = target_fraction * self.max_bytes
+      for _, path, entry in entries:
+        if self._size <= target:
+          break
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+        references[entry["body"]] -= 1
+        if references[entry["body"]] == 0:
+          self._size -= self._remove_blob(entry["body"])
@@ -0,0 +1,139 @@
+"""Routes only English reviews to the (expensive) spaCy stage.
+
+The language of each review is taken from the metadata scraped from
+Trip Advisor (`language`, then `originalLanguage`). Reviews without metadata
+go through a fast batched detector based on the fraction of English stop
+words. `langdetect` is used only for the texts that the fast detector cannot
+decide, if it is installed.
+"""
+import re
+import pandas as pd
+from tools.stopwords import STOP_WORDS
+from typing import Dict, Optional
+
+try:
+  import langdetect
+except ImportError:
+  langdetect = None
+
+UNKNOWN = "<UNK>"
+_WORD_PATTERN = re.compile(r"[^\W\d_]+")
+
+
+def detect(text: str) -> str:
+  """Detects the language of a single text using `langdetect`."""
+  if langdetect is None:
+    return UNKNOWN
+  try:
+    return langdetect.detect(text)
+  except Exception:
+    print("Failed to identify language of:", text)
+    return UNKNOWN
+
+
+def _english_score(words) -> Optional[bool]:
+  """Helper method for `detect_english`. None if the text is ambiguous."""
+  if not words:
+    return None
+  ascii_words = sum(word.isascii() for word in words)
+  if ascii_words < 0.8 * len(words):
+    return False
+  stop_fraction = sum(word in STOP_WORDS for word in words) / len(words)
+  if stop_fraction >= 0.25:
+    return True
+  if stop_fraction < 0.05 and len(words) >= 10:
+    return False
+  return None
+
+
+def detect_english(texts: pd.Series, batch_size: int = 512) -> pd.Series:
+  """Detects which texts are English.
+
+  Args:
+    texts: Series of texts.
+    batch_size: Number of texts that are tokenized at once.
+
+  Returns:
+    Boolean Series with the same index as `texts`.
+  """
+  scores = []
+  for start in range(0, len(texts), batch_size):
+    batch = texts.iloc[start:start + batch_size].fillna("").str.lower()
+    scores.extend(batch.str.findall(_WORD_PATTERN).map(_english_score))
+  scores = pd.Series(scores, index=texts.index, dtype=object)
+
+  ambiguous = scores.isnull()
+  if ambiguous.any():
+    if langdetect is not None:
+      scores[ambiguous] = texts[ambiguous].map(lambda x: detect(x) == "en")
+    else:
+      # Keep undecided texts so that we never lose English reviews
+      scores[ambiguous] = True
+  return scores.astype(bool)
+
+
+class LanguageReport:
+  """Counts of the language gate and the parse time it saved."""
+
+  def __init__(self, n_reviews: int, from_metadata: int, detected: int,
+               kept: int, skipped_chars: int, kept_chars: int):
+    self.n_reviews = n_reviews
+    self.from_metadata = from_metadata
+    self.detected = detected
+    self.kept = kept
+    self.skipped_chars = skipped_chars
+    self.kept_chars = kept_chars
+    self.skipped_parse_time = 0.0
+
+  @property
+  def skipped(self) -> int:
+    return self.n_reviews - self.kept
+
+  def estimate_skipped_time(self, parse_time: float) -> float:
+    """Estimates the parse time saved given the time to parse kept reviews."""
+    if self.kept_chars > 0:
+      self.skipped_parse_time = parse_time * self.skipped_chars / self.kept_chars
+    return self.skipped_parse_time
+
+  def as_dict(self) -> Dict:
+    return {"reviews": self.n_reviews, "from_metadata": self.from_metadata,
+            "detected": self.detected, "kept": self.kept,
+            "skipped": self.skipped,
+            "skipped_parse_seconds": self.skipped_parse_time}
+
+  def __str__(self):
+    return ("Language gate kept {} / {} reviews ({} from metadata, {} detected)"
+            ", skipped ~{:.1f}s of parsing.".format(
+                self.kept, self.n_reviews, self.from_metadata, self.detected,
+                self.skipped_parse_time))
+
+
+def gate_languages(reviews: pd.DataFrame, target: str = "en",
+                   text_col: str = "text"):
+  """Finds the reviews that should be processed by the English NLP pipeline.
+
+  Returns:
+    mask: Boolean Series with the reviews that are in the `target` language.
+    report: `LanguageReport` with the gate counts.
+  """
+  languages = pd.Series(None, index=reviews.index, dtype=object)
+  for column in ["language", "originalLanguage"]:
+    if column in reviews:
+      languages = languages.fillna(reviews[column])
+  missing = languages.isnull()
+  mask = languages == target
+
+  if missing.any():
+    is_english = detect_english(reviews.loc[missing, text_col])
+    if target == "en":
+      mask[missing] = is_english
+    else:
+      mask[missing] = False
+
+  lengths = reviews[text_col].fillna("").str.len()
+  report = LanguageReport(n_reviews=len(reviews),
+                          from_metadata=int((~missing).sum()),
+                          detected=int(missing.sum()), kept=int(mask.sum()),
+                          skipped_chars=int(lengths[~mask].sum()),
+                          kept_chars=int(lengths[mask].sum()))
+  return mask.astype(bool), report
@@ -0,0 +1,166 @@
+"""Pipelined scraping and aspect extraction of a hotel.
+
+A producer thread fetches the review pages, appends each page to the raw csv
+of the hotel and pushes its reviews into a bounded queue. The calling thread
+consumes the queue in batches that go through the language gate,
+preprocessing, spaCy and aspect extraction (`aspects.process_reviews`), so
+NLP runs while the next pages are being downloaded and the reviews never
+make a round trip through the csv. The bounded queue makes the scraper wait
+when NLP falls behind, so memory stays bounded for large hotels.
+
+The csv is only kept as a raw backup while the job runs and is removed once
+the processed reviews are saved.
+"""
+import os
+import time
+import queue
+import threading
+import pandas as pd
+from scraping import aspects, scraper as scraper_lib
+from tools import corpus, metrics
+from typing import Callable, List, Optional, Tuple
+
+_DONE = object()
+
+
+class PipelineResult:
+  """Processed reviews accumulated batch by batch.
+
+  Contains:
+    * self.batches: List with the processed DataFrame of each batch.
+    * self.corpora: List with the `TokenCorpus` of each batch.
+    * self.n_scraped: Number of raw reviews scraped so far.
+    * self.n_pages: Number of review pages consumed so far.
+  """
+
+  def __init__(self):
+    self.batches = []
+    self.corpora = []
+    self.n_scraped = 0
+    self.n_pages = 0
+
+  def add(self, reviews: pd.DataFrame, token_corpus: corpus.TokenCorpus):
+    self.batches.append(reviews)
+    self.corpora.append(token_corpus)
+
+  @property
+  def n_processed(self) -> int:
+    return sum(len(batch) for batch in self.batches)
+
+  def merged(self) -> Tuple[pd.DataFrame, corpus.TokenCorpus]:
+    """Concatenates the batches to the output of `process_reviews`."""
+    if not self.batches:
+      return pd.DataFrame(), corpus.TokenCorpus.concatenate([], [])
+    row_offsets, total = [], 0
+    for batch in self.batches:
+      row_offsets.append(total)
+      total += len(batch)
+    return (pd.concat(self.batches),
+            corpus.TokenCorpus.concatenate(self.corpora, row_offsets))
+
+
+def _put(items: queue.Queue, item, stop: threading.Event) -> bool:
+  """Blocks until `item` is queued or the consumer stopped."""
+  while not stop.is_set():
+    try:
+      items.put(item, timeout=0.5)
+      return True
+    except queue.Full:
+      continue
+  return False
+
+
+def _produce(scraper: scraper_lib.TripAdvisorScraper, items: queue.Queue,
+             stop: threading.Event, max_reviews: Optional[int],
+             n_workers: int):
+  pages = scraper.iter_pages(max_reviews=max_reviews, n_workers=n_workers)
+  try:
+    for page in pages:
+      if page:
+        scraper.append_csv(page)
+      if not _put(items, page, stop):
+        return
+    _put(items, _DONE, stop)
+  except Exception as exception:
+    _put(items, exception, stop)
+  finally:
+    # Cancels the pages that are not fetched yet if the consumer stopped
+    pages.close()
+
+
+def run(scraper: scraper_lib.TripAdvisorScraper, folder: str,
+        max_reviews: Optional[int] = None, n_workers: int = 1,
+        batch_size: int = 100, max_queued_pages: int = 40,
+        on_batch: Optional[Callable[[PipelineResult], None]] = None,
+        first_batch_size: Optional[int] = None) -> pd.DataFrame:
+  """Scrapes the reviews of a hotel and finds their aspects in a pipeline.
+
+  Args:
+    scraper: Scraper of the hotel (with its metadata already scraped).
+    folder: Directory in which the hotel folder is created.
+    max_reviews: Maximum number of reviews to scrape.
+    n_workers: Number of review pages fetched concurrently.
+    batch_size: Minimum number of reviews processed in each NLP batch.
+    max_queued_pages: Maximum number of scraped pages waiting for NLP.
+    on_batch: Optional function that is called with the accumulated
+      `PipelineResult` after each processed batch.
+    first_batch_size: Optional minimum number of reviews of the first batch,
+      eg. smaller than `batch_size` so that `on_batch` is called early.
+
+  Returns:
+    DataFrame with the processed reviews, as returned by `find_aspects`.
+
+  Raises:
+    ValueError: If no reviews with text were scraped.
+  """
+  hotel_folder = scraper.create_folder(folder)
+  items = queue.Queue(maxsize=max_queued_pages)
+  stop = threading.Event()
+  producer = threading.Thread(target=_produce, daemon=True,
+                              args=(scraper, items, stop, max_reviews,
+                                    n_workers))
+  start_time = time.perf_counter()
+  producer.start()
+
+  result = PipelineResult()
+  pending = []
+  try:
+    done = False
+    while not done:
+      with metrics.STAGE_SECONDS.time(stage="pipeline_wait"):
+        item = items.get()
+      if isinstance(item, Exception):
+        raise item
+      done = item is _DONE
+      if not done:
+        pending.extend(item)
+        result.n_pages += 1
+      if result.batches or first_batch_size is None:
+        min_size = batch_size
+      else:
+        min_size = first_batch_size
+      if pending and (done or len(pending) >= min_size):
+        reviews = scraper.to_dataframe(pending)
+        # Same index as the rows of the raw csv
+        reviews.index = pd.RangeIndex(result.n_scraped,
+                                      result.n_scraped + len(pending))
+        result.n_scraped += len(pending)
+        pending = []
+        result.add(*aspects.process_reviews(reviews))
+        if on_batch is not None:
+          on_batch(result)
+  finally:
+    stop.set()
+    producer.join()
+
+  if not result.n_processed:
+    # Nothing to save: an empty store cannot be loaded by the app
+    raise ValueError("No reviews with text were scraped for {}.".format(
+        scraper.lower_name))
+  valid_reviews, token_corpus = result.merged()
+  name = os.path.basename(scraper.csv_path).split(".")[0]
+  aspects.save_processed(valid_reviews, hotel_folder, name, token_corpus)
+  scraper.remove_csv()
+  print("Pipeline processed {} reviews of {} pages in {:.1f}s.".format(
+      result.n_scraped, result.n_pages, time.perf_counter() - start_time))
+  return valid_reviews
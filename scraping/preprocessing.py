@@ -3,14 +3,24 @@ import re
 import json
 import spacy
 import time
+import threading
 import pandas as pd
 from spacy import tokens
-from typing import Iterable, List
+from scraping import language
+from tools import corpus, metrics
+from typing import Iterable, List, Sequence
 
 _CMAP_DIR = os.path.join(os.getcwd(), "scraping", "contractions.txt")
 with open(_CMAP_DIR, "r") as file:
   _CMAP = json.load(file)
 
+# Loaded spaCy models by (parse, tag, entity), since loading takes seconds
+_MODELS = {}
+_MODELS_LOCK = threading.Lock()
+# spaCy models are not thread-safe, so all threads of a process (eg. scrapes
+# and uploads in the web app, or hotels of the batch CLI) parse one at a time
+_NLP_LOCK = threading.Lock()
+
 
 def expand_contractions(text, contraction_mapping=_CMAP):
   contractions_pattern = re.compile('({})'.format('|'.join(
@@ -46,47 +56,50 @@ def remove_special_characters(text: str, remove_digits: bool = False) -> str:
 
 
 def find_language(text: str) -> str:
-  try:
-    language = langdetect.detect(text)
-  except:
-    print("Failed to identify language of:", text)
-    return "<UNK>"
-  return language
+  return language.detect(text)
 
 
 def basic_preprocessing(texts: pd.Series):
   texts = texts.map(expand_contractions)
   texts = texts.map(remove_special_characters)
+  metrics.REVIEWS_PREPROCESSED.inc(len(texts))
   print("Basic preprocessing completed on {} reviews.".format(len(texts)))
   return texts
 
 
-def lemmatize(docs: Iterable[tokens.Doc]) -> List[str]:
-  texts = []
+def lemmatize(docs: Sequence[tokens.Doc]) -> List[str]:
+  """Lemmatizes docs through the integer-encoded `corpus.TokenCorpus`."""
   start_time = time.time()
-
-  for doc in docs:
-    text = " ".join([token.lemma_ if token.lemma_ != '-PRON-' else token.text
-                     for token in doc])
-    # Leave only letter characters
-    text = re.sub("[^a-zA-z\s]", " ", text)
-    # Substitute any white space character with a single space
-    text = " ".join(text.split())
-    # Make lower case
-    texts.append(text.lower())
-
+  texts = corpus.TokenCorpus.from_docs(docs).texts()
   print("\nLemmatized {} reviews.".format(len(texts)))
   print(time.time() - start_time)
   return texts
 
 
+def load_model(parse=True, tag=True, entity=True) -> "spacy.language.Language":
+  """Loads the English spaCy model once per process and configuration."""
+  key = (parse, tag, entity)
+  with _MODELS_LOCK:
+    if key not in _MODELS:
+      _MODELS[key] = spacy.load('en_core_web_sm', parse=parse, tag=tag,
+                                entity=entity)
+    return _MODELS[key]
+
+
 def apply_spacy(texts: Iterable[str], parse=True, tag=True, entity=True
                 ) -> Iterable[tokens.Doc]:
-  nlp = spacy.load('en_core_web_sm', parse=parse, tag=tag, entity=entity)
+  nlp = load_model(parse=parse, tag=tag, entity=entity)
 
-  start_time = time.time()
-  docs = list(nlp.pipe(texts))
+  with _NLP_LOCK:
+    start_time = time.time()
+    docs = list(nlp.pipe(texts))
+    parse_time = time.time() - start_time
   print("\nApplied spacy on {} reviews.".format(len(docs)))
-  print(time.time() - start_time)
+  print(parse_time)
+
+  metrics.DOCS_PARSED.inc(len(docs))
+  metrics.PARSE_SECONDS.observe(parse_time)
+  if parse_time > 0:
+    metrics.DOCS_PER_SECOND.observe(len(docs) / parse_time)
 
   return docs
\ No newline at end of file
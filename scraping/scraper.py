@@ -2,8 +2,21 @@ import os
 import requests
 import bs4
 import json
+import time
+import threading
+import itertools
+import collections
 import pandas as pd
-from typing import Dict, List, Optional, Union
+from concurrent import futures
+from scraping import cache as cache_lib
+from tools import metrics
+from typing import Dict, Iterator, List, Optional, Union
+
+
+def format_url(url: str) -> str:
+  """Adds {} to the URL of the hotel main page to access review pages."""
+  n = url.find("Reviews") + len("Reviews")
+  return "".join([url[:n], "{}", url[n:]])
 
 
 def find_reviews_dict(root, target="mgmtResponse") -> Optional[str]:
@@ -41,6 +54,40 @@ def multiple_dict_indexing(d: Union[Dict, List], ids: List[str],
   return new_d
 
 
+class RateLimiter:
+  """Thread-safe token bucket shared by all scrapers of a process.
+
+  Args:
+    rate: Maximum number of requests per second.
+    burst: Maximum number of requests that can be made at once after
+      a period of inactivity.
+  """
+
+  def __init__(self, rate: float, burst: int = 1):
+    if rate <= 0:
+      raise ValueError("Rate limit should be positive but {} was given."
+                       "".format(rate))
+    self.rate = rate
+    self.burst = burst
+    self._tokens = float(burst)
+    self._last = time.monotonic()
+    self._lock = threading.Lock()
+
+  def acquire(self):
+    """Blocks until a request is allowed."""
+    with self._lock:
+      now = time.monotonic()
+      self._tokens = min(self.burst,
+                         self._tokens + (now - self._last) * self.rate)
+      self._last = now
+      # Reserve a token even if it is not available yet so that waiting
+      # threads are served in order
+      self._tokens -= 1
+      wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+    if wait > 0:
+      time.sleep(wait)
+
+
 class TripAdvisorScraper:
 
   _REVIEW_DATA = ["id", "absoluteUrl", "createdDate", "publishedDate",
@@ -63,9 +110,36 @@ class TripAdvisorScraper:
 
   _SCRIPT_TARGET = "window.__WEB_CONTEXT__"
 
-  def __init__(self, base_url: str, reviews_per_page: int = 5):
-    self.session = requests.Session()
+  # Statuses of responses that are retried with exponential backoff
+  _RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+  def __init__(self, base_url: str, reviews_per_page: int = 5,
+               session: Optional[requests.Session] = None,
+               rate_limiter: Optional[RateLimiter] = None,
+               cache: Optional[cache_lib.ResponseCache] = None,
+               max_retries: int = 3, backoff: float = 1.0):
+    """Creates the scraper and scrapes the hotel metadata.
+
+    Args:
+      base_url: Hotel URL formatted with `format_url`.
+      reviews_per_page: Number of reviews in each Trip Advisor review page.
+      session: HTTP session to use. Sharing a pooled session between
+        scrapers allows them to reuse connections.
+      rate_limiter: Optional `RateLimiter` that all requests go through.
+      cache: Optional `ResponseCache` that responses are served from.
+      max_retries: Number of times a request that returns a 429/5xx status
+        is retried.
+      backoff: Seconds to wait before the first retry, doubled after every
+        retry.
+    """
+    self.session = requests.Session() if session is None else session
+    self.rate_limiter = rate_limiter
+    self.cache = cache
+    self.max_retries = max_retries
+    self.backoff = backoff
     self.reviews = []
+    self.scraped_pages = []
+    self.failed_pages = []
 
     self.n_reviews = None
     self.reviews_per_page = reviews_per_page
@@ -89,29 +163,99 @@ class TripAdvisorScraper:
       print("Failed to scrape additional ratings.")
     return data
 
-  def scrape_reviews(self, start_page: int = 0, max_reviews: Optional[int] = None):
+  def scrape_reviews(self, start_page: int = 0, max_reviews: Optional[int] = None,
+                     n_workers: int = 1):
+    """Scrapes review pages and appends the reviews to `self.reviews`.
+
+    Args:
+      start_page: First review page to scrape.
+      max_reviews: Maximum number of reviews to scrape.
+      n_workers: Number of review pages of this hotel fetched concurrently.
+        Reviews are kept in page order regardless.
+    """
+    for page in self.iter_pages(start_page, max_reviews, n_workers):
+      self.reviews.extend(page)
+
+  def iter_pages(self, start_page: int = 0, max_reviews: Optional[int] = None,
+                 n_workers: int = 1) -> Iterator[List[List]]:
+    """Scrapes review pages and yields the reviews of each page in order.
+
+    Pages that failed are yielded as empty lists. See `scrape_reviews` for
+    the arguments. With multiple workers at most `n_workers` pages are
+    fetched ahead of the page that is yielded, and pages that were not
+    fetched yet are cancelled when the generator is closed.
+    """
     counter = start_page * self.reviews_per_page
     if max_reviews is None or max_reviews > self.n_reviews:
       max_reviews = self.n_reviews
+    counters = iter(range(counter, max_reviews, self.reviews_per_page))
 
-    while counter < max_reviews:
-      url = self._get_url(counter)
-      page_nr = counter // self.reviews_per_page + 1
+    if n_workers > 1:
+      executor = futures.ThreadPoolExecutor(n_workers)
+      pending = collections.deque()
       try:
-        soup = self.get_soup(url)
-        revlist = self.get_base(soup)["reviewListPage"]["reviews"]
-        for review in revlist:
-          self.reviews.append(self.scrape_review(review))
-        print("Page {} - {} reviews scrapped.".format(page_nr, len(revlist)))
-      except Exception:
-        print("Failed to read reviews on page {}.".format(page_nr))
-
-      counter += self.reviews_per_page
+        for counter in itertools.islice(counters, n_workers):
+          pending.append(executor.submit(self._try_scrape_page, counter))
+        while pending:
+          page = pending.popleft().result()
+          for counter in itertools.islice(counters, 1):
+            pending.append(executor.submit(self._try_scrape_page, counter))
+          yield page
+      finally:
+        # `cancel_futures` of `shutdown` requires Python 3.9
+        for future in pending:
+          future.cancel()
+        executor.shutdown(wait=False)
+    else:
+      for counter in counters:
+        yield self._try_scrape_page(counter)
+
+  def _try_scrape_page(self, counter: int) -> List[List]:
+    page_nr = counter // self.reviews_per_page + 1
+    try:
+      page = self.scrape_page(counter)
+      print("Page {} - {} reviews scrapped.".format(page_nr, len(page)))
+      self.scraped_pages.append(page_nr)
+      return page
+    except Exception:
+      print("Failed to read reviews on page {}.".format(page_nr))
+      self.failed_pages.append(page_nr)
+      return []
+
+  def scrape_page(self, counter: int) -> List[List]:
+    """Scrapes the review page that starts with review number `counter`."""
+    soup = self.get_soup(self._get_url(counter))
+    revlist = self.get_base(soup)["reviewListPage"]["reviews"]
+    page = [self.scrape_review(review) for review in revlist]
+    metrics.REVIEWS_SCRAPED.inc(len(page))
+    return page
+
+  def fetch(self, url: str) -> str:
+    """Returns the HTML of the given URL from the cache or the network."""
+    if self.cache is not None:
+      return self.cache.get(url, self._request)
+    req = self._request(url)
+    assert req.status_code == 200
+    return req.text
+
+  def _request(self, url: str, headers: Optional[Dict] = None
+               ) -> requests.Response:
+    """Gets the URL, retrying 429/5xx responses through the rate limiter."""
+    for attempt in range(self.max_retries + 1):
+      if attempt > 0:
+        time.sleep(self.backoff * 2 ** (attempt - 1))
+      if self.rate_limiter is not None:
+        self.rate_limiter.acquire()
+      start_time = time.perf_counter()
+      req = self.session.get(url, headers=headers)
+      metrics.HTTP_LATENCY.observe(time.perf_counter() - start_time)
+      metrics.PAGES_FETCHED.inc(status=req.status_code)
+      if req.status_code not in self._RETRY_STATUSES:
+        break
+    return req
 
   def get_soup(self, url: str) -> bs4.BeautifulSoup:
-    req = self.session.get(url)
-    assert req.status_code == 200
-    return bs4.BeautifulSoup(req.text, "html.parser")
+    return bs4.BeautifulSoup(self.fetch(url), "html.parser")
 
   def get_base(self, soup: bs4.BeautifulSoup) -> Dict:
     n = len(self._SCRIPT_TARGET)
@@ -182,8 +326,11 @@ class TripAdvisorScraper:
   def lower_name(self) -> str:
     return "_".join(self.data["name"].lower().split(" "))
 
-  def to_dataframe(self) -> pd.DataFrame:
-    return pd.DataFrame(self.reviews, columns=self._REVIEW_TITLES)
+  def to_dataframe(self, reviews: Optional[List[List]] = None
+                   ) -> pd.DataFrame:
+    if reviews is None:
+      reviews = self.reviews
+    return pd.DataFrame(reviews, columns=self._REVIEW_TITLES)
 
   @property
   def csv_path(self) -> str:
@@ -192,7 +339,12 @@ class TripAdvisorScraper:
                               "".format(self.lower_name))
     return self._csv_path
 
-  def save(self, folder: str):
+  def create_folder(self, folder: str) -> str:
+    """Creates the hotel folder with the metadata txt.
+
+    Returns:
+      Path of the created hotel folder.
+    """
     folder_name = os.path.join(folder, self.lower_name)
     if os.path.isdir(folder_name):
       raise FileExistsError("Folder {} already exists in storage.".format(
@@ -204,6 +356,16 @@ class TripAdvisorScraper:
         self.lower_name, self.n_reviews))
     with open(txt_path, "w") as file:
       json.dump(self.data, file)
+    return folder_name
+
+  def append_csv(self, reviews: List[List]):
+    """Appends scraped reviews to the csv created by `create_folder`."""
+    header = not os.path.exists(self.csv_path)
+    self.to_dataframe(reviews).to_csv(self.csv_path, mode="a", header=header,
+                                      index=False)
+
+  def save(self, folder: str):
+    self.create_folder(folder)
     df = self.to_dataframe()
     df.to_csv(self.csv_path, index=False)
 
@@ -1,3 +1,14 @@
+from tools import api
 from tools import containers
+from tools import corpus
+from tools import facets
+from tools import fragments
 from tools import hotel
+from tools import ingest
+from tools import mapped
+from tools import metrics
+from tools import preview
+from tools import storage
+from tools import synthetic
+from tools import tracing
 from tools import utils
\ No newline at end of file
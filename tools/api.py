@@ -0,0 +1,209 @@
+"""Read-only JSON API for hotel summaries, aspects and reviews.
+
+Endpoints:
+  * /api/hotels/<hotelname>: Hotel summary.
+  * /api/hotels/<hotelname>/aspects?sign=pos&offset=0&limit=50:
+    Ranked aspects.
+  * /api/hotels/<hotelname>/aspects/<word>/reviews?sign=pos&page=1&per_page=20:
+    Paginated reviews in which `word` is an aspect with the given sign.
+
+The aspects and reviews endpoints accept the facet filters of the analysis
+page (see `tools.facets`), eg. ?tripType=Business&rating=1&rating=2.
+
+Lists are returned in columnar form (one array per field) to keep payloads
+compact. Responses are compressed with brotli (if installed) or gzip and
+carry strong ETags derived from the hotel data version, so that clients and
+CDNs can cache them and revalidate with If-None-Match.
+"""
+import gzip
+import json
+import hashlib
+import itertools
+import flask
+from tools import facets
+from tools import hotel as hotel_lib
+from typing import Any, Dict, List, Optional
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+blueprint = flask.Blueprint("api", __name__, url_prefix="/api")
+
+_MIN_COMPRESS_BYTES = 1024
+_MAX_PER_PAGE = 100
+
+
+def _hotel_folder(hotelname: str) -> str:
+  try:
+    return flask.current_app.config["STORAGE"].local_folder(hotelname)
+  except FileNotFoundError:
+    flask.abort(404)
+
+
+def _int_arg(name: str, default: int, minimum: int = 0,
+             maximum: Optional[int] = None) -> int:
+  value = flask.request.args.get(name, default)
+  try:
+    value = int(value)
+  except ValueError:
+    flask.abort(400, "Argument {} should be an integer.".format(name))
+  if value < minimum or (maximum is not None and value > maximum):
+    flask.abort(400, "Argument {} is out of range.".format(name))
+  return value
+
+
+def _sign_arg() -> str:
+  sign = flask.request.args.get("sign", "pos")
+  if sign not in ("pos", "neg"):
+    flask.abort(400, "Argument sign should be 'pos' or 'neg'.")
+  return sign
+
+
+def _choose_encoding() -> Optional[str]:
+  accepted = flask.request.accept_encodings
+  if brotli is not None and accepted["br"]:
+    return "br"
+  if accepted["gzip"]:
+    return "gzip"
+  return None
+
+
+def _etag(version: str, encoding: Optional[str]) -> str:
+  """Strong ETag of the requested representation."""
+  query = flask.request.full_path.encode("utf-8")
+  return "{}-{}-{}".format(version, hashlib.sha1(query).hexdigest()[:12],
+                           encoding or "identity")
+
+
+def _cached_response(folder: str, build) -> flask.Response:
+  """Builds a compressed JSON response or returns 304 if not modified.
+
+  Args:
+    folder: Hotel folder, used to find the current data version.
+    build: Function that takes the loaded `Hotel` and returns the payload.
+      It is only called when the client does not have the current version.
+  """
+  encoding = _choose_encoding()
+  version = hotel_lib.data_version(folder)
+  etag = _etag(version, encoding)
+  # Small payloads are sent uncompressed with the identity ETag
+  identity_etag = _etag(version, None)
+  if flask.request.if_none_match.contains(identity_etag):
+    etag = identity_etag
+  if flask.request.if_none_match.contains(etag):
+    response = flask.Response(status=304)
+  else:
+    hotel = hotel_lib.Hotel.load_from_folder(folder)
+    hotel.apply_filters(facets.parse_filters(flask.request.args))
+    body = json.dumps(build(hotel), separators=(",", ":")).encode("utf-8")
+    response = flask.Response(body, mimetype="application/json")
+    if len(body) >= _MIN_COMPRESS_BYTES and encoding is not None:
+      if encoding == "br":
+        response.set_data(brotli.compress(body))
+      else:
+        response.set_data(gzip.compress(body, compresslevel=6))
+      response.headers["Content-Encoding"] = encoding
+    else:
+      etag = identity_etag
+
+  response.set_etag(etag)
+  response.headers["Vary"] = "Accept-Encoding"
+  response.cache_control.public = True
+  response.cache_control.max_age = flask.current_app.config.get(
+      "API_MAX_AGE", 300)
+  return response
+
+
+def _columns(rows: List[Dict[str, Any]], names: List[str]) -> Dict[str, List]:
+  return {name: [row[name] for row in rows] for name in names}
+
+
+@blueprint.route("/hotels/<hotelname>")
+def summary(hotelname: str):
+  def build(hotel: hotel_lib.Hotel) -> Dict:
+    rating_counts = hotel.ratings.value_counts().sort_index()
+    return {"id": hotel.id,
+            "name": getattr(hotel, "name", hotel.id),
+            "version": hotel.version,
+            "n_reviews": hotel.n_reviews,
+            "filters": hotel.filters,
+            "n_filtered_reviews": hotel.n_filtered_reviews,
+            "n_reviews_with_aspects": hotel.aspects.n_reviews,
+            "rating_counts": {str(k): int(v) for k, v in rating_counts.items()},
+            "aspects_sentiment": dict(zip(
+                ["negative", "neutral", "positive"],
+                hotel.aspects.n_reviews_aspects_sentiment)),
+            "additional_ratings": getattr(hotel, "additionalRatings", {})}
+  return _cached_response(_hotel_folder(hotelname), build)
+
+
+@blueprint.route("/hotels/<hotelname>/aspects")
+def aspects(hotelname: str):
+  sign = _sign_arg()
+  offset = _int_arg("offset", 0)
+  limit = _int_arg("limit", flask.current_app.config.get("NUM_ASPECTS", 50),
+                   minimum=1, maximum=1000)
+
+  def build(hotel: hotel_lib.Hotel) -> Dict:
+    if sign == "pos":
+      ranked = hotel.aspects.most_common_positive
+    else:
+      ranked = hotel.aspects.most_common_negative
+    rows = [{"text": word.text, "score": float(word.score),
+             "positive": int(word.positive_appearances),
+             "negative": int(word.negative_appearances)}
+            for word in ranked[offset:offset + limit]]
+    return {"sign": sign, "offset": offset, "total": len(ranked),
+            "aspects": _columns(rows, ["text", "score", "positive",
+                                       "negative"])}
+  return _cached_response(_hotel_folder(hotelname), build)
+
+
+_REVIEW_FIELDS = [("title", "title"), ("url", "absoluteUrl"),
+                  ("published", "publishedDate"), ("rating", "rating"),
+                  ("helpful_votes", "helpfulVotes"), ("username", "username"),
+                  ("hometown", "user_hometownName")]
+
+
+def _json_value(value):
+  """Converts numpy/pandas scalars and missing values to json types."""
+  if value is None:
+    return None
+  if hasattr(value, "item"):
+    value = value.item()
+  if isinstance(value, float) and value != value:
+    return None
+  return value
+
+
+@blueprint.route("/hotels/<hotelname>/aspects/<word>/reviews")
+def reviews(hotelname: str, word: str):
+  sign = _sign_arg()
+  page = _int_arg("page", 1, minimum=1)
+  per_page = _int_arg("per_page", 20, minimum=1, maximum=_MAX_PER_PAGE)
+
+  def build(hotel: hotel_lib.Hotel) -> Dict:
+    if word not in hotel.aspects.known_words:
+      flask.abort(404)
+    aspect = hotel.aspects.known_words[word]
+    if sign == "pos":
+      total = aspect.positive_appearances
+    else:
+      total = aspect.negative_appearances
+    start = (page - 1) * per_page
+    selected = itertools.islice(aspect.get_reviews(sign), start,
+                                start + per_page)
+    rows = []
+    for review in selected:
+      row = {k: _json_value(review.data.get(column))
+             for k, column in _REVIEW_FIELDS}
+      row["text"] = str(review)
+      row["score"] = float(review.score)
+      row["aspects"] = [[str(a), float(s)] for a, s in review.aspects.items()]
+      rows.append(row)
+    names = [k for k, _ in _REVIEW_FIELDS] + ["text", "score", "aspects"]
+    return {"word": word, "sign": sign, "page": page, "per_page": per_page,
+            "total": int(total), "reviews": _columns(rows, names)}
+  return _cached_response(_hotel_folder(hotelname), build)
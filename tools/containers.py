@@ -1,13 +1,71 @@
 import collections
 import pandas as pd
 from tools.stopwords import STOP_WORDS
-from typing import List, Optional, Union
+from typing import Any, Iterable, List, Optional, Tuple, Union
 
 
 def get_color(positive: bool = True) -> str:
   return "MediumSeaGreen" if positive else "Tomato"
 
 
+def color_aspects(text: str, aspects: Iterable[Tuple[Any, float]],
+                  word: str) -> str:
+  """Colors all aspects of a review text and bolds the selected aspect word.
+
+  Args:
+    text: Full review text.
+    aspects: Pairs of aspect words (or `AspectWord`s) and their scores.
+    word: The selected aspect word.
+
+  Returns:
+    The text as HTML.
+  """
+  # TODO: Fix bugs with coloring
+  text = text.replace("\n", "<br>")
+  for aspect, score in aspects:
+    color = get_color(score > 0)
+    if str(aspect) == word:
+      text = text.replace(
+          "{}".format(aspect),
+          "<b><font color='{}'>{}</font></b>".format(color, aspect))
+    else:
+      text = text.replace(
+          "{}".format(aspect),
+          "<font color='{}'>{}</font>".format(color, aspect))
+  return text
+
+
+class RowView:
+  """Attribute access to a single row of a DataFrame (eg. `data.title`).
+
+  Used instead of `data.iloc[i]`, which copies the row in a new `pd.Series`
+  for every review. Values are looked up when they are accessed.
+  """
+
+  __slots__ = ("_frame", "_index")
+
+  def __init__(self, frame: pd.DataFrame, index: int):
+    self._frame = frame
+    self._index = index
+
+  def __getattr__(self, name: str):
+    if name.startswith("_"):
+      raise AttributeError(name)
+    try:
+      return self[name]
+    except KeyError:
+      raise AttributeError(name)
+
+  def __getitem__(self, name: str):
+    return self._frame.iat[self._index, self._frame.columns.get_loc(name)]
+
+  def get(self, name: str, default=None):
+    try:
+      return self[name]
+    except KeyError:
+      return default
+
+
 class AspectWord:
   """Data structure for an aspect WORD.
 
@@ -17,9 +75,11 @@ class AspectWord:
       the WORD as an aspect and maps them to the corresponding score.
   """
 
+  __slots__ = ("_text", "reviews")
+
   def __init__(self, word: str):
     self._text = word
-    self.reviews = collections.Counter({})
+    self.reviews = {}
 
   def __str__(self):
     return self._text
@@ -68,13 +128,16 @@ class Review:
     * self.text: The full text of the REVIEW as str.
     * self.aspects: Dict[AspectWord, float] that contains all aspects present
       in REVIEW mapped to their scores.
-    * self.index: The index of the REVIEW in the hotel DataFrame.
+    * self.data: The row of the REVIEW in the hotel DataFrame, either as a
+      `pd.Series` or as a `RowView`.
   """
-  # FIXME: Update docstring for data (Series)
 
-  def __init__(self, text: str, data: Optional[pd.Series] = None):
+  __slots__ = ("_text", "aspects", "data")
+
+  def __init__(self, text: str,
+               data: Optional[Union[pd.Series, RowView]] = None):
     self._text = text
-    self.aspects = collections.Counter({})
+    self.aspects = {}
 
     self.data = data
 
@@ -95,20 +158,7 @@ class Review:
     return sum(self.aspects.values())
 
   def colored_text(self, word: str) -> str:
-    # TODO: Fix bugs with coloring
-    text = str(self).replace("\n", "<br>")
-    # Color all aspects and bold selected aspect word
-    for aspect, score in self.aspects.items():
-      color = get_color(score > 0)
-      if str(aspect) == word:
-        text = text.replace(
-            "{}".format(aspect),
-            "<b><font color='{}'>{}</font></b>".format(color, aspect))
-      else:
-        text = text.replace(
-            "{}".format(aspect),
-            "<font color='{}'>{}</font>".format(color, aspect))
-    return text
+    return color_aspects(str(self), self.aspects.items(), word)
 
 
 class AspectsCollection:
@@ -120,11 +170,18 @@ class AspectsCollection:
     * self.reviews: List of `Review` with the ordering of the DataFrame.
     * known_words: Dict from words (str) to the corresponding `AspectWord`.
     * aspects_scores: Dict from `AspectWord` to its corresponding score.
+
+  Args:
+    data: DataFrame with the reviews and their aspects.
+    row_views: If True each `Review` refers to its row in `data` through a
+      `RowView`. Otherwise it keeps a copy of the row (`data.iloc[i]`),
+      which takes a few KB per review.
   """
 
   def __init__(self, data: pd.DataFrame,
                text_col_name: str = "text",
-               aspect_col_name: str = "aspects"):
+               aspect_col_name: str = "aspects",
+               row_views: bool = True):
     self.reviews = []
 
     self.known_words = {} # Dict[str, WordAspect]
@@ -135,7 +192,8 @@ class AspectsCollection:
       if aspect_counter is None:
         continue
 
-      review = Review(review_text, data=data.iloc[i])
+      row = RowView(data, i) if row_views else data.iloc[i]
+      review = Review(review_text, data=row)
       self.reviews.append(review)
 
       for word, score in aspect_counter.items():
@@ -0,0 +1,254 @@
+"""Integer-encoded corpus of lemmatized reviews.
+
+Each hotel corpus consists of a lemma vocabulary and a flat int32 array with
+the token ids of all documents, with document boundaries given by an offsets
+array. It is extracted from spaCy docs with `Doc.to_array`, so that string
+cleaning runs once per distinct lemma instead of once per token, and
+lemmatized texts, word frequencies and n-gram counts are computed with numpy
+operations instead of re-tokenizing text.
+"""
+import os
+import re
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from tools import mapped
+from typing import Iterable, List, Optional, Sequence
+
+FOLDER_NAME = "corpus"
+# Same cleaning as the original string based lemmatization
+_NON_LETTERS = re.compile(r"[^a-zA-z\s]")
+
+
+def clean_lemma(lemma: str) -> str:
+  """Leaves only letters, collapses whitespace and makes lower case."""
+  return " ".join(_NON_LETTERS.sub(" ", lemma).split()).lower()
+
+
+class TokenCorpus:
+  """Lemma vocabulary with flat token ids and document offsets.
+
+  Contains:
+    * self.vocab: Array (object dtype) with the cleaned lemmas sorted.
+    * self.token_ids: int32 array with the vocabulary id of every token.
+    * self.offsets: int64 array with the start of each document in
+      `token_ids` (plus the total number of tokens at the end).
+    * self.doc_rows: Position of each document in the reviews DataFrame.
+  """
+
+  def __init__(self, vocab: Sequence[str], token_ids: np.ndarray,
+               offsets: np.ndarray, doc_rows: Optional[np.ndarray] = None):
+    self.vocab = np.array(list(vocab), dtype=object)
+    self.token_ids = token_ids
+    self.offsets = offsets
+    if doc_rows is None:
+      doc_rows = np.arange(self.n_docs, dtype=np.int64)
+    self.doc_rows = doc_rows
+
+  @property
+  def n_docs(self) -> int:
+    return len(self.offsets) - 1
+
+  @property
+  def n_tokens(self) -> int:
+    return len(self.token_ids)
+
+  @classmethod
+  def _from_raw_ids(cls, raw_ids: np.ndarray, raw_strings: Sequence[str],
+                    lengths: np.ndarray,
+                    doc_rows: Optional[np.ndarray] = None) -> "TokenCorpus":
+    """Builds the corpus from per token ids of uncleaned strings.
+
+    Args:
+      raw_ids: Index of each token's uncleaned string in `raw_strings`.
+      raw_strings: Distinct uncleaned strings.
+      lengths: Number of tokens of each document.
+    """
+    cleaned = [clean_lemma(s) for s in raw_strings]
+    vocab, remap = np.unique(np.array(cleaned + [""], dtype=object),
+                             return_inverse=True)
+    token_ids = remap[raw_ids]
+    # Tokens that are empty after cleaning are dropped
+    empty_id = remap[-1]
+    keep = token_ids != empty_id
+    doc_index = np.repeat(np.arange(len(lengths)), lengths)
+    kept_lengths = np.bincount(doc_index[keep], minlength=len(lengths))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(kept_lengths, out=offsets[1:])
+
+    # Remove the empty string from the vocabulary
+    token_ids = token_ids[keep]
+    token_ids = (token_ids - (token_ids > empty_id)).astype(np.int32)
+    vocab = np.delete(vocab, empty_id)
+    return cls(vocab, token_ids, offsets, doc_rows)
+
+  @classmethod
+  def from_docs(cls, docs: Sequence, doc_rows: Optional[np.ndarray] = None
+                ) -> "TokenCorpus":
+    """Extracts the corpus from spaCy docs.
+
+    Pronoun lemmas (-PRON-) are replaced by the lower case token text.
+    """
+    from spacy import attrs
+    if not docs:
+      return cls([], np.zeros(0, dtype=np.int32),
+                 np.zeros(1, dtype=np.int64), doc_rows)
+
+    strings = docs[0].vocab.strings
+    arrays = [doc.to_array([attrs.LEMMA, attrs.LOWER]) for doc in docs]
+    lengths = np.array([len(doc) for doc in docs], dtype=np.int64)
+    hashes = np.concatenate(arrays).reshape(-1, 2).astype(np.uint64)
+    pron = np.uint64(strings.add("-PRON-"))
+    hashes = np.where(hashes[:, 0] == pron, hashes[:, 1], hashes[:, 0])
+
+    unique_hashes, raw_ids = np.unique(hashes, return_inverse=True)
+    raw_strings = [strings[int(h)] for h in unique_hashes]
+    return cls._from_raw_ids(raw_ids, raw_strings, lengths, doc_rows)
+
+  @classmethod
+  def from_texts(cls, texts: Iterable[Optional[str]]) -> "TokenCorpus":
+    """Builds the corpus from already lemmatized texts (eg. legacy data).
+
+    Rows with missing text are not included as documents.
+    """
+    tokens, lengths, doc_rows = [], [], []
+    for i, text in enumerate(texts):
+      if isinstance(text, str):
+        words = text.split()
+        tokens.extend(words)
+        lengths.append(len(words))
+        doc_rows.append(i)
+    raw_strings, raw_ids = np.unique(np.array(tokens, dtype=object),
+                                     return_inverse=True)
+    return cls._from_raw_ids(raw_ids, list(raw_strings),
+                             np.array(lengths, dtype=np.int64),
+                             np.array(doc_rows, dtype=np.int64))
+
+  @classmethod
+  def concatenate(cls, corpora: Sequence["TokenCorpus"],
+                  row_offsets: Sequence[int]) -> "TokenCorpus":
+    """Merges corpora of consecutive batches of reviews.
+
+    Args:
+      corpora: Corpus of each batch.
+      row_offsets: Position of the first review of each batch in the merged
+        reviews, which is added to the `doc_rows` of the batch.
+    """
+    corpora = list(corpora)
+    if not corpora:
+      return cls([], np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64))
+    all_words = np.concatenate([c.vocab for c in corpora] +
+                               [np.array([], dtype=object)])
+    vocab, remap = np.unique(all_words, return_inverse=True)
+    token_ids, offsets, doc_rows = [], [np.zeros(1, dtype=np.int64)], []
+    word_start, token_start = 0, 0
+    for c, row_offset in zip(corpora, row_offsets):
+      batch_remap = remap[word_start:word_start + len(c.vocab)]
+      token_ids.append(batch_remap[np.asarray(c.token_ids)])
+      offsets.append(np.asarray(c.offsets[1:]) + token_start)
+      doc_rows.append(np.asarray(c.doc_rows) + row_offset)
+      word_start += len(c.vocab)
+      token_start += c.n_tokens
+    return cls(vocab, np.concatenate(token_ids).astype(np.int32),
+               np.concatenate(offsets),
+               np.concatenate(doc_rows).astype(np.int64))
+
+  def doc(self, i: int) -> np.ndarray:
+    return self.token_ids[self.offsets[i]:self.offsets[i + 1]]
+
+  def texts(self) -> List[str]:
+    """Lemmatized text of every document."""
+    words = self.vocab[self.token_ids]
+    return [" ".join(words[self.offsets[i]:self.offsets[i + 1]])
+            for i in range(self.n_docs)]
+
+  def word_counts(self) -> pd.Series:
+    """Number of appearances of each lemma, most common first."""
+    counts = np.bincount(self.token_ids, minlength=len(self.vocab))
+    order = np.argsort(-counts, kind="stable")
+    return pd.Series(counts[order], index=self.vocab[order])
+
+  def document_frequencies(self) -> pd.Series:
+    """Number of documents that contain each lemma, most common first."""
+    doc_index = np.repeat(np.arange(self.n_docs), np.diff(self.offsets))
+    pairs = np.unique(doc_index.astype(np.int64) * len(self.vocab) +
+                      self.token_ids)
+    counts = np.bincount(pairs % max(len(self.vocab), 1),
+                         minlength=len(self.vocab))
+    order = np.argsort(-counts, kind="stable")
+    return pd.Series(counts[order], index=self.vocab[order])
+
+  def ngram_counts(self, n: int = 2, min_count: int = 1) -> pd.Series:
+    """Counts the n-grams that do not cross document boundaries.
+
+    Returns:
+      Series from n-gram strings (lemmas joined with spaces) to counts,
+      most common first.
+    """
+    n_valid = self.n_tokens - n + 1
+    if n_valid <= 0:
+      return pd.Series([], dtype=np.int64)
+    doc_index = np.repeat(np.arange(self.n_docs), np.diff(self.offsets))
+    valid = doc_index[:n_valid] == doc_index[n - 1:]
+
+    size = len(self.vocab)
+    if size ** n <= np.iinfo(np.int64).max:
+      # Encode each n-gram as a single integer, faster than unique rows
+      codes = np.zeros(n_valid, dtype=np.int64)
+      for k in range(n):
+        codes = codes * np.int64(size) + self.token_ids[k:k + n_valid]
+      codes, counts = np.unique(codes[valid], return_counts=True)
+      ids = np.zeros((len(codes), n), dtype=np.int64)
+      for k in range(n - 1, -1, -1):
+        ids[:, k] = codes % size
+        codes = codes // size
+    else:
+      # The codes would overflow int64
+      windows = np.stack([self.token_ids[k:k + n_valid] for k in range(n)],
+                         axis=1)
+      ids, counts = np.unique(windows[valid], axis=0, return_counts=True)
+    frequent = counts >= min_count
+    ids, counts = ids[frequent], counts[frequent]
+
+    order = np.argsort(-counts, kind="stable")
+    ids, counts = ids[order], counts[order]
+    index = [" ".join(words) for words in self.vocab[ids]]
+    return pd.Series(counts, index=index)
+
+  def save(self, folder: str):
+    """Saves the corpus in `folder/corpus`, replacing any previous one."""
+    target = os.path.join(folder, FOLDER_NAME)
+    tmp_target = "{}_tmp{}".format(target, os.getpid())
+    shutil.rmtree(tmp_target, ignore_errors=True)
+    os.mkdir(tmp_target)
+    vocab_data, vocab_offsets = mapped.encode_strings(list(self.vocab))
+    arrays = {"vocab.data": vocab_data, "vocab.offsets": vocab_offsets,
+              "token_ids": self.token_ids, "offsets": self.offsets,
+              "doc_rows": self.doc_rows}
+    for name, array in arrays.items():
+      np.save(os.path.join(tmp_target, name + ".npy"), array)
+    with open(os.path.join(tmp_target, "meta.json"), "w") as file:
+      json.dump({"n_docs": self.n_docs, "n_tokens": self.n_tokens,
+                 "n_words": len(self.vocab)}, file)
+    if os.path.isdir(target):
+      shutil.rmtree(target)
+    os.rename(tmp_target, target)
+
+  @classmethod
+  def load(cls, folder: str) -> "TokenCorpus":
+    """Loads a saved corpus memory-mapping the token arrays."""
+    path = os.path.join(folder, FOLDER_NAME)
+    def load(name, mmap_mode="r"):
+      try:
+        return np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+      except ValueError:
+        # Empty arrays cannot be memory-mapped
+        return np.load(os.path.join(path, name + ".npy"))
+    vocab = mapped.StringColumn(load("vocab.data"), load("vocab.offsets"))
+    return cls(list(vocab), load("token_ids"), load("offsets"),
+               load("doc_rows"))
+
+
+def has_corpus(folder: str) -> bool:
+  return os.path.exists(os.path.join(folder, FOLDER_NAME, "meta.json"))
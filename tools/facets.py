@@ -0,0 +1,150 @@
+"""Facet indexes for filtering the aspects of a hotel by review metadata.
+
+For each facet (trip type, star rating, year and language) the reviews are
+grouped by facet value in a sorted-id index: the ids of the reviews sorted by
+value and the offsets of each value in them. The indexes are written in the
+mapped store when the hotel is processed (see `mapped.write_store`), so a
+filter combination is answered by taking the union of the selected values
+of each facet and intersecting the facets as boolean masks over the reviews.
+The aspects are then re-ranked with masked reductions over the flat aspect
+arrays of the store (`mapped.Aggregates.from_mask`) instead of rebuilding an
+`AspectsCollection` from a filtered DataFrame.
+
+Filters are given as query parameters, eg.
+  /analysis/<hotelname>?tripType=Business&rating=1&rating=2&year=2019
+"""
+import numpy as np
+import pandas as pd
+from tools import mapped
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Facet name to the review column it is derived from
+FACETS = {"tripType": "tripType", "rating": "rating",
+          "year": "publishedDate", "language": "language"}
+LABELS = {"tripType": "Trip type", "rating": "Rating", "year": "Year",
+          "language": "Language"}
+
+
+def _to_values(name: str, column: Sequence) -> List[str]:
+  """Converts a review column to the str facet value of each review.
+
+  Missing values are converted to "" and are not indexed.
+  """
+  column = pd.Series(list(column), dtype=object)
+  if name == "year":
+    years = pd.to_datetime(column, errors="coerce").dt.year
+    return ["" if pd.isnull(y) else str(int(y)) for y in years]
+  if name == "rating":
+    ratings = pd.to_numeric(column, errors="coerce")
+    return ["" if pd.isnull(r) or r <= 0 else str(int(r)) for r in ratings]
+  return [v if isinstance(v, str) else "" for v in column]
+
+
+def build_index(values: Sequence[str]) -> Tuple[List[str], np.ndarray,
+                                                np.ndarray]:
+  """Builds the sorted-id index of a facet.
+
+  Returns:
+    keys: Sorted distinct non-empty facet values.
+    ids: int32 ids of the reviews sorted by facet value.
+    offsets: int64 start of each value in `ids` (plus the end).
+  """
+  values = np.array(list(values), dtype=object)
+  indexed = np.flatnonzero(values != "")
+  keys, codes = np.unique(values[indexed], return_inverse=True)
+  ids = indexed[np.argsort(codes, kind="stable")].astype(np.int32)
+  offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+  np.cumsum(np.bincount(codes, minlength=len(keys)), out=offsets[1:])
+  return list(keys), ids, offsets
+
+
+def index_arrays(data: pd.DataFrame) -> Dict[str, np.ndarray]:
+  """Facet index arrays for the columns available in `data`.
+
+  Used by `mapped.write_store` to save the indexes with the hotel.
+  """
+  arrays = {}
+  for name, column in FACETS.items():
+    if column not in data:
+      continue
+    keys, ids, offsets = build_index(_to_values(name, data[column]))
+    prefix = "facet_{}".format(name)
+    arrays[prefix + ".data"], arrays[prefix + ".offsets"] = (
+        mapped.encode_strings(keys))
+    arrays[prefix + "_ids"] = ids
+    arrays[prefix + "_offsets"] = offsets
+  return arrays
+
+
+class FacetIndex:
+  """Sorted-id indexes of the facets of a hotel's reviews.
+
+  Args:
+    n_reviews: Total number of reviews.
+    indexes: Dict from facet name to the (keys, ids, offsets) returned by
+      `build_index`.
+  """
+
+  def __init__(self, n_reviews: int,
+               indexes: Dict[str, Tuple[Sequence[str], np.ndarray,
+                                        np.ndarray]]):
+    self.n_reviews = n_reviews
+    self.indexes = indexes
+    self._positions = {name: {key: i for i, key in enumerate(keys)}
+                       for name, (keys, _, _) in indexes.items()}
+
+  @classmethod
+  def from_store(cls, store: mapped.MappedStore) -> "FacetIndex":
+    """Opens the indexes saved in the store or builds the missing ones."""
+    indexes = {}
+    for name, column in FACETS.items():
+      prefix = "facet_{}".format(name)
+      if store.has_column(prefix):
+        indexes[name] = (list(store.column(prefix)),
+                         store.arrays[prefix + "_ids"],
+                         store.arrays[prefix + "_offsets"])
+      elif store.has_column(column):
+        # Stores written before the facet indexes were added
+        indexes[name] = build_index(_to_values(name, store.column(column)))
+    return cls(store.n_reviews, indexes)
+
+  @classmethod
+  def from_data(cls, data: pd.DataFrame) -> "FacetIndex":
+    indexes = {name: build_index(_to_values(name, data[column]))
+               for name, column in FACETS.items() if column in data}
+    return cls(len(data), indexes)
+
+  def counts(self, name: str) -> List[Tuple[str, int]]:
+    """Values of a facet with their number of reviews."""
+    keys, _, offsets = self.indexes[name]
+    return list(zip(keys, np.diff(offsets).tolist()))
+
+  def facet_mask(self, name: str, values: Sequence[str]) -> np.ndarray:
+    """Mask of the reviews that have any of the given values of a facet."""
+    mask = np.zeros(self.n_reviews, dtype=bool)
+    if name not in self.indexes:
+      return mask
+    _, ids, offsets = self.indexes[name]
+    for value in values:
+      position = self._positions[name].get(value)
+      if position is not None:
+        mask[ids[offsets[position]:offsets[position + 1]]] = True
+    return mask
+
+  def mask(self, filters: Dict[str, Sequence[str]]) -> Optional[np.ndarray]:
+    """Mask of the reviews that match all filters, None if no filters."""
+    mask = None
+    for name, values in filters.items():
+      facet_mask = self.facet_mask(name, values)
+      mask = facet_mask if mask is None else mask & facet_mask
+    return mask
+
+
+def parse_filters(args) -> Dict[str, List[str]]:
+  """Reads facet filters from the query parameters of a request."""
+  filters = {}
+  for name in FACETS:
+    values = [v for v in args.getlist(name) if v]
+    if values:
+      filters[name] = values
+  return filters
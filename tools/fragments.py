@@ -0,0 +1,207 @@
+"""Cache of rendered HTML fragments of the analysis and reviews pages.
+
+The aspect tables, chart blocks and review lists only change when the data
+of a hotel change, so they are rendered once per hotel id, data version
+(`hotel.data_version`) and request query (eg. word and facet filters) and
+then served from the cache. Old versions are never served because the
+version is part of the key; they are evicted when the cache exceeds its
+size.
+
+Backends:
+  * `MemoryLRU`: In-process least recently used cache.
+  * `DiskStore`: Files in a local directory shared by all gunicorn workers.
+    File modification times are used as last access times for eviction and
+    are updated at most once per `touch_interval` seconds.
+"""
+import os
+import time
+import hashlib
+import tempfile
+import threading
+import collections
+import flask
+import markupsafe
+from tools import metrics, tracing
+from typing import Callable, Optional
+
+
+class MemoryLRU:
+  """In-process LRU cache bounded by the total size of the values in bytes."""
+
+  def __init__(self, max_bytes: int):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self._values = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key: str) -> Optional[bytes]:
+    with self._lock:
+      value = self._values.get(key)
+      if value is not None:
+        self._values.move_to_end(key)
+      return value
+
+  def set(self, key: str, value: bytes):
+    if len(value) > self.max_bytes:
+      return
+    with self._lock:
+      if key in self._values:
+        self.size -= len(self._values.pop(key))
+      self._values[key] = value
+      self.size += len(value)
+      while self.size > self.max_bytes:
+        _, evicted = self._values.popitem(last=False)
+        self.size -= len(evicted)
+
+
+class DiskStore:
+  """On-disk cache shared by processes, bounded by its size in bytes."""
+
+  def __init__(self, directory: str, max_bytes: int,
+               touch_interval: float = 60.0):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.touch_interval = touch_interval
+    os.makedirs(directory, exist_ok=True)
+    self._lock = threading.Lock()
+    self.size = sum(os.path.getsize(path) for path in self._paths())
+
+  def _path(self, key: str) -> str:
+    return os.path.join(self.directory, key[:2], "{}.html".format(key))
+
+  def _paths(self):
+    for subfolder in os.listdir(self.directory):
+      folder = os.path.join(self.directory, subfolder)
+      if os.path.isdir(folder):
+        for file in os.listdir(folder):
+          if not file.endswith(".tmp"):
+            yield os.path.join(folder, file)
+
+  def get(self, key: str) -> Optional[bytes]:
+    path = self._path(key)
+    try:
+      with open(path, "rb") as file:
+        value = file.read()
+        last_access = os.fstat(file.fileno()).st_mtime
+      if time.time() - last_access > self.touch_interval:
+        os.utime(path)
+      return value
+    except OSError:
+      # Missing or evicted by another worker
+      return None
+
+  def set(self, key: str, value: bytes):
+    if len(value) > self.max_bytes:
+      return
+    path = self._path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as file:
+      file.write(value)
+    try:
+      old_size = os.path.getsize(path)
+    except OSError:
+      old_size = 0
+    os.replace(tmp_path, path)
+    with self._lock:
+      self.size += len(value) - old_size
+      if self.size > self.max_bytes:
+        self.evict()
+
+  def evict(self, target_fraction: float = 0.9):
+    """Removes least recently used files until the store is small enough.
+
+    The size is recomputed from the directory since other workers write to
+    it too. Should be called with the lock held.
+    """
+    entries = []
+    for path in self._paths():
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    self.size = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+      if self.size <= target_fraction * self.max_bytes:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      self.size -= size
+
+
+class FragmentCache:
+  """Renders fragment templates through a cache backend."""
+
+  def __init__(self, backend):
+    self.backend = backend
+
+  @staticmethod
+  def key(hotel_id: str, version: str, name: str, query: str) -> str:
+    text = "\n".join([hotel_id, version or "", name, query])
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+  def get_or_render(self, key: str, render: Callable[[], str]
+                    ) -> markupsafe.Markup:
+    value = self.backend.get(key)
+    if value is not None:
+      metrics.FRAGMENT_REQUESTS.inc(result="hit")
+      return markupsafe.Markup(value.decode("utf-8"))
+    metrics.FRAGMENT_REQUESTS.inc(result="miss")
+    html = render()
+    self.backend.set(key, html.encode("utf-8"))
+    return markupsafe.Markup(html)
+
+
+def create(kind: Optional[str], max_bytes: int,
+           directory: Optional[str] = None) -> Optional[FragmentCache]:
+  """Creates a fragment cache.
+
+  Args:
+    kind: "memory", "disk" or None to disable caching.
+    max_bytes: Maximum size of the cached fragments.
+    directory: Directory of the "disk" backend.
+  """
+  if not kind:
+    return None
+  if kind == "memory":
+    return FragmentCache(MemoryLRU(max_bytes))
+  if kind == "disk":
+    return FragmentCache(DiskStore(directory, max_bytes))
+  raise ValueError("Unknown fragment cache {}.".format(kind))
+
+
+def init_app(app: flask.Flask):
+  """Creates the fragment cache configured by `FRAGMENT_CACHE*` settings."""
+  cache = create(app.config.get("FRAGMENT_CACHE"),
+                 app.config.get("FRAGMENT_CACHE_MB", 64) * 2 ** 20,
+                 app.config.get("FRAGMENT_CACHE_DIR"))
+  if cache is not None:
+    app.extensions["fragments"] = cache
+
+
+def render(hotel, name: str, **context) -> markupsafe.Markup:
+  """Renders `templates/fragments/<name>.html` for a hotel using the cache.
+
+  The fragment is keyed by the hotel id and data version and the full path
+  of the request, which contains the selected word and facet filters.
+
+  Args:
+    hotel: The `Hotel` that is shown. The template gets it as `hotel`.
+    name: Name of the fragment template.
+    context: Additional template variables. These should be determined by
+      the request path or the app config, since they are not in the key.
+  """
+  def render_template() -> str:
+    with tracing.span("render"):
+      return flask.render_template("fragments/{}.html".format(name),
+                                   hotel=hotel, **context)
+
+  cache = flask.current_app.extensions.get("fragments")
+  if cache is None:
+    return markupsafe.Markup(render_template())
+  key = cache.key(hotel.id, hotel.version, name, flask.request.full_path)
+  return cache.get_or_render(key, render_template)
@@ -1,13 +1,63 @@
 import os
 import json
 import flask
+import hashlib
+import numpy as np
 import pandas as pd
-from tools import containers, utils
+from tools import containers, mapped, tracing, utils
+from tools import facets as facets_lib
 
 import plotly
 from plotly import graph_objects as go
 
-from typing import Any, Dict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+def data_version(folder: str) -> str:
+  """Identifier that changes whenever the data of a hotel folder change.
+
+  It is derived from the content hash of the mapped store (if it exists)
+  and the names, sizes and modification times of the other files, so it is
+  cheap to compute without loading the hotel.
+  """
+  signature = hashlib.sha256()
+  if mapped.has_store(folder):
+    signature.update(mapped.read_meta(folder)["version"].encode("utf-8"))
+  for file in sorted(os.listdir(folder)):
+    path = os.path.join(folder, file)
+    if os.path.isfile(path):
+      stat = os.stat(path)
+      signature.update("{}:{}:{};".format(file, stat.st_size,
+                                          stat.st_mtime_ns).encode("utf-8"))
+  return signature.hexdigest()[:16]
+
+
+def encode_plot(*plot):
+  with tracing.span("serialize"):
+    return json.dumps(list(plot), cls=plotly.utils.PlotlyJSONEncoder)
+
+
+_PIE_COLORS = ["rgb(227,26,28)", "rgb(251,154,153)", "rgb(166,206,227)",
+               "rgb(129,218,85)", "rgb(51,160,44)"]
+
+
+def rating_counts_piechart(rating_counts: Iterable[Tuple[Any, int]]):
+  """Pie chart of (star rating, number of reviews) pairs."""
+  labels, values = [], []
+  for l, v in rating_counts:
+    labels.append(l)
+    values.append(v)
+  pie = go.Pie(labels=labels, values=values,
+               marker_colors=_PIE_COLORS[::-1])
+  return encode_plot(pie)
+
+
+def aspects_sentiment_piechart(sentiment_counts: List[int]):
+  """Pie chart of the number of reviews with neg/neutral/pos total score."""
+  labels = ["Negative", "Neutral", "Positive"]
+  colors = [_PIE_COLORS[0], _PIE_COLORS[2], _PIE_COLORS[-1]]
+  pie = go.Pie(labels=labels, values=sentiment_counts, marker_colors=colors)
+  return encode_plot(pie)
 
 
 class Hotel:
@@ -17,21 +67,43 @@ class Hotel:
     * self.id: An identifier for this particular hotel (id). This is also used
       in the URL of the main hotel page.
     * self.data: DataFrame with all the hotel reviews and the identified aspects.
+      None if the hotel is loaded from a memory-mapped store.
+    * self.store: The `mapped.MappedStore` of the hotel, if available.
+    * self.version: Identifier of the hotel data version (see `data_version`).
     * self.aspects: An `AspectsCollection` container for manipulation of aspect
-      words.
+      words (`MappedAspectsCollection` when loaded from a mapped store).
+    * self.filters: Dict from facet name to the selected values (see
+      `apply_filters`).
+    * self.review_mask: Boolean mask of the reviews that match the filters.
+      None if no filters are applied.
 
     Optionally:
       * self.{} for all {} that are contained in the hotel json txt.
   """
 
-  def __init__(self, metadata: Dict[str, Any], review_data: pd.DataFrame):
+  def __init__(self, metadata: Dict[str, Any],
+               review_data: Optional[pd.DataFrame] = None,
+               store: Optional[mapped.MappedStore] = None,
+               version: Optional[str] = None):
     if "id" not in metadata:
       raise KeyError("Unable to find hotel id in hotel meta data file.")
+    if (review_data is None) == (store is None):
+      raise ValueError("Exactly one of review data and mapped store should "
+                       "be given.")
     for k, v in metadata.items():
         setattr(self, k, v)
 
     self.data = review_data
-    self.aspects = containers.AspectsCollection(review_data)
+    self.store = store
+    self.version = version
+    self.filters = {}
+    self.review_mask = None
+    self._facets = None
+    with tracing.span("build"):
+      if store is not None:
+        self.aspects = mapped.MappedAspectsCollection(store)
+      else:
+        self.aspects = containers.AspectsCollection(review_data)
 
   @classmethod
   def load_from_folder(cls, folder: str) -> "Hotel":
@@ -47,6 +119,17 @@ class Hotel:
     with open(metafile_dir[0], "r") as file:
       metadata = json.load(file)
 
+    # If the key `id` is not found in metadata use the folders name
+    # The `id` key is required to generate URLs
+    if "id" not in metadata:
+      metadata["id"] = os.path.split(folder)[-1]
+
+    # Open the memory-mapped store without copying, if available
+    if mapped.has_store(folder):
+      with tracing.span("load"):
+        store = mapped.MappedStore(folder)
+      return cls(metadata, store=store, version=data_version(folder))
+
     # Load DataFrame from csv/pkl
     pkl_files = utils.find_files_of_type(folder, target_type="pkl")
     csv_files = utils.find_files_of_type(folder, target_type="csv")
@@ -55,52 +138,85 @@ class Hotel:
     elif len(csv_files) + len(pkl_files) == 0:
       raise FileNotFoundError("Unable to data file in {}.".format(folder))
 
-    if len(pkl_files) > 0:
-      review_data = pd.read_pickle(pkl_files[0])
-    else:
-      review_data = pd.read_csv(csv_files[0])
+    with tracing.span("load"):
+      if len(pkl_files) > 0:
+        review_data = pd.read_pickle(pkl_files[0])
+      else:
+        review_data = pd.read_csv(csv_files[0])
 
-    # If the key `id` is not found in metadata use the folders name
-    # The `id` key is required to generate URLs
-    if "id" not in metadata:
-      metadata["id"] = os.path.split(folder)[-1]
+    return cls(metadata, review_data, version=data_version(folder))
 
-    return cls(metadata, review_data)
+  @property
+  def facets(self) -> facets_lib.FacetIndex:
+    """Facet indexes of the hotel reviews."""
+    if self._facets is None:
+      if self.store is not None:
+        self._facets = facets_lib.FacetIndex.from_store(self.store)
+      else:
+        self._facets = facets_lib.FacetIndex.from_data(self.data)
+    return self._facets
+
+  def apply_filters(self, filters: Dict[str, List[str]]):
+    """Restricts aspects and ratings to the reviews that match the filters.
+
+    Args:
+      filters: Dict from facet name to the accepted values of this facet,
+        as returned by `facets.parse_filters`.
+    """
+    self.filters = filters
+    self.review_mask = self.facets.mask(filters)
+    if self.review_mask is None:
+      return
+    with tracing.span("build"):
+      if self.store is not None:
+        aggregates = mapped.Aggregates.from_mask(self.store, self.review_mask)
+        self.aspects = mapped.MappedAspectsCollection(self.store, aggregates)
+      else:
+        self.aspects = containers.AspectsCollection(
+            self.data[self.review_mask])
 
   @property
   def app_url(self):
     """URL that redirects back to the hotel's main page."""
-    return flask.url_for("analysis", hotelname=self.id)
+    return flask.url_for("analysis", hotelname=self.id, **self.filters)
 
   @property
   def n_reviews(self) -> int:
     """Total number of reviews available for this hotel."""
+    if self.store is not None:
+      return self.store.n_reviews
     return len(self.data)
 
+  @property
+  def n_filtered_reviews(self) -> int:
+    """Number of reviews that match the filters."""
+    if self.review_mask is None:
+      return self.n_reviews
+    return int(np.count_nonzero(self.review_mask))
+
+  @property
+  def ratings(self) -> pd.Series:
+    """Star rating of each review that matches the filters."""
+    if self.store is not None:
+      ratings = pd.Series(np.asarray(self.store.column("rating"), dtype=int))
+    else:
+      ratings = self.data.rating
+    if self.review_mask is not None:
+      ratings = ratings[self.review_mask]
+    return ratings
+
   @staticmethod
   def encode_plot(*plot):
-    return json.dumps(list(plot), cls=plotly.utils.PlotlyJSONEncoder)
-
-  _PIE_COLORS = ["rgb(227,26,28)", "rgb(251,154,153)", "rgb(166,206,227)",
-                 "rgb(129,218,85)", "rgb(51,160,44)"]
+    return encode_plot(*plot)
 
   @property
   def rating_counts_piechart(self):
-    labels, values = [], []
-    for l, v in pd.value_counts(self.data.rating).items():
-      labels.append(l)
-      values.append(v)
-    pie = go.Pie(labels=labels, values=values,
-                 marker_colors=self._PIE_COLORS[::-1])
-    return self.encode_plot(pie)
+    return rating_counts_piechart(self.ratings.value_counts().items())
 
   @property
   def aspects_sentiment_piechart(self):
-    labels = ["Negative", "Neutral", "Positive"]
-    colors = [self._PIE_COLORS[0], self._PIE_COLORS[2], self._PIE_COLORS[-1]]
-    pie = go.Pie(labels=labels, values=self.aspects.n_reviews_aspects_sentiment,
-                 marker_colors=colors)
-    return self.encode_plot(pie)
+    return aspects_sentiment_piechart(
+        self.aspects.n_reviews_aspects_sentiment)
 
   @property
   def additionalrating_radarchart(self):
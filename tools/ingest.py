@@ -0,0 +1,356 @@
+"""Validation and background ingest of hotel zips uploaded by users.
+
+Uploads are streamed to disk and validated inside the request. Extraction
+and conversion to the app's canonical format (processed pkl + memory-mapped
+store, see `tools.mapped`) run in a background thread, so page views never
+pay CSV parsing or NLP costs. Supported zip contents are a hotel metadata txt
+and one of:
+  * a processed pkl or csv (with an `aspects` column),
+  * a raw scraped csv, whose aspects are found with `scraping.aspects`.
+
+The state of each ingest is kept in a json file in the `_ingest` folder of
+the local storage directory, so that all gunicorn workers can report it.
+Jobs whose worker process died (eg. after a restart) are reported as failed.
+Converted hotels are published through the `tools.storage` backend.
+
+Hotels scraped from the web app are processed by a separate background
+thread (see `scrape`) and show a progressive preview until they are published.
+"""
+import os
+import re
+import ast
+import json
+import time
+import shutil
+import socket
+import zipfile
+import tempfile
+import threading
+import collections
+import pandas as pd
+from concurrent import futures
+from tools import corpus, mapped, preview, utils
+from werkzeug import datastructures, utils as werkzeug_utils
+from typing import Dict, Optional
+
+FOLDER_NAME = "_ingest"
+_CHUNK_SIZE = 2 ** 20
+_DATA_TYPES = ("pkl", "csv")
+_COUNTER_PATTERN = re.compile(r"^Counter\((.*)\)$", re.DOTALL)
+
+# A single background thread per worker since conversion may run spaCy.
+# Scrapes take long, so they run in their own thread and do not block uploads.
+_EXECUTOR = futures.ThreadPoolExecutor(max_workers=1)
+_SCRAPE_EXECUTOR = futures.ThreadPoolExecutor(max_workers=1)
+_ACTIVE_STATES = ("queued", "processing")
+
+
+class UploadError(ValueError):
+  """Raised when an uploaded file is not a valid hotel zip."""
+
+
+def _ingest_folder(storage_path: str) -> str:
+  folder = os.path.join(storage_path, FOLDER_NAME)
+  os.makedirs(folder, exist_ok=True)
+  return folder
+
+
+def _status_path(storage_path: str, hotelname: str) -> str:
+  return os.path.join(_ingest_folder(storage_path),
+                      "{}.json".format(hotelname))
+
+
+def _status(state: str, error: Optional[str] = None) -> Dict:
+  # The owner process is recorded so that jobs of dead workers are detected
+  return {"state": state, "error": error, "time": time.time(),
+          "pid": os.getpid(), "host": socket.gethostname()}
+
+
+def set_status(storage_path: str, hotelname: str, state: str,
+               error: Optional[str] = None):
+  path = _status_path(storage_path, hotelname)
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+  with os.fdopen(fd, "w") as file:
+    json.dump(_status(state, error), file)
+  os.replace(tmp_path, path)
+
+
+def claim(storage_path: str, hotelname: str) -> bool:
+  """Creates the queued status of a new job of a hotel.
+
+  The status file is created with `O_EXCL`, so that of concurrent jobs of
+  the same hotel only one is accepted. The status of a finished or failed
+  job is moved away first.
+
+  Returns:
+    False if another job of the hotel is queued or processing.
+  """
+  path = _status_path(storage_path, hotelname)
+  while True:
+    try:
+      fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+      status = get_status(storage_path, hotelname)
+      if status is not None and status["state"] in _ACTIVE_STATES:
+        return False
+      stale_path = "{}.{}.{}.stale".format(path, os.getpid(),
+                                           threading.get_ident())
+      try:
+        os.rename(path, stale_path)
+      except FileNotFoundError:
+        # Moved by a concurrent job, try to create the status again
+        continue
+      try:
+        with open(stale_path, "r") as file:
+          stale = json.load(file)
+      except (OSError, ValueError):
+        stale = {}
+      if stale.get("state") in _ACTIVE_STATES:
+        # A concurrent job claimed the hotel after our check, give it back
+        try:
+          os.link(stale_path, path)
+        except FileExistsError:
+          pass
+        os.remove(stale_path)
+        return False
+      os.remove(stale_path)
+      continue
+    with os.fdopen(fd, "w") as file:
+      json.dump(_status("queued"), file)
+    return True
+
+
+def _is_alive(pid: int) -> bool:
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+
+def get_status(storage_path: str, hotelname: str) -> Optional[Dict]:
+  """Returns the ingest status of a hotel or None if it was never uploaded.
+
+  Queued or processing jobs whose worker process no longer exists (eg.
+  after a restart) are marked as failed.
+  """
+  try:
+    with open(_status_path(storage_path, hotelname), "r") as file:
+      status = json.load(file)
+  except (OSError, ValueError):
+    return None
+  if (status["state"] in _ACTIVE_STATES and "pid" in status and
+      status.get("host") == socket.gethostname() and
+      not _is_alive(status["pid"])):
+    set_status(storage_path, hotelname, "failed",
+               "The worker stopped before the job finished.")
+    return get_status(storage_path, hotelname)
+  return status
+
+
+def save_upload(file: datastructures.FileStorage, storage_path: str,
+                max_bytes: int) -> str:
+  """Streams an uploaded zip to the ingest folder in chunks.
+
+  Each upload is saved with a unique name, so that concurrent uploads of
+  files with the same name do not overwrite each other.
+
+  Returns:
+    Path of the saved zip, `<hotelname>.<random>.zip`.
+  """
+  filename = werkzeug_utils.secure_filename(file.filename or "")
+  if not filename.endswith(".zip") or len(filename.split(".")) != 2:
+    raise UploadError("Expected a .zip file without dots in its name "
+                      "but {} was given.".format(file.filename))
+
+  hotelname = filename.split(".")[0]
+  fd, path = tempfile.mkstemp(dir=_ingest_folder(storage_path),
+                              prefix="{}.".format(hotelname), suffix=".zip")
+  size = 0
+  with os.fdopen(fd, "wb") as target:
+    while True:
+      chunk = file.stream.read(_CHUNK_SIZE)
+      if not chunk:
+        break
+      size += len(chunk)
+      if size > max_bytes:
+        target.close()
+        os.remove(path)
+        raise UploadError("Uploaded file exceeds {} bytes.".format(max_bytes))
+      target.write(chunk)
+  return path
+
+
+def validate_zip(zip_path: str, max_bytes: int):
+  """Checks that a zip contains a hotel and is safe to extract."""
+  if not zipfile.is_zipfile(zip_path):
+    raise UploadError("{} is not a valid zip file.".format(
+        os.path.basename(zip_path)))
+
+  with zipfile.ZipFile(zip_path, "r") as zip_ref:
+    members = [m for m in zip_ref.infolist() if not m.is_dir()]
+  names = [m.filename for m in members]
+  for name in names:
+    if os.path.basename(name) != name or name.startswith("."):
+      raise UploadError("Zip should contain only files without folders but "
+                        "found {}.".format(name))
+    if len(name.split(".")) != 2:
+      raise UploadError("Cannot identify type of {}.".format(name))
+  if sum(m.file_size for m in members) > max_bytes:
+    raise UploadError("Uncompressed zip contents exceed {} bytes.".format(
+        max_bytes))
+
+  types = collections.Counter(name.split(".")[-1] for name in names)
+  if types["txt"] != 1:
+    raise UploadError("Zip should contain exactly one metadata txt file.")
+  if sum(types[t] for t in _DATA_TYPES) != 1:
+    raise UploadError("Zip should contain exactly one pkl or csv data file.")
+
+
+def _parse_counter(value) -> Optional[collections.Counter]:
+  """Parses aspect Counters that were saved as str in a csv."""
+  if not isinstance(value, str):
+    return None
+  match = _COUNTER_PATTERN.match(value.strip())
+  literal = match.group(1) if match else value
+  return collections.Counter(ast.literal_eval(literal or "{}"))
+
+
+def convert_folder(folder: str):
+  """Converts the data of a hotel folder to the canonical format.
+
+  The data file is replaced by a processed pkl, the memory-mapped store and
+  the token corpus.
+  """
+  data_files = [path for t in _DATA_TYPES
+                for path in utils.find_files_of_type(folder, target_type=t)]
+  data_path = data_files[0]
+  name = os.path.basename(data_path).split(".")[0]
+  if data_path.endswith(".pkl"):
+    reviews = pd.read_pickle(data_path)
+  else:
+    reviews = pd.read_csv(data_path)
+    if "aspects" in reviews:
+      reviews["aspects"] = reviews["aspects"].map(_parse_counter)
+
+  if "aspects" in reviews:
+    if "lemmatized_text" in reviews:
+      corpus.TokenCorpus.from_texts(reviews["lemmatized_text"]).save(folder)
+    mapped.write_store(folder, reviews)
+    if data_path.endswith(".pkl"):
+      return
+    reviews.to_pickle(os.path.join(folder, "{}.pkl".format(name)))
+  else:
+    # Raw scraped reviews: find aspects once here instead of never
+    from scraping import aspects
+    reviews, token_corpus = aspects.process_reviews(reviews)
+    aspects.save_processed(reviews, folder, name, token_corpus)
+  os.remove(data_path)
+
+
+def ingest(zip_path: str, storage, hotelname: str):
+  """Extracts and converts an uploaded zip and publishes the hotel.
+
+  Args:
+    zip_path: Path of the uploaded zip.
+    storage: `tools.storage` backend that the hotel is published to.
+    hotelname: Id of the uploaded hotel.
+  """
+  set_status(storage.work_dir, hotelname, "processing")
+  staging = storage.staging_dir()
+  try:
+    with zipfile.ZipFile(zip_path, "r") as zip_ref:
+      zip_ref.extractall(staging)
+    convert_folder(staging)
+    storage.publish(hotelname, staging)
+    set_status(storage.work_dir, hotelname, "done")
+  except Exception as exception:
+    print("Failed to ingest {}: {!r}".format(zip_path, exception))
+    set_status(storage.work_dir, hotelname, "failed", repr(exception))
+    shutil.rmtree(staging, ignore_errors=True)
+  finally:
+    os.remove(zip_path)
+
+
+def scrape(scraper, storage, max_reviews: Optional[int] = None,
+           preview_pages: int = 10, batch_size: int = 200,
+           preview_interval: float = 5.0):
+  """Scrapes and processes a hotel, publishing a preview while it runs.
+
+  Args:
+    scraper: `TripAdvisorScraper` of the hotel with its metadata scraped.
+    storage: `tools.storage` backend that the hotel is published to.
+    max_reviews: Maximum number of reviews to scrape.
+    preview_pages: Number of review pages in the first preview.
+    batch_size: Number of reviews processed by spaCy at a time. The preview
+      is refined after the following batches.
+    preview_interval: Minimum seconds between two updates of the preview.
+  """
+  from scraping import pipeline
+  hotelname = scraper.lower_name
+  set_status(storage.work_dir, hotelname, "processing")
+  n_reviews = scraper.n_reviews
+  if max_reviews is not None:
+    n_reviews = min(n_reviews, max_reviews)
+  writer = preview.PreviewWriter(_ingest_folder(storage.work_dir), hotelname,
+                                 dict(scraper.data, n_reviews=n_reviews),
+                                 min_pages=preview_pages,
+                                 min_interval=preview_interval)
+  staging = storage.staging_dir()
+  try:
+    pipeline.run(scraper, staging, max_reviews=max_reviews,
+                 batch_size=batch_size, on_batch=writer,
+                 first_batch_size=preview_pages * scraper.reviews_per_page)
+    storage.publish(hotelname, os.path.join(staging, hotelname))
+    set_status(storage.work_dir, hotelname, "done")
+  except Exception as exception:
+    print("Failed to scrape {}: {!r}".format(hotelname, exception))
+    set_status(storage.work_dir, hotelname, "failed", repr(exception))
+  finally:
+    writer.remove()
+    shutil.rmtree(staging, ignore_errors=True)
+
+
+def submit_scrape(scraper, storage, max_reviews: Optional[int] = None,
+                  preview_pages: int = 10, batch_size: int = 200) -> str:
+  """Schedules a scraping job (see `scrape`).
+
+  Returns:
+    The id of the scraped hotel.
+  """
+  hotelname = scraper.lower_name
+  if storage.exists(hotelname):
+    raise FileExistsError("Hotel {} already exists in storage.".format(
+        hotelname))
+  if not claim(storage.work_dir, hotelname):
+    raise FileExistsError("Hotel {} is already being processed.".format(
+        hotelname))
+  _SCRAPE_EXECUTOR.submit(scrape, scraper, storage, max_reviews,
+                          preview_pages, batch_size)
+  return hotelname
+
+
+def submit(file: datastructures.FileStorage, storage, max_bytes: int) -> str:
+  """Saves and validates an upload and schedules its ingest.
+
+  Returns:
+    The id of the uploaded hotel.
+  """
+  zip_path = save_upload(file, storage.work_dir, max_bytes)
+  try:
+    validate_zip(zip_path, max_bytes)
+  except UploadError:
+    os.remove(zip_path)
+    raise
+
+  hotelname = os.path.basename(zip_path).split(".")[0]
+  if storage.exists(hotelname):
+    os.remove(zip_path)
+    raise UploadError("Hotel {} already exists.".format(hotelname))
+  if not claim(storage.work_dir, hotelname):
+    os.remove(zip_path)
+    raise UploadError("Hotel {} is already being uploaded.".format(hotelname))
+  _EXECUTOR.submit(ingest, zip_path, storage, hotelname)
+  return hotelname
@@ -0,0 +1,373 @@
+"""End-to-end HTTP load test of the app under gunicorn.
+
+Example use:
+  python -m tools.loadtest --sizes 200 2000 10000 --workers 4 \
+      --concurrency 16 --duration 30 --mix browse --report load.json
+
+Synthetic hotels (see `tools.synthetic`) of the given sizes are written in a
+temporary `STORAGE_PATH` and the app is started with `gunicorn main:app`.
+Client threads then request a mix of the main page, hotel analysis pages,
+aspect word review pages and zip downloads for the given duration. The
+report contains the throughput, the p50/p95/p99 latency overall and for each
+kind of page and the resident memory of each gunicorn worker.
+
+Settings of the app can be passed to the server with `--env`, eg.
+`--env FRAGMENT_CACHE=disk`, to compare caching and storage options.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import collections
+import numpy as np
+import pandas as pd
+import requests
+from tools import memprofile, synthetic, utils
+from typing import Dict, List, Optional, Tuple
+
+_REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Fraction of the requests to each kind of page
+MIXES = {
+    "browse": {"index": 0.1, "analysis": 0.4, "reviews": 0.45,
+               "download": 0.05},
+    "analysis": {"analysis": 1.0},
+    "reviews": {"reviews": 1.0},
+    "download": {"download": 1.0},
+}
+
+
+class SyntheticHotel:
+  """A synthetic hotel with the aspect words that its pages link to.
+
+  Contains:
+    * self.id: Id of the hotel, used in URLs.
+    * self.n_reviews: Number of reviews.
+    * self.words: List of "{word}__{pos/neg}" with the most common aspect
+      words of each sign, as in the links of the analysis page.
+  """
+
+  def __init__(self, hotel_id: str, n_reviews: int, words: List[str]):
+    self.id = hotel_id
+    self.n_reviews = n_reviews
+    self.words = words
+
+  @classmethod
+  def create(cls, storage_path: str, n_reviews: int, index: int = 0,
+             n_words: int = 20, mapped_store: bool = True
+             ) -> "SyntheticHotel":
+    hotel_id = "hotel_{}_{}".format(index, n_reviews)
+    folder = synthetic.write_hotel(storage_path, hotel_id, n_reviews,
+                                   mapped_store=mapped_store)
+    data = pd.read_pickle(
+        utils.find_files_of_type(folder, target_type="pkl")[0])
+    scores = collections.Counter()
+    for counter in data["aspects"]:
+      scores.update(counter)
+    ranked = [word for word, _ in scores.most_common()]
+    words = (["{}__pos".format(w) for w in ranked[:n_words]] +
+             ["{}__neg".format(w) for w in ranked[::-1][:n_words]])
+    return cls(hotel_id, n_reviews, words)
+
+  def url(self, kind: str, rng: np.random.Generator) -> str:
+    if kind == "analysis":
+      return "/analysis/{}".format(self.id)
+    if kind == "reviews":
+      word = self.words[rng.integers(len(self.words))]
+      # The `analysis` route has a literal "?word=" in its path
+      return "/analysis/{}%3Fword={}".format(self.id, word)
+    if kind == "download":
+      return "/analysis/{}/download".format(self.id)
+    raise ValueError("Unknown page kind {}.".format(kind))
+
+
+def _free_port() -> int:
+  with socket.socket() as sock:
+    sock.bind(("127.0.0.1", 0))
+    return sock.getsockname()[1]
+
+
+class Server:
+  """Runs the app with gunicorn in a subprocess.
+
+  Args:
+    storage_path: `STORAGE_PATH` of the app.
+    workers: Number of gunicorn worker processes.
+    port: Port to listen to. A free port is used if not given.
+    env: Additional environment variables of the app.
+  """
+
+  def __init__(self, storage_path: str, workers: int = 2,
+               port: Optional[int] = None,
+               env: Optional[Dict[str, str]] = None):
+    self.storage_path = storage_path
+    self.workers = workers
+    self.port = port or _free_port()
+    self.env = dict(os.environ, STORAGE_PATH=storage_path, **(env or {}))
+    self.process = None
+
+  @property
+  def url(self) -> str:
+    return "http://127.0.0.1:{}".format(self.port)
+
+  def start(self, timeout: float = 60.0):
+    command = [sys.executable, "-m", "gunicorn", "main:app",
+               "--workers", str(self.workers),
+               "--bind", "127.0.0.1:{}".format(self.port),
+               "--log-level", "warning"]
+    self.process = subprocess.Popen(command, cwd=_REPO_PATH, env=self.env)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+      if self.process.poll() is not None:
+        raise RuntimeError("gunicorn exited with code {}.".format(
+            self.process.returncode))
+      try:
+        if requests.get(self.url + "/", timeout=1).status_code == 200:
+          break
+      except requests.ConnectionError:
+        pass
+      time.sleep(0.2)
+    else:
+      self.stop()
+      raise TimeoutError("gunicorn did not start in {}s.".format(timeout))
+    # Workers are forked lazily, so wait until all of them are running
+    while len(self.worker_pids()) < self.workers and time.time() < deadline:
+      time.sleep(0.2)
+
+  def worker_pids(self) -> List[int]:
+    """Process ids of the gunicorn workers (children of the master)."""
+    pids = []
+    for name in os.listdir("/proc"):
+      if not name.isdigit():
+        continue
+      try:
+        with open("/proc/{}/stat".format(name), "r") as file:
+          # The process name (second field) may contain spaces
+          fields = file.read().rsplit(")", 1)[1].split()
+      except OSError:
+        continue
+      if int(fields[1]) == self.process.pid:
+        pids.append(int(name))
+    return sorted(pids)
+
+  def stop(self):
+    if self.process is not None and self.process.poll() is None:
+      self.process.terminate()
+      try:
+        self.process.wait(timeout=30)
+      except subprocess.TimeoutExpired:
+        self.process.kill()
+        self.process.wait()
+
+  def __enter__(self) -> "Server":
+    self.start()
+    return self
+
+  def __exit__(self, *args):
+    self.stop()
+
+
+class _RSSSampler(threading.Thread):
+  """Samples the resident memory of the workers while the test runs."""
+
+  def __init__(self, server: Server, interval: float = 0.5):
+    super().__init__(daemon=True)
+    self.server = server
+    self.interval = interval
+    self.peak = {}
+    self.last = {}
+    self._done = threading.Event()
+
+  def sample(self):
+    for pid in self.server.worker_pids():
+      rss = memprofile.rss_bytes(pid)
+      if rss is not None:
+        self.last[pid] = rss
+        self.peak[pid] = max(rss, self.peak.get(pid, 0))
+
+  def run(self):
+    while not self._done.is_set():
+      self.sample()
+      self._done.wait(self.interval)
+
+  def stop(self):
+    self._done.set()
+    self.join()
+    self.sample()
+
+
+def _client(base_url: str, hotels: List[SyntheticHotel],
+            mix: Dict[str, float], deadline: float, seed: int,
+            results: List[Tuple[str, int, float]]):
+  rng = np.random.default_rng(seed)
+  kinds = list(mix)
+  weights = np.array([mix[k] for k in kinds], dtype=float)
+  weights /= weights.sum()
+  session = requests.Session()
+  while time.time() < deadline:
+    kind = kinds[rng.choice(len(kinds), p=weights)]
+    if kind == "index":
+      path = "/"
+    else:
+      path = hotels[rng.integers(len(hotels))].url(kind, rng)
+    start_time = time.perf_counter()
+    try:
+      response = session.get(base_url + path, timeout=60)
+      status = response.status_code
+    except requests.RequestException:
+      status = 0
+    # list.append is atomic, so the clients share a single list
+    results.append((kind, status, time.perf_counter() - start_time))
+
+
+def _latency_stats(latencies: List[float]) -> Dict[str, float]:
+  if not latencies:
+    return {}
+  p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+  return {"p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99),
+          "mean_ms": float(np.mean(latencies) * 1000)}
+
+
+def summarize(results: List[Tuple[str, int, float]], wall_seconds: float,
+              sampler: Optional[_RSSSampler] = None) -> Dict:
+  """Creates the report of a load test from the request results."""
+  report = {"requests": len(results), "wall_seconds": wall_seconds,
+            "throughput_rps": len(results) / wall_seconds,
+            "errors": sum(status != 200 for _, status, _ in results)}
+  report.update(_latency_stats([latency for _, _, latency in results]))
+  kinds = {}
+  for kind in sorted({kind for kind, _, _ in results}):
+    selected = [(status, latency) for k, status, latency in results
+                if k == kind]
+    kinds[kind] = {"requests": len(selected),
+                   "status": dict(collections.Counter(
+                       str(status) for status, _ in selected))}
+    kinds[kind].update(_latency_stats([latency for _, latency in selected]))
+  report["kinds"] = kinds
+  if sampler is not None:
+    report["workers"] = [{"pid": pid, "rss_mb": sampler.last[pid] / 2 ** 20,
+                          "peak_rss_mb": sampler.peak[pid] / 2 ** 20}
+                         for pid in sorted(sampler.last)]
+  return report
+
+
+def run(server: Server, hotels: List[SyntheticHotel], mix: Dict[str, float],
+        concurrency: int = 8, duration: float = 30.0, warmup: float = 0.0,
+        seed: int = 0) -> Dict:
+  """Drives traffic against a running server and returns the report.
+
+  Args:
+    server: The running `Server`.
+    hotels: Hotels in the storage of the server.
+    mix: Fraction of the requests to each kind of page (see `MIXES`).
+    concurrency: Number of client threads.
+    duration: Seconds for which requests are measured.
+    warmup: Seconds of requests before the measurement, eg. to fill caches.
+    seed: Seed of the random page selection.
+  """
+  def drive(seconds: float, results: List, seed_offset: int):
+    deadline = time.time() + seconds
+    clients = [threading.Thread(target=_client, args=(
+                   server.url, hotels, mix, deadline,
+                   seed + seed_offset + i, results))
+               for i in range(concurrency)]
+    for client in clients:
+      client.start()
+    for client in clients:
+      client.join()
+
+  if warmup > 0:
+    drive(warmup, [], concurrency)
+  sampler = _RSSSampler(server)
+  sampler.start()
+  results = []
+  start_time = time.perf_counter()
+  drive(duration, results, 0)
+  wall_seconds = time.perf_counter() - start_time
+  sampler.stop()
+  return summarize(results, wall_seconds, sampler)
+
+
+def print_report(report: Dict):
+  print("\n{} requests in {:.1f}s: {:.1f} requests/s, {} errors".format(
+      report["requests"], report["wall_seconds"], report["throughput_rps"],
+      report["errors"]))
+  header = "{:<10} {:>9} {:>9} {:>9} {:>9}  {}".format(
+      "page", "requests", "p50 ms", "p95 ms", "p99 ms", "status")
+  print(header)
+  print("-" * len(header))
+  rows = list(report["kinds"].items()) + [("all", report)]
+  for kind, stats in rows:
+    status = stats.get("status", "")
+    print("{:<10} {:>9} {:>9.1f} {:>9.1f} {:>9.1f}  {}".format(
+        kind, stats["requests"], stats.get("p50_ms", 0),
+        stats.get("p95_ms", 0), stats.get("p99_ms", 0), status))
+  for worker in report.get("workers", []):
+    print("worker {}: RSS {:.1f} MB (peak {:.1f} MB)".format(
+        worker["pid"], worker["rss_mb"], worker["peak_rss_mb"]))
+
+
+def _parse_env(text: str) -> Tuple[str, str]:
+  key, sep, value = text.partition("=")
+  if not sep:
+    raise argparse.ArgumentTypeError("Expected KEY=VALUE but got {}."
+                                     "".format(text))
+  return key, value
+
+
+def main(argv: Optional[List[str]] = None):
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--sizes", type=int, nargs="+",
+                      default=[200, 2000, 10000],
+                      help="Number of reviews of each synthetic hotel.")
+  parser.add_argument("--no-mapped", action="store_true",
+                      help="Write hotels without the memory-mapped store.")
+  parser.add_argument("--workers", type=int, default=2,
+                      help="Number of gunicorn workers.")
+  parser.add_argument("--concurrency", type=int, default=8,
+                      help="Number of concurrent client threads.")
+  parser.add_argument("--duration", type=float, default=30,
+                      help="Seconds of measured traffic.")
+  parser.add_argument("--warmup", type=float, default=5,
+                      help="Seconds of traffic before measuring.")
+  parser.add_argument("--mix", default="browse", choices=sorted(MIXES),
+                      help="Traffic mix.")
+  parser.add_argument("--env", type=_parse_env, action="append", default=[],
+                      metavar="KEY=VALUE",
+                      help="Environment variable of the app server.")
+  parser.add_argument("--storage", default=None,
+                      help="Directory for the synthetic storage (default: "
+                           "a temporary directory that is removed).")
+  parser.add_argument("--port", type=int, default=None,
+                      help="Port of the app server.")
+  parser.add_argument("--report", default=None,
+                      help="Path to save the json report.")
+  args = parser.parse_args(argv)
+
+  with tempfile.TemporaryDirectory(dir=args.storage) as storage_path:
+    hotels = [SyntheticHotel.create(storage_path, n, index=i,
+                                    mapped_store=not args.no_mapped)
+              for i, n in enumerate(args.sizes)]
+    print("Created {} synthetic hotels in {}.".format(len(hotels),
+                                                      storage_path))
+    with Server(storage_path, args.workers, args.port,
+                dict(args.env)) as server:
+      report = run(server, hotels, MIXES[args.mix], args.concurrency,
+                   args.duration, args.warmup)
+  report["config"] = {"sizes": args.sizes, "workers": args.workers,
+                      "concurrency": args.concurrency, "mix": args.mix,
+                      "mapped": not args.no_mapped, "env": dict(args.env)}
+  print_report(report)
+  if args.report is not None:
+    with open(args.report, "w") as file:
+      json.dump(report, file, indent=2)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
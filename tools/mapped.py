@@ -0,0 +1,531 @@
+"""Read-only memory-mapped representation of a hotel's reviews and aspects.
+
+Review text, review metadata and aspects are stored as flat numpy arrays
+(offsets + contiguous buffers) in the `mapped` subfolder of the hotel folder
+and are opened with `np.load(mmap_mode="r")`. The arrays are never copied in
+the process memory, so their pages are shared through the OS page cache by
+all gunicorn workers. In contrast to unpickled DataFrames and
+`AspectsCollection`s, reading them does not touch Python reference counts,
+so copy-on-write pages of forked workers stay shared.
+
+`MappedAspectsCollection`, `MappedAspectWord` and `MappedReview` provide the
+same interface as the containers in `tools.containers` that the templates
+use, creating lightweight views only for the words and reviews shown.
+
+Convert existing hotels with:
+  python -m tools.mapped /path/to/app_storage
+"""
+import os
+import sys
+import json
+import shutil
+import hashlib
+import collections
+from collections import abc
+import numpy as np
+import pandas as pd
+from tools import containers
+from tools.stopwords import STOP_WORDS
+from typing import Dict, Iterator, List, Optional, Sequence
+
+FOLDER_NAME = "mapped"
+_META_FILE = "meta.json"
+_STRING_COLUMNS = ["text", "title", "absoluteUrl", "publishedDate",
+                   "username", "user_hometownName", "tripType", "language"]
+_NUMERIC_COLUMNS = ["rating", "helpfulVotes"]
+
+
+def encode_strings(values: Sequence) -> List[np.ndarray]:
+  """Encodes strings to a utf-8 buffer and an offsets array."""
+  encoded = [b"" if not isinstance(v, str) else v.encode("utf-8")
+             for v in values]
+  offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+  np.cumsum([len(x) for x in encoded], out=offsets[1:])
+  data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+  return [data, offsets]
+
+
+class StringColumn:
+  """Column of strings stored as a utf-8 buffer and an offsets array."""
+
+  def __init__(self, data: np.ndarray, offsets: np.ndarray):
+    self.data = data
+    self.offsets = offsets
+
+  def __len__(self) -> int:
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i: int) -> str:
+    start, end = self.offsets[i], self.offsets[i + 1]
+    return self.data[start:end].tobytes().decode("utf-8")
+
+  def __iter__(self) -> Iterator[str]:
+    for i in range(len(self)):
+      yield self[i]
+
+
+def write_store(folder: str, data: pd.DataFrame,
+                text_col_name: str = "text",
+                aspect_col_name: str = "aspects") -> str:
+  """Writes the mapped representation of a hotel in `folder/mapped`.
+
+  The arrays are first written in a temporary folder that is then renamed,
+  so that readers never see a partially written store.
+
+  Args:
+    folder: The hotel folder.
+    data: DataFrame with the reviews and their aspects, as created by
+      `scraping.aspects.find_aspects`.
+
+  Returns:
+    The version (content hash) of the written store.
+  """
+  arrays = {}
+  n_reviews = len(data)
+  texts = list(data[text_col_name])
+  arrays["text.data"], arrays["text.offsets"] = encode_strings(texts)
+  for column in _STRING_COLUMNS:
+    if column != text_col_name and column in data:
+      arrays[column + ".data"], arrays[column + ".offsets"] = encode_strings(
+          list(data[column]))
+  for column in _NUMERIC_COLUMNS:
+    if column in data:
+      arrays[column] = pd.to_numeric(data[column], errors="coerce").fillna(
+          0).to_numpy(dtype=np.float32)
+
+  # Flatten aspects: word ids are assigned in order of first appearance,
+  # which is the order `AspectsCollection` uses to break ties
+  word_ids = collections.OrderedDict()
+  has_aspects = np.zeros(n_reviews, dtype=bool)
+  aspect_offsets = np.zeros(n_reviews + 1, dtype=np.int64)
+  flat_words, flat_scores = [], []
+  for i, counter in enumerate(data[aspect_col_name]):
+    if isinstance(counter, dict):
+      has_aspects[i] = True
+      for word, score in counter.items():
+        if word in STOP_WORDS:
+          continue
+        flat_words.append(word_ids.setdefault(word, len(word_ids)))
+        flat_scores.append(score)
+    aspect_offsets[i + 1] = len(flat_words)
+  flat_words = np.array(flat_words, dtype=np.int32)
+  flat_scores = np.array(flat_scores, dtype=np.float32)
+  flat_reviews = np.repeat(np.arange(n_reviews, dtype=np.int32),
+                           np.diff(aspect_offsets))
+  n_words = len(word_ids)
+
+  arrays["has_aspects"] = has_aspects
+  arrays["aspect_offsets"] = aspect_offsets
+  arrays["aspect_words"] = flat_words
+  arrays["aspect_scores"] = flat_scores
+  arrays["words.data"], arrays["words.offsets"] = encode_strings(
+      list(word_ids.keys()))
+  # Word ids sorted alphabetically for lookups by text
+  arrays["words_sorted"] = np.array(
+      sorted(range(n_words), key=list(word_ids.keys()).__getitem__),
+      dtype=np.int32)
+
+  # Precomputed aggregates per word and per review
+  arrays["word_scores"] = np.bincount(flat_words, weights=flat_scores,
+                                      minlength=n_words)
+  arrays["word_positive"] = np.bincount(flat_words[flat_scores > 0],
+                                        minlength=n_words).astype(np.int32)
+  arrays["word_negative"] = np.bincount(flat_words[flat_scores < 0],
+                                        minlength=n_words).astype(np.int32)
+  arrays["review_scores"] = np.bincount(flat_reviews, weights=flat_scores,
+                                        minlength=n_reviews)
+
+  # Inverted index from words to reviews (in review order)
+  order = np.argsort(flat_words, kind="stable")
+  arrays["word_review_ids"] = flat_reviews[order]
+  arrays["word_review_scores"] = flat_scores[order]
+  word_review_offsets = np.zeros(n_words + 1, dtype=np.int64)
+  np.cumsum(np.bincount(flat_words, minlength=n_words),
+            out=word_review_offsets[1:])
+  arrays["word_review_offsets"] = word_review_offsets
+
+  # Sorted-id indexes for filtering by review metadata
+  from tools import facets
+  arrays.update(facets.index_arrays(data))
+
+  version = hashlib.sha256()
+  for name in sorted(arrays):
+    version.update(name.encode("utf-8"))
+    version.update(np.ascontiguousarray(arrays[name]).tobytes())
+  meta = {"version": version.hexdigest()[:16], "n_reviews": n_reviews,
+          "n_words": n_words, "arrays": sorted(arrays)}
+
+  target = os.path.join(folder, FOLDER_NAME)
+  tmp_target = "{}_tmp{}".format(target, os.getpid())
+  shutil.rmtree(tmp_target, ignore_errors=True)
+  os.mkdir(tmp_target)
+  for name, array in arrays.items():
+    np.save(os.path.join(tmp_target, name + ".npy"), array)
+  with open(os.path.join(tmp_target, _META_FILE), "w") as file:
+    json.dump(meta, file)
+  if os.path.isdir(target):
+    shutil.rmtree(target)
+  os.rename(tmp_target, target)
+  return meta["version"]
+
+
+def has_store(folder: str) -> bool:
+  return os.path.exists(os.path.join(folder, FOLDER_NAME, _META_FILE))
+
+
+def read_meta(folder: str) -> Dict:
+  with open(os.path.join(folder, FOLDER_NAME, _META_FILE), "r") as file:
+    return json.load(file)
+
+
+class MappedStore:
+  """Read-only view of the arrays written by `write_store`."""
+
+  def __init__(self, folder: str):
+    self.path = os.path.join(folder, FOLDER_NAME)
+    self.meta = read_meta(folder)
+    self.arrays = {name: self._load(name) for name in self.meta["arrays"]}
+    self._columns = {}
+
+  def _load(self, name: str) -> np.ndarray:
+    path = os.path.join(self.path, name + ".npy")
+    try:
+      return np.load(path, mmap_mode="r")
+    except ValueError:
+      # Empty arrays cannot be memory-mapped
+      return np.load(path)
+
+  @property
+  def version(self) -> str:
+    return self.meta["version"]
+
+  @property
+  def n_reviews(self) -> int:
+    return self.meta["n_reviews"]
+
+  @property
+  def n_words(self) -> int:
+    return self.meta["n_words"]
+
+  def has_column(self, name: str) -> bool:
+    return name in self.arrays or name + ".data" in self.arrays
+
+  def column(self, name: str):
+    """Returns a `StringColumn` or a numeric array for the given column."""
+    if name not in self._columns:
+      if name + ".data" in self.arrays:
+        self._columns[name] = StringColumn(self.arrays[name + ".data"],
+                                           self.arrays[name + ".offsets"])
+      else:
+        self._columns[name] = self.arrays[name]
+    return self._columns[name]
+
+  @property
+  def aggregates(self) -> "Aggregates":
+    """Word aggregates over all reviews, as precomputed by `write_store`."""
+    if "aggregates" not in self._columns:
+      self._columns["aggregates"] = Aggregates(
+          self.arrays["word_scores"], self.arrays["word_positive"],
+          self.arrays["word_negative"],
+          np.diff(self.arrays["word_review_offsets"]))
+    return self._columns["aggregates"]
+
+  def value(self, name: str, i: int):
+    if not self.has_column(name):
+      return None
+    value = self.column(name)[i]
+    if isinstance(value, np.floating) and value.is_integer():
+      return int(value)
+    return value
+
+
+class Aggregates:
+  """Word aggregates over all reviews of a store or over a subset of them.
+
+  Contains:
+    * self.word_scores: Total score of each word.
+    * self.word_positive: Number of positive appearances of each word.
+    * self.word_negative: Number of negative appearances of each word.
+    * self.word_counts: Number of appearances of each word.
+    * self.review_mask: Boolean mask of the reviews that are aggregated.
+      None if all reviews are used.
+    * self.first_appearance: Position of the first appearance of each word
+      in the aggregated reviews, used to break ties in rankings as
+      `AspectsCollection` does. None if it is the word id order.
+  """
+
+  def __init__(self, word_scores: np.ndarray, word_positive: np.ndarray,
+               word_negative: np.ndarray, word_counts: np.ndarray,
+               review_mask: Optional[np.ndarray] = None,
+               first_appearance: Optional[np.ndarray] = None):
+    self.word_scores = np.asarray(word_scores)
+    self.word_positive = word_positive
+    self.word_negative = word_negative
+    self.word_counts = word_counts
+    self.review_mask = review_mask
+    self.first_appearance = first_appearance
+
+  @classmethod
+  def from_mask(cls, store: MappedStore, review_mask: np.ndarray
+                ) -> "Aggregates":
+    """Aggregates the flat aspect arrays over the reviews in the mask."""
+    offsets = store.arrays["aspect_offsets"]
+    flat_mask = np.repeat(review_mask, np.diff(offsets))
+    words = store.arrays["aspect_words"][flat_mask]
+    scores = store.arrays["aspect_scores"][flat_mask]
+    n_words = store.n_words
+    first_appearance = np.full(n_words, len(words), dtype=np.int64)
+    unique_words, first_index = np.unique(words, return_index=True)
+    first_appearance[unique_words] = first_index
+    return cls(np.bincount(words, weights=scores, minlength=n_words),
+               np.bincount(words[scores > 0], minlength=n_words),
+               np.bincount(words[scores < 0], minlength=n_words),
+               np.bincount(words, minlength=n_words), review_mask,
+               first_appearance)
+
+
+class RowView:
+  """Attribute access to the columns of a single review (eg. `data.title`)."""
+
+  __slots__ = ("_store", "_index")
+
+  def __init__(self, store: MappedStore, index: int):
+    self._store = store
+    self._index = index
+
+  def __getattr__(self, name: str):
+    if name.startswith("_"):
+      raise AttributeError(name)
+    return self._store.value(name, self._index)
+
+  def __getitem__(self, name: str):
+    return self._store.value(name, self._index)
+
+  def get(self, name: str, default=None):
+    value = self._store.value(name, self._index)
+    return default if value is None else value
+
+
+class MappedReview:
+  """`containers.Review` interface for a review in a `MappedStore`."""
+
+  __slots__ = ("_store", "index")
+
+  def __init__(self, store: MappedStore, index: int):
+    self._store = store
+    self.index = index
+
+  def __str__(self):
+    return self._store.column("text")[self.index]
+
+  def __hash__(self):
+    return hash((self._store.path, self.index))
+
+  def __eq__(self, other):
+    return (isinstance(other, MappedReview) and other.index == self.index and
+            other._store is self._store)
+
+  @property
+  def data(self) -> RowView:
+    return RowView(self._store, self.index)
+
+  @property
+  def aspects(self) -> Dict[str, float]:
+    offsets = self._store.arrays["aspect_offsets"]
+    start, end = offsets[self.index], offsets[self.index + 1]
+    words = self._store.column("words")
+    return collections.OrderedDict(
+        (words[w], float(s)) for w, s in zip(
+            self._store.arrays["aspect_words"][start:end],
+            self._store.arrays["aspect_scores"][start:end]))
+
+  @property
+  def score(self) -> float:
+    return float(self._store.arrays["review_scores"][self.index])
+
+  def colored_text(self, word: str) -> str:
+    return containers.color_aspects(str(self), self.aspects.items(), word)
+
+
+class MappedAspectWord:
+  """`containers.AspectWord` interface for a word in a `MappedStore`."""
+
+  __slots__ = ("_store", "_aggregates", "id")
+
+  def __init__(self, store: MappedStore, word_id: int,
+               aggregates: Optional[Aggregates] = None):
+    self._store = store
+    self._aggregates = aggregates or store.aggregates
+    self.id = word_id
+
+  def __str__(self):
+    return self._store.column("words")[self.id]
+
+  def __eq__(self, other):
+    if isinstance(other, str):
+      return str(self) == other
+    return isinstance(other, MappedAspectWord) and other.id == self.id
+
+  def __hash__(self):
+    return hash(str(self))
+
+  @property
+  def text(self) -> str:
+    return str(self)
+
+  @property
+  def positive_appearances(self) -> int:
+    return int(self._aggregates.word_positive[self.id])
+
+  @property
+  def negative_appearances(self) -> int:
+    return int(self._aggregates.word_negative[self.id])
+
+  @property
+  def score(self) -> float:
+    return float(self._aggregates.word_scores[self.id])
+
+  def get_reviews(self, mode: str = "pos") -> Iterator[MappedReview]:
+    sign = 1 if mode == "pos" else - 1
+    offsets = self._store.arrays["word_review_offsets"]
+    start, end = offsets[self.id], offsets[self.id + 1]
+    review_ids = self._store.arrays["word_review_ids"][start:end]
+    scores = self._store.arrays["word_review_scores"][start:end]
+    selected = sign * scores > 0
+    if self._aggregates.review_mask is not None:
+      selected &= self._aggregates.review_mask[review_ids]
+    for i in review_ids[selected]:
+      yield MappedReview(self._store, int(i))
+
+
+class _WordList(abc.Sequence):
+  """Lazy sequence of `MappedAspectWord` in a given order."""
+
+  def __init__(self, store: MappedStore, order: np.ndarray,
+               aggregates: Aggregates):
+    self._store = store
+    self._order = order
+    self._aggregates = aggregates
+
+  def __len__(self) -> int:
+    return len(self._order)
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [MappedAspectWord(self._store, int(w), self._aggregates)
+              for w in self._order[i]]
+    return MappedAspectWord(self._store, int(self._order[i]), self._aggregates)
+
+
+class _WordLookup(abc.Mapping):
+  """Maps word text to `MappedAspectWord` by binary search."""
+
+  def __init__(self, store: MappedStore, aggregates: Aggregates):
+    self._store = store
+    self._aggregates = aggregates
+
+  def _find(self, word: str) -> Optional[int]:
+    words = self._store.column("words")
+    sorted_ids = self._store.arrays["words_sorted"]
+    low, high = 0, len(sorted_ids)
+    while low < high:
+      mid = (low + high) // 2
+      if words[sorted_ids[mid]] < word:
+        low = mid + 1
+      else:
+        high = mid
+    if low < len(sorted_ids) and words[sorted_ids[low]] == word:
+      return int(sorted_ids[low])
+    return None
+
+  def __getitem__(self, word: str) -> MappedAspectWord:
+    word_id = self._find(word)
+    if word_id is None:
+      raise KeyError(word)
+    return MappedAspectWord(self._store, word_id, self._aggregates)
+
+  def __contains__(self, word) -> bool:
+    return isinstance(word, str) and self._find(word) is not None
+
+  def __iter__(self) -> Iterator[str]:
+    return iter(self._store.column("words"))
+
+  def __len__(self) -> int:
+    return self._store.n_words
+
+
+class MappedAspectsCollection:
+  """`containers.AspectsCollection` interface for a `MappedStore`.
+
+  Args:
+    store: The mapped store of the hotel.
+    aggregates: Optional `Aggregates` over a subset of the reviews (see
+      `tools.facets`). If None all reviews are used.
+  """
+
+  def __init__(self, store: MappedStore,
+               aggregates: Optional[Aggregates] = None):
+    self.store = store
+    self.aggregates = aggregates or store.aggregates
+    self.known_words = _WordLookup(store, self.aggregates)
+
+  def _has_aspects(self) -> np.ndarray:
+    has_aspects = np.asarray(self.store.arrays["has_aspects"])
+    if self.aggregates.review_mask is not None:
+      has_aspects = has_aspects & self.aggregates.review_mask
+    return has_aspects
+
+  @property
+  def reviews(self) -> List[MappedReview]:
+    return [MappedReview(self.store, int(i)) for i in
+            np.flatnonzero(self._has_aspects())]
+
+  @property
+  def n_reviews(self) -> int:
+    return int(np.count_nonzero(self._has_aspects()))
+
+  def most_common(self, invert_sign: bool = False) -> Sequence[MappedAspectWord]:
+    scores = self.aggregates.word_scores
+    if not invert_sign:
+      scores = -scores
+    if self.aggregates.first_appearance is None:
+      order = np.argsort(scores, kind="stable")
+    else:
+      order = np.lexsort((self.aggregates.first_appearance, scores))
+    # Words that do not appear in the aggregated reviews are not ranked
+    order = order[self.aggregates.word_counts[order] > 0]
+    return _WordList(self.store, order, self.aggregates)
+
+  @property
+  def most_common_positive(self) -> Sequence[MappedAspectWord]:
+    return self.most_common(invert_sign=False)
+
+  @property
+  def most_common_negative(self) -> Sequence[MappedAspectWord]:
+    return self.most_common(invert_sign=True)
+
+  @property
+  def n_reviews_aspects_sentiment(self) -> List[int]:
+    """Calculates the number of reviews with neg/neutral/pos total score."""
+    scores = self.store.arrays["review_scores"][self._has_aspects()]
+    return [int(np.count_nonzero(scores < 0)),
+            int(np.count_nonzero(scores == 0)),
+            int(np.count_nonzero(scores > 0))]
+
+
+def convert_folder(folder: str) -> str:
+  """Writes the mapped store of a hotel folder from its pkl file."""
+  from tools import utils
+  pkl_files = utils.find_files_of_type(folder, target_type="pkl")
+  if len(pkl_files) != 1:
+    raise FileNotFoundError("Expected a single pkl file in {} but found {}."
+                            "".format(folder, len(pkl_files)))
+  return write_store(folder, pd.read_pickle(pkl_files[0]))
+
+
+if __name__ == "__main__":
+  storage_path = sys.argv[1]
+  for name in sorted(os.listdir(storage_path)):
+    hotel_folder = os.path.join(storage_path, name)
+    if os.path.isdir(hotel_folder):
+      print("{}: version {}".format(name, convert_folder(hotel_folder)))
@@ -0,0 +1,241 @@
+"""Memory footprint of loaded hotels with per review budgets.
+
+Example use:
+  python -m tools.memprofile --sizes 1000 5000 20000 --report memory.json
+
+For each number of reviews a synthetic hotel (see `tools.synthetic`) is
+written in a temporary directory and loaded in a fresh forked process with
+each of the following layouts:
+  * hotel_pkl: `Hotel.load_from_folder` of a hotel without mapped store
+    (unpickled DataFrame and `AspectsCollection`).
+  * hotel_mapped: `Hotel.load_from_folder` of the memory-mapped store.
+  * collection_rows: `AspectsCollection` of an already loaded DataFrame,
+    with each `Review` referring to its row through a `RowView`.
+  * collection_series: The same with a copy of each row (`data.iloc[i]`).
+
+The bytes that remain allocated after loading (tracemalloc) and the growth
+of the resident set size are reported per review and per aspect (review and
+aspect word pair). The command exits with a non-zero status if the retained
+memory per review of a layout exceeds its budget, so it can run as a check
+in CI.
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import tracemalloc
+import collections
+import multiprocessing
+import pandas as pd
+from concurrent import futures
+from tools import containers, hotel, synthetic, utils
+from typing import Any, Callable, Dict, List, Optional
+
+# Maximum retained KB per review of each layout
+# (None for layouts that are only measured for comparison)
+BUDGETS = {"hotel_pkl": 5.0, "hotel_mapped": 0.5, "collection_rows": 1.5,
+           "collection_series": None}
+LAYOUTS = list(BUDGETS)
+
+
+def rss_bytes(pid: str = "self") -> Optional[int]:
+  """Resident set size of a process from `/proc` (None if unavailable)."""
+  try:
+    with open("/proc/{}/status".format(pid), "r") as file:
+      for line in file:
+        if line.startswith("VmRSS:"):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  return None
+
+
+def measure(load: Callable[[], Any]) -> Dict[str, int]:
+  """Measures the memory allocated by `load`.
+
+  Returns:
+    Dictionary with the bytes still allocated after `load` returns, the
+    peak allocation during `load` and the growth of the resident set size.
+  """
+  rss_before = rss_bytes()
+  tracemalloc.start()
+  try:
+    result = load()
+    retained, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  rss_after = rss_bytes()
+  del result
+  rss = None if rss_before is None else rss_after - rss_before
+  return {"retained_bytes": retained, "peak_bytes": peak, "rss_bytes": rss}
+
+
+def _read_pkl(folder: str) -> pd.DataFrame:
+  return pd.read_pickle(utils.find_files_of_type(folder, target_type="pkl")[0])
+
+
+def _measure_layout(layout: str, folder: str) -> Dict[str, int]:
+  """Measures a layout, called in a fresh process for a clean RSS."""
+  if layout.startswith("hotel"):
+    return measure(lambda: hotel.Hotel.load_from_folder(folder))
+  data = _read_pkl(folder)
+  row_views = layout == "collection_rows"
+  return measure(lambda: containers.AspectsCollection(data,
+                                                      row_views=row_views))
+
+
+def _run_isolated(function: Callable, *args):
+  context = multiprocessing.get_context("fork")
+  with futures.ProcessPoolExecutor(max_workers=1,
+                                   mp_context=context) as executor:
+    return executor.submit(function, *args).result()
+
+
+class _LegacyAspectWord:
+  """`containers.AspectWord` before `__slots__`, for comparison."""
+
+  def __init__(self, word: str):
+    self._text = word
+    self.reviews = collections.Counter({})
+
+
+class _LegacyReview:
+  """`containers.Review` before `__slots__`, for comparison."""
+
+  def __init__(self, text: str, data=None):
+    self._text = text
+    self.aspects = collections.Counter({})
+    self.data = data
+
+
+def instance_bytes(n: int = 10000) -> Dict[str, float]:
+  """Average bytes of an (empty) `Review` and `AspectWord` instance.
+
+  Compares the slotted containers to their previous `__dict__` based
+  layout with a `Counter` in every instance.
+  """
+  classes = {"Review": (containers.Review, _LegacyReview),
+             "AspectWord": (containers.AspectWord, _LegacyAspectWord)}
+  sizes = {}
+  for name, (cls, legacy_cls) in classes.items():
+    for label, factory in [("slots", cls), ("legacy", legacy_cls)]:
+      texts = ["{} {}".format(name, i) for i in range(n)]
+      stats = measure(lambda: [factory(text) for text in texts])
+      # Subtract the list that holds the instances
+      list_bytes = sys.getsizeof([None] * n)
+      sizes["{}_{}".format(name, label)] = (
+          (stats["retained_bytes"] - list_bytes) / n)
+  return sizes
+
+
+def profile(sizes: List[int], layouts: List[str] = LAYOUTS,
+            directory: Optional[str] = None) -> List[Dict]:
+  """Measures every layout for synthetic hotels of the given sizes.
+
+  Args:
+    sizes: Number of reviews of each synthetic hotel.
+    layouts: Names of the layouts to measure (see `LAYOUTS`).
+    directory: Directory for the synthetic hotels. A temporary directory
+      is used if not given.
+
+  Returns:
+    List with the measurements of each size and layout.
+  """
+  with tempfile.TemporaryDirectory(dir=directory) as root:
+    results = []
+    for n_reviews in sizes:
+      folders = {
+          True: synthetic.write_hotel(os.path.join(root, "mapped"),
+                                      "hotel_{}".format(n_reviews), n_reviews,
+                                      mapped_store=True),
+          False: synthetic.write_hotel(os.path.join(root, "pkl"),
+                                       "hotel_{}".format(n_reviews), n_reviews,
+                                       mapped_store=False)}
+      n_aspects = sum(len(counter) for counter in
+                      _read_pkl(folders[False])["aspects"])
+      for layout in layouts:
+        folder = folders[layout == "hotel_mapped"]
+        stats = _run_isolated(_measure_layout, layout, folder)
+        stats.update({"layout": layout, "n_reviews": n_reviews,
+                      "n_aspects": n_aspects})
+        stats["kb_per_review"] = stats["retained_bytes"] / n_reviews / 1024
+        stats["bytes_per_aspect"] = stats["retained_bytes"] / n_aspects
+        results.append(stats)
+  return results
+
+
+def check_budgets(results: List[Dict], budgets: Dict[str, Optional[float]]
+                  ) -> List[str]:
+  """Returns a message for every measurement that exceeds its budget."""
+  failures = []
+  for stats in results:
+    budget = budgets.get(stats["layout"])
+    if budget is not None and stats["kb_per_review"] > budget:
+      failures.append("{} with {} reviews: {:.2f} KB per review exceeds the "
+                      "budget of {:.2f} KB.".format(
+                          stats["layout"], stats["n_reviews"],
+                          stats["kb_per_review"], budget))
+  return failures
+
+
+def _parse_budget(text: str):
+  layout, _, value = text.partition("=")
+  if layout not in BUDGETS or not value:
+    raise argparse.ArgumentTypeError(
+        "Budgets should have the form LAYOUT=KB with LAYOUT one of {}."
+        "".format(", ".join(LAYOUTS)))
+  return layout, float(value)
+
+
+def main(argv: Optional[List[str]] = None):
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--sizes", type=int, nargs="+",
+                      default=[1000, 5000, 20000],
+                      help="Number of reviews of the synthetic hotels.")
+  parser.add_argument("--layouts", nargs="+", default=LAYOUTS,
+                      choices=LAYOUTS, help="Layouts to measure.")
+  parser.add_argument("--budget", type=_parse_budget, action="append",
+                      default=[], metavar="LAYOUT=KB",
+                      help="Overrides the KB per review budget of a layout.")
+  parser.add_argument("--tmp-dir", default=None,
+                      help="Directory for the synthetic hotels.")
+  parser.add_argument("--report", default=None,
+                      help="Path to save the json report.")
+  args = parser.parse_args(argv)
+  budgets = dict(BUDGETS)
+  budgets.update(args.budget)
+
+  results = profile(args.sizes, args.layouts, args.tmp_dir)
+  header = "{:<18} {:>8} {:>8} {:>12} {:>10} {:>9} {:>11} {:>10}".format(
+      "layout", "reviews", "aspects", "retained MB", "peak MB", "RSS MB",
+      "KB/review", "B/aspect")
+  print(header)
+  print("-" * len(header))
+  for stats in results:
+    rss = stats["rss_bytes"]
+    print("{:<18} {:>8} {:>8} {:>12.1f} {:>10.1f} {:>9} {:>11.2f} "
+          "{:>10.1f}".format(
+              stats["layout"], stats["n_reviews"], stats["n_aspects"],
+              stats["retained_bytes"] / 2 ** 20, stats["peak_bytes"] / 2 ** 20,
+              "-" if rss is None else "{:.1f}".format(rss / 2 ** 20),
+              stats["kb_per_review"], stats["bytes_per_aspect"]))
+
+  sizes = instance_bytes()
+  print("\nBytes per instance (slots / legacy): Review {:.0f} / {:.0f}, "
+        "AspectWord {:.0f} / {:.0f}".format(
+            sizes["Review_slots"], sizes["Review_legacy"],
+            sizes["AspectWord_slots"], sizes["AspectWord_legacy"]))
+
+  failures = check_budgets(results, budgets)
+  for failure in failures:
+    print("BUDGET EXCEEDED {}".format(failure))
+  if args.report is not None:
+    with open(args.report, "w") as file:
+      json.dump({"results": results, "instances": sizes,
+                 "budgets": budgets, "failures": failures}, file, indent=2)
+  return 0 if not failures else 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,394 @@
+"""Lightweight counters and histograms exposed in Prometheus text format.
+
+Metrics are kept in memory by each process and updating them only takes a
+lock and a dictionary lookup, so instrumentation can stay on in production.
+When the app runs under gunicorn each worker periodically flushes a snapshot
+of its metrics to a shared directory (`METRICS_DIR`) and the `/metrics`
+endpoint sums the snapshots of all workers, so that counts are aggregated
+correctly regardless of which worker serves the scrape. When a worker exits
+its snapshot is merged into the retired totals of the directory, so that
+counts stay monotonic without summing stale snapshots of dead processes (see
+the gunicorn hooks in `gunicorn.conf.py`).
+
+Docs parsed per second can be read directly from the
+`spacy_docs_per_second` histogram or as
+`rate(spacy_docs_parsed_total) / rate(spacy_parse_seconds_sum)`.
+"""
+import os
+import json
+import time
+import bisect
+import tempfile
+import threading
+import contextlib
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+try:
+  import fcntl
+except ImportError:
+  # Not available on Windows, where the app does not run under gunicorn
+  fcntl = None
+
+_RETIRED_FILE = "metrics_retired.json"
+_LOCK_FILE = ".metrics.lock"
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class _Metric:
+  """Base class for metrics with an optional set of label names."""
+
+  _TYPE = None
+
+  def __init__(self, name: str, documentation: str,
+               labelnames: Sequence[str] = ()):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = tuple(labelnames)
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+    if set(labels) != set(self.labelnames):
+      raise ValueError("Metric {} expects labels {} but {} were given."
+                       "".format(self.name, self.labelnames, tuple(labels)))
+    return tuple(str(labels[k]) for k in self.labelnames)
+
+  def snapshot(self) -> Dict:
+    with self._lock:
+      samples = [[list(k), self._copy_value(v)]
+                 for k, v in self._values.items()]
+    return {"type": self._TYPE, "help": self.documentation,
+            "labelnames": list(self.labelnames), "samples": samples}
+
+  @staticmethod
+  def _copy_value(value):
+    return value
+
+
+class Counter(_Metric):
+  """Monotonically increasing count (pages fetched, reviews processed, ...)."""
+
+  _TYPE = "counter"
+
+  def inc(self, amount: float = 1, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+  """Distribution of observed values (latencies, throughputs, ...).
+
+  Each sample value is a list with the (non-cumulative) count of every
+  bucket followed by the sum and the total count of observations.
+  """
+
+  _TYPE = "histogram"
+
+  def __init__(self, name: str, documentation: str,
+               labelnames: Sequence[str] = (),
+               buckets: Sequence[float] = _DEFAULT_BUCKETS):
+    super().__init__(name, documentation, labelnames)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, value: float, **labels):
+    key = self._key(labels)
+    i = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      if key not in self._values:
+        self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+      sample = self._values[key]
+      sample[i] += 1
+      sample[-2] += value
+      sample[-1] += 1
+
+  @contextlib.contextmanager
+  def time(self, **labels):
+    """Context manager that observes the time spent in its block."""
+    start_time = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter() - start_time, **labels)
+
+  @staticmethod
+  def _copy_value(value):
+    return list(value)
+
+  def snapshot(self) -> Dict:
+    snapshot = super().snapshot()
+    snapshot["buckets"] = list(self.buckets)
+    return snapshot
+
+
+class Registry:
+  """Holds all metrics of the process and renders them.
+
+  Args:
+    flush_interval: Minimum number of seconds between two snapshots
+      written by `maybe_flush`.
+  """
+
+  def __init__(self, flush_interval: float = 5.0):
+    self.metrics = {}
+    self.flush_interval = flush_interval
+    self._last_flush = 0.0
+    self._flushed_pid = None
+
+  def register(self, metric: _Metric) -> _Metric:
+    if metric.name in self.metrics:
+      raise KeyError("Metric {} is already registered.".format(metric.name))
+    self.metrics[metric.name] = metric
+    return metric
+
+  def counter(self, name: str, documentation: str,
+              labelnames: Sequence[str] = ()) -> Counter:
+    return self.register(Counter(name, documentation, labelnames))
+
+  def histogram(self, name: str, documentation: str,
+                labelnames: Sequence[str] = (),
+                buckets: Sequence[float] = _DEFAULT_BUCKETS) -> Histogram:
+    return self.register(Histogram(name, documentation, labelnames, buckets))
+
+  def snapshot(self) -> Dict[str, Dict]:
+    return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+  def flush(self, directory: str):
+    """Writes the snapshot of this process in `directory` atomically."""
+    os.makedirs(directory, exist_ok=True)
+    pid = os.getpid()
+    if self._flushed_pid != pid:
+      # A snapshot with our (recycled) pid belongs to a process that exited
+      self.retire(directory, pid)
+      self._flushed_pid = pid
+    _write_json(_snapshot_path(directory, pid), self.snapshot())
+    self._last_flush = time.monotonic()
+
+  def maybe_flush(self, directory: Optional[str]):
+    """Flushes only if `flush_interval` has passed since the last flush."""
+    if directory is None:
+      return
+    if time.monotonic() - self._last_flush >= self.flush_interval:
+      self.flush(directory)
+
+  def retire(self, directory: str, pid: int):
+    """Merges the snapshot of an exited process into the retired totals."""
+    path = _snapshot_path(directory, pid)
+    # Only one process claims a snapshot, even if several retire it
+    claimed = "{}.retiring.{}".format(path, os.getpid())
+    try:
+      os.rename(path, claimed)
+    except FileNotFoundError:
+      return
+    with _locked(directory):
+      retired_path = os.path.join(directory, _RETIRED_FILE)
+      snapshots = [s for s in (_read_json(retired_path), _read_json(claimed))
+                   if s is not None]
+      _write_json(retired_path, _aggregate(snapshots))
+      os.remove(claimed)
+
+  def clear(self, directory: str):
+    """Removes all snapshots, eg. when a new deployment starts."""
+    if not os.path.isdir(directory):
+      return
+    with _locked(directory):
+      for file_name in os.listdir(directory):
+        if file_name.startswith("metrics_"):
+          os.remove(os.path.join(directory, file_name))
+
+  def collect(self, directory: Optional[str] = None) -> Dict[str, Dict]:
+    """Returns the metrics aggregated over all processes.
+
+    Snapshots of processes that no longer exist are retired first, in case
+    they exited without the gunicorn `child_exit` hook.
+
+    Args:
+      directory: Directory that contains the worker snapshots.
+        If None only the metrics of the current process are returned.
+    """
+    if directory is None:
+      return self.snapshot()
+
+    self.flush(directory)
+    for pid in _snapshot_pids(directory):
+      if not _is_alive(pid):
+        self.retire(directory, pid)
+    with _locked(directory):
+      paths = [_snapshot_path(directory, pid)
+               for pid in _snapshot_pids(directory)]
+      paths.append(os.path.join(directory, _RETIRED_FILE))
+      # Missing or unreadable snapshots belong to workers being replaced
+      snapshots = [s for s in map(_read_json, paths) if s is not None]
+    return _aggregate(snapshots)
+
+  def render(self, directory: Optional[str] = None) -> str:
+    """Renders the (aggregated) metrics in Prometheus text format."""
+    lines = []
+    for name, metric in sorted(self.collect(directory).items()):
+      lines.append("# HELP {} {}".format(name, metric["help"]))
+      lines.append("# TYPE {} {}".format(name, metric["type"]))
+      for labelvalues, value in metric["samples"]:
+        labels = list(zip(metric["labelnames"], labelvalues))
+        if metric["type"] == "histogram":
+          lines.extend(_render_histogram(name, labels, metric["buckets"], value))
+        else:
+          lines.append(_render_sample(name, labels, value))
+    return "\n".join(lines) + "\n"
+
+
+def _snapshot_path(directory: str, pid: int) -> str:
+  return os.path.join(directory, "metrics_{}.json".format(pid))
+
+
+def _snapshot_pids(directory: str) -> List[int]:
+  pids = []
+  for file_name in os.listdir(directory):
+    name, ext = os.path.splitext(file_name)
+    if ext == ".json" and name.startswith("metrics_") and name[8:].isdigit():
+      pids.append(int(name[8:]))
+  return sorted(pids)
+
+
+def _is_alive(pid: int) -> bool:
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+
+@contextlib.contextmanager
+def _locked(directory: str):
+  """Serializes changes of the snapshots of `directory` between processes."""
+  if fcntl is None:
+    yield
+    return
+  with open(os.path.join(directory, _LOCK_FILE), "w") as file:
+    fcntl.flock(file, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def _read_json(path: str) -> Optional[Dict]:
+  try:
+    with open(path, "r") as file:
+      return json.load(file)
+  except (OSError, ValueError):
+    return None
+
+
+def _write_json(path: str, data: Dict):
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+  with os.fdopen(fd, "w") as file:
+    json.dump(data, file)
+  os.replace(tmp_path, path)
+
+
+def _aggregate(snapshots: Iterable[Dict]) -> Dict[str, Dict]:
+  """Sums the samples of process snapshots into a single snapshot."""
+  aggregated, samples = {}, {}
+  for snapshot in snapshots:
+    for name, metric in snapshot.items():
+      aggregated.setdefault(name, dict(metric))
+      _merge_samples(samples.setdefault(name, {}), metric)
+  for name, metric in aggregated.items():
+    metric["samples"] = [[list(k), v] for k, v in samples[name].items()]
+  return aggregated
+
+
+def _merge_samples(samples: Dict[Tuple[str, ...], object], metric: Dict):
+  """Adds the samples of a single process snapshot to `samples`."""
+  for labelvalues, value in metric["samples"]:
+    key = tuple(labelvalues)
+    if key not in samples:
+      samples[key] = value
+    elif metric["type"] == "histogram":
+      samples[key] = [x + y for x, y in zip(samples[key], value)]
+    else:
+      samples[key] += value
+
+
+def _format_labels(labels: List[Tuple[str, str]]) -> str:
+  if not labels:
+    return ""
+  escaped = ('{}="{}"'.format(k, str(v).replace("\\", "\\\\")
+                                       .replace('"', '\\"')
+                                       .replace("\n", "\\n"))
+             for k, v in labels)
+  return "{{{}}}".format(",".join(escaped))
+
+
+def _render_sample(name: str, labels: List[Tuple[str, str]], value) -> str:
+  return "{}{} {}".format(name, _format_labels(labels), float(value))
+
+
+def _render_histogram(name: str, labels: List[Tuple[str, str]],
+                      buckets: List[float], value: List[float]) -> List[str]:
+  lines = []
+  cumulative = 0
+  for bound, count in zip(list(buckets) + ["+Inf"], value[:-2]):
+    cumulative += count
+    bucket_labels = labels + [("le", bound if bound == "+Inf" else float(bound))]
+    lines.append(_render_sample(name + "_bucket", bucket_labels, cumulative))
+  lines.append(_render_sample(name + "_sum", labels, value[-2]))
+  lines.append(_render_sample(name + "_count", labels, value[-1]))
+  return lines
+
+
+REGISTRY = Registry()
+
+# Scraping
+PAGES_FETCHED = REGISTRY.counter(
+    "scraper_pages_fetched_total",
+    "Trip Advisor pages requested by the scraper.", ["status"])
+HTTP_LATENCY = REGISTRY.histogram(
+    "scraper_http_request_seconds",
+    "Latency of HTTP requests made by the scraper.")
+CACHE_REQUESTS = REGISTRY.counter(
+    "scraper_cache_requests_total",
+    "Scraper requests served by the response cache by result "
+    "(hit/revalidated/miss).", ["result"])
+REVIEWS_SCRAPED = REGISTRY.counter(
+    "scraper_reviews_scraped_total",
+    "Reviews extracted from review pages.")
+
+# NLP pipeline
+REVIEWS_PREPROCESSED = REGISTRY.counter(
+    "nlp_reviews_preprocessed_total",
+    "Reviews that went through basic preprocessing.")
+REVIEWS_SKIPPED = REGISTRY.counter(
+    "nlp_reviews_skipped_total",
+    "Reviews that were not parsed by spaCy.", ["reason"])
+PARSE_SECONDS_SKIPPED = REGISTRY.counter(
+    "nlp_parse_seconds_skipped_total",
+    "Estimated spaCy time saved by skipping non English reviews.")
+DOCS_PARSED = REGISTRY.counter(
+    "spacy_docs_parsed_total",
+    "Documents parsed by spaCy.")
+PARSE_SECONDS = REGISTRY.histogram(
+    "spacy_parse_seconds",
+    "Time spent in a single `apply_spacy` call.")
+DOCS_PER_SECOND = REGISTRY.histogram(
+    "spacy_docs_per_second",
+    "spaCy throughput measured over a single `apply_spacy` call.",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+ASPECTS_EXTRACTED = REGISTRY.counter(
+    "nlp_aspects_extracted_total",
+    "Aspect occurrences extracted by `sentiment_aspects`.")
+STAGE_SECONDS = REGISTRY.histogram(
+    "pipeline_stage_seconds",
+    "Time spent in each stage of the aspect extraction pipeline.", ["stage"])
+
+# Web app
+ROUTE_SECONDS = REGISTRY.histogram(
+    "app_route_phase_seconds",
+    "Time spent in each phase (load/build/render/serialize) of the app routes.",
+    ["route", "phase"])
+FRAGMENT_REQUESTS = REGISTRY.counter(
+    "app_fragment_cache_requests_total",
+    "Rendered HTML fragments requested from the fragment cache by result.",
+    ["result"])
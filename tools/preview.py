@@ -0,0 +1,196 @@
+"""Progressive preview of hotels that are still being scraped.
+
+While a scraping job runs (see `ingest.scrape`), the aspects of each batch
+of processed reviews are reduced to `PartialAggregates`: per word score and
+positive/negative appearance counts, star rating counts and review
+sentiment counts. These are sums, so the preview is refined by merging the
+aggregates of each new batch into the previous ones instead of recomputing
+them over all reviews. The merged aggregates are saved as json next to the
+job status, so that every gunicorn worker can render the preview page.
+"""
+import os
+import json
+import time
+import tempfile
+import collections
+import pandas as pd
+from tools import hotel as hotel_lib
+from tools.stopwords import STOP_WORDS
+from typing import Dict, List, Optional, Tuple
+
+
+class PartialAggregates:
+  """Mergeable aggregates of the aspects of a subset of reviews.
+
+  Contains:
+    * self.words: Dict from word to [score, positive, negative] in order of
+      first appearance, which breaks ties as `AspectsCollection` does.
+    * self.ratings: Counter of the star ratings.
+    * self.sentiment: Number of reviews with negative/neutral/positive total
+      aspect score.
+    * self.n_reviews: Number of processed reviews.
+  """
+
+  def __init__(self):
+    self.words = collections.OrderedDict()
+    self.ratings = collections.Counter()
+    self.sentiment = [0, 0, 0]
+    self.n_reviews = 0
+
+  @classmethod
+  def from_reviews(cls, reviews: pd.DataFrame,
+                   aspect_col_name: str = "aspects") -> "PartialAggregates":
+    """Aggregates a batch of processed reviews."""
+    partial = cls()
+    partial.n_reviews = len(reviews)
+    ratings = pd.to_numeric(reviews["rating"], errors="coerce").dropna()
+    partial.ratings.update(int(r) for r in ratings)
+    for counter in reviews[aspect_col_name]:
+      if not isinstance(counter, dict):
+        continue
+      review_score = 0
+      for word, score in counter.items():
+        if word in STOP_WORDS:
+          continue
+        stats = partial.words.setdefault(word, [0.0, 0, 0])
+        stats[0] += float(score)
+        stats[1] += int(score > 0)
+        stats[2] += int(score < 0)
+        review_score += score
+      partial.sentiment[(review_score > 0) - (review_score < 0) + 1] += 1
+    return partial
+
+  def merge(self, other: "PartialAggregates"):
+    """Adds the aggregates of another (later) batch in place."""
+    for word, (score, positive, negative) in other.words.items():
+      stats = self.words.setdefault(word, [0.0, 0, 0])
+      stats[0] += score
+      stats[1] += positive
+      stats[2] += negative
+    self.ratings.update(other.ratings)
+    self.sentiment = [a + b for a, b in zip(self.sentiment, other.sentiment)]
+    self.n_reviews += other.n_reviews
+
+  @property
+  def n_reviews_aspects_sentiment(self) -> List[int]:
+    return list(self.sentiment)
+
+  def most_common(self, n: Optional[int] = None, invert_sign: bool = False
+                  ) -> List[Tuple[str, float, int, int]]:
+    """(word, score, positive, negative) tuples sorted by score."""
+    sign = 1 if invert_sign else -1
+    ranked = sorted(self.words.items(), key=lambda x: sign * x[1][0])
+    return [(word,) + tuple(stats) for word, stats in ranked[:n]]
+
+  def as_dict(self) -> Dict:
+    return {"words": list(self.words.items()),
+            "ratings": sorted(self.ratings.items()),
+            "sentiment": self.sentiment, "n_reviews": self.n_reviews}
+
+  @classmethod
+  def from_dict(cls, data: Dict) -> "PartialAggregates":
+    partial = cls()
+    partial.words = collections.OrderedDict(
+        (word, stats) for word, stats in data["words"])
+    partial.ratings = collections.Counter(dict(data["ratings"]))
+    partial.sentiment = data["sentiment"]
+    partial.n_reviews = data["n_reviews"]
+    return partial
+
+
+def _path(folder: str, hotelname: str) -> str:
+  return os.path.join(folder, "{}.preview.json".format(hotelname))
+
+
+class PreviewWriter:
+  """Updates the preview of a hotel after each processed batch.
+
+  Used as the `on_batch` callback of `scraping.pipeline.run`.
+
+  Args:
+    folder: Folder in which the preview json is saved.
+    hotelname: Id of the hotel.
+    metadata: Scraped hotel metadata (name, total number of reviews, etc.).
+    min_pages: Number of review pages processed before the first preview.
+    min_interval: Minimum seconds between two updates of the preview.
+  """
+
+  def __init__(self, folder: str, hotelname: str, metadata: Dict,
+               min_pages: int = 10, min_interval: float = 5.0):
+    self.path = _path(folder, hotelname)
+    self.metadata = metadata
+    self.min_pages = min_pages
+    self.min_interval = min_interval
+    self.aggregates = PartialAggregates()
+    self._n_merged = 0
+    self._last_write = None
+
+  def __call__(self, result):
+    # Only the batches that were added since the last call are aggregated
+    for batch in result.batches[self._n_merged:]:
+      self.aggregates.merge(PartialAggregates.from_reviews(batch))
+    self._n_merged = len(result.batches)
+    if result.n_pages < self.min_pages:
+      return
+    if (self._last_write is None or
+        time.time() - self._last_write >= self.min_interval):
+      self.write(result.n_scraped)
+      self._last_write = time.time()
+
+  def write(self, n_scraped: int):
+    preview = {"metadata": self.metadata, "n_scraped": n_scraped,
+               "aggregates": self.aggregates.as_dict()}
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                    suffix=".tmp")
+    with os.fdopen(fd, "w") as file:
+      json.dump(preview, file)
+    os.replace(tmp_path, self.path)
+
+  def remove(self):
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+
+class Preview:
+  """Template interface for the preview of a hotel (see `preview.html`)."""
+
+  def __init__(self, hotelname: str, data: Dict):
+    self.id = hotelname
+    self.metadata = data["metadata"]
+    self.name = self.metadata.get("name", hotelname)
+    self.n_scraped = data["n_scraped"]
+    self.aggregates = PartialAggregates.from_dict(data["aggregates"])
+
+  @classmethod
+  def load(cls, folder: str, hotelname: str) -> Optional["Preview"]:
+    """Returns the preview of a hotel or None if there is no preview yet."""
+    try:
+      with open(_path(folder, hotelname), "r") as file:
+        return cls(hotelname, json.load(file))
+    except (OSError, ValueError):
+      return None
+
+  @property
+  def n_total(self) -> Optional[int]:
+    """Number of reviews that will be scraped in total."""
+    return self.metadata.get("n_reviews")
+
+  @property
+  def n_reviews(self) -> int:
+    return self.aggregates.n_reviews
+
+  def most_common_positive(self, n: Optional[int] = None):
+    return self.aggregates.most_common(n)
+
+  def most_common_negative(self, n: Optional[int] = None):
+    return self.aggregates.most_common(n, invert_sign=True)
+
+  @property
+  def rating_counts_piechart(self):
+    return hotel_lib.rating_counts_piechart(
+        sorted(self.aggregates.ratings.items()))
+
+  @property
+  def aspects_sentiment_piechart(self):
+    return hotel_lib.aspects_sentiment_piechart(
+        self.aggregates.n_reviews_aspects_sentiment)
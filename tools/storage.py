@@ -0,0 +1,448 @@
+"""Storage backends for the hotel folders of the app.
+
+The web app only reads hotels through a `Storage` object, so that the same
+code runs on a single machine or on several web nodes that share an object
+store:
+  * `LocalStorage`: Hotel folders in a local (or network mounted) directory.
+    This is the original layout of `STORAGE_PATH`.
+  * `ObjectStorage`: Hotels in an S3-compatible object store. Each node keeps
+    a size-bounded local read-through cache of the hotel folders that it
+    serves, so the app still loads (and memory-maps) local files.
+
+Object store layout:
+  * <prefix><hotel>/<version>/<file>: Files of each published version.
+  * <prefix><hotel>/CURRENT: Version that is currently published.
+
+New versions are uploaded under a fresh version prefix and become visible
+only when the CURRENT pointer is overwritten, which is atomic, so readers
+never see a partially uploaded hotel.
+
+`LocalObjectClient` implements the subset of the boto3 S3 client used here
+on a local directory and can be used as a stand-in for testing.
+"""
+import os
+import io
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+import contextlib
+from urllib import parse
+from typing import Dict, Iterator, List, Optional
+try:
+  import fcntl
+except ImportError:
+  # Not available on Windows, where the app does not run under gunicorn
+  fcntl = None
+
+_POINTER = "CURRENT"
+_DELETE_BATCH = 1000
+_LOCK_FILE = ".cache.lock"
+# Cached versions used more recently are not evicted, since requests of
+# other workers may still be loading them
+_IN_USE_SECONDS = 60.0
+
+
+class LocalStorage:
+  """Hotel folders in a local directory.
+
+  Args:
+    root: Directory that contains a folder per hotel. It is also used as the
+      working directory for uploads and scraping.
+  """
+
+  def __init__(self, root: str):
+    self.root = root
+    self.work_dir = root
+
+  def _path(self, hotelname: str) -> str:
+    return os.path.join(self.root, hotelname)
+
+  def list_hotels(self) -> List[str]:
+    # Folders starting with _ are used internally (eg. for uploads)
+    return sorted(name for name in os.listdir(self.root)
+                  if not name.startswith("_") and
+                  os.path.isdir(self._path(name)))
+
+  def exists(self, hotelname: str) -> bool:
+    return not hotelname.startswith("_") and os.path.isdir(
+        self._path(hotelname))
+
+  def local_folder(self, hotelname: str) -> str:
+    """Returns the local folder with the files of a hotel."""
+    if not self.exists(hotelname):
+      raise FileNotFoundError("Unable to find hotel {} in {}.".format(
+          hotelname, self.root))
+    return self._path(hotelname)
+
+  def staging_dir(self) -> str:
+    """Creates a temporary folder on the same filesystem as the storage."""
+    folder = os.path.join(self.work_dir, "_staging")
+    os.makedirs(folder, exist_ok=True)
+    return tempfile.mkdtemp(dir=folder)
+
+  def publish(self, hotelname: str, folder: str, replace: bool = False):
+    """Moves a complete hotel folder into the storage.
+
+    Args:
+      hotelname: Id of the hotel.
+      folder: Local folder with the hotel files. It is moved, so it should
+        be on the same filesystem as the storage (see `staging_dir`).
+      replace: If True an existing version of the hotel is replaced.
+        Otherwise `FileExistsError` is raised.
+    """
+    target = self._path(hotelname)
+    old = None
+    if os.path.exists(target):
+      if not replace:
+        raise FileExistsError("Hotel {} already exists in storage.".format(
+            hotelname))
+      old = os.path.join(self.staging_dir(), hotelname)
+      os.rename(target, old)
+    os.rename(folder, target)
+    self._remove_zip(hotelname)
+    if old is not None:
+      shutil.rmtree(os.path.dirname(old), ignore_errors=True)
+
+  def _remove_zip(self, hotelname: str):
+    zip_path = os.path.join(self.root, ".".join([hotelname, "zip"]))
+    if os.path.exists(zip_path):
+      os.remove(zip_path)
+
+  def delete(self, hotelname: str):
+    """Deletes both the folder and the zip file of the hotel."""
+    self._remove_zip(hotelname)
+    if self.exists(hotelname):
+      shutil.rmtree(self._path(hotelname))
+
+
+class _Exceptions:
+  """Mirrors `client.exceptions` of boto3 clients."""
+
+  class NoSuchKey(KeyError):
+    pass
+
+
+class LocalObjectClient:
+  """Local directory that behaves as an S3 client (subset of boto3).
+
+  Each bucket is a subfolder of `root` and each key a file in it.
+  """
+  exceptions = _Exceptions
+
+  def __init__(self, root: str):
+    self.root = root
+
+  def _path(self, bucket: str, key: str) -> str:
+    return os.path.join(self.root, bucket, *key.split("/"))
+
+  def _write(self, path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as file:
+      file.write(data)
+    os.replace(tmp_path, path)
+
+  def put_object(self, Bucket: str, Key: str, Body: bytes) -> Dict:
+    self._write(self._path(Bucket, Key), Body)
+    return {}
+
+  def get_object(self, Bucket: str, Key: str) -> Dict:
+    try:
+      with open(self._path(Bucket, Key), "rb") as file:
+        return {"Body": io.BytesIO(file.read())}
+    except FileNotFoundError:
+      raise self.exceptions.NoSuchKey(Key)
+
+  def upload_file(self, Filename: str, Bucket: str, Key: str):
+    with open(Filename, "rb") as file:
+      self._write(self._path(Bucket, Key), file.read())
+
+  def download_file(self, Bucket: str, Key: str, Filename: str):
+    try:
+      shutil.copyfile(self._path(Bucket, Key), Filename)
+    except FileNotFoundError:
+      raise self.exceptions.NoSuchKey(Key)
+
+  def list_objects_v2(self, Bucket: str, Prefix: str = "",
+                      Delimiter: Optional[str] = None, **kwargs) -> Dict:
+    bucket_root = os.path.join(self.root, Bucket)
+    keys = []
+    for folder, _, files in os.walk(bucket_root):
+      for file in files:
+        if not file.endswith(".tmp"):
+          path = os.path.join(folder, file)
+          keys.append(os.path.relpath(path, bucket_root).replace(os.sep, "/"))
+
+    contents, prefixes = [], set()
+    for key in sorted(keys):
+      if not key.startswith(Prefix):
+        continue
+      rest = key[len(Prefix):]
+      if Delimiter is not None and Delimiter in rest:
+        prefixes.add(Prefix + rest.split(Delimiter)[0] + Delimiter)
+      else:
+        size = os.path.getsize(self._path(Bucket, key))
+        contents.append({"Key": key, "Size": size})
+    return {"Contents": contents, "IsTruncated": False,
+            "CommonPrefixes": [{"Prefix": p} for p in sorted(prefixes)]}
+
+  def delete_objects(self, Bucket: str, Delete: Dict) -> Dict:
+    for item in Delete["Objects"]:
+      path = self._path(Bucket, item["Key"])
+      if os.path.exists(path):
+        os.remove(path)
+    return {}
+
+
+class ObjectStorage:
+  """Hotels in an S3-compatible object store with a local read-through cache.
+
+  Args:
+    client: boto3 S3 client or `LocalObjectClient`.
+    bucket: Name of the bucket.
+    prefix: Prefix of all the keys of the app in the bucket.
+    work_dir: Local directory for uploads, scraping and the cache.
+    cache_max_bytes: Maximum size of the local cache. Least recently used
+      hotel versions are evicted when it is exceeded.
+    pointer_ttl: Seconds for which the CURRENT version of a hotel is reused
+      before it is read again from the object store.
+    keep_versions: Number of versions of each hotel that are kept in the
+      object store when a new one is published, so that nodes that still
+      read an older pointer can finish downloading it. Includes the
+      current version, so it should be at least 1.
+  """
+
+  def __init__(self, client, bucket: str, prefix: str = "",
+               work_dir: str = "app_storage", cache_max_bytes: int = 2 ** 32,
+               pointer_ttl: float = 5.0, keep_versions: int = 2):
+    if keep_versions < 1:
+      raise ValueError("At least the current version should be kept but "
+                       "keep_versions is {}.".format(keep_versions))
+    self.client = client
+    self.bucket = bucket
+    self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+    self.work_dir = work_dir
+    self.cache_dir = os.path.join(work_dir, "_cache")
+    os.makedirs(self.cache_dir, exist_ok=True)
+    self.cache_max_bytes = cache_max_bytes
+    self.pointer_ttl = pointer_ttl
+    self.keep_versions = keep_versions
+    self._pointers = {}
+    self._lock = threading.Lock()
+
+  def _key(self, *parts: str) -> str:
+    return self.prefix + "/".join(parts)
+
+  def _list(self, prefix: str, delimiter: Optional[str] = None
+            ) -> Iterator[Dict]:
+    """Yields all the pages of a listing."""
+    kwargs = {"Bucket": self.bucket, "Prefix": prefix}
+    if delimiter is not None:
+      kwargs["Delimiter"] = delimiter
+    while True:
+      response = self.client.list_objects_v2(**kwargs)
+      yield response
+      if not response.get("IsTruncated"):
+        break
+      kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+  def _list_keys(self, prefix: str) -> List[str]:
+    return [item["Key"] for page in self._list(prefix)
+            for item in page.get("Contents", [])]
+
+  def _delete_keys(self, keys: List[str]):
+    for start in range(0, len(keys), _DELETE_BATCH):
+      objects = [{"Key": key} for key in keys[start:start + _DELETE_BATCH]]
+      self.client.delete_objects(Bucket=self.bucket,
+                                 Delete={"Objects": objects})
+
+  def current_version(self, hotelname: str) -> Optional[str]:
+    """Returns the published version of a hotel or None if not published."""
+    cached = self._pointers.get(hotelname)
+    if cached is not None and time.time() - cached[1] < self.pointer_ttl:
+      return cached[0]
+    try:
+      response = self.client.get_object(Bucket=self.bucket,
+                                        Key=self._key(hotelname, _POINTER))
+      version = response["Body"].read().decode("utf-8").strip()
+    except self.client.exceptions.NoSuchKey:
+      version = None
+    self._pointers[hotelname] = (version, time.time())
+    return version
+
+  def list_hotels(self) -> List[str]:
+    hotels = []
+    for page in self._list(self.prefix, delimiter="/"):
+      for item in page.get("CommonPrefixes", []):
+        name = item["Prefix"][len(self.prefix):].rstrip("/")
+        # Hotels that are being uploaded do not have a pointer yet
+        if not name.startswith("_") and self.current_version(name):
+          hotels.append(name)
+    return sorted(hotels)
+
+  def exists(self, hotelname: str) -> bool:
+    return (not hotelname.startswith("_") and
+            self.current_version(hotelname) is not None)
+
+  def local_folder(self, hotelname: str) -> str:
+    """Returns the local cached folder of the current version of a hotel.
+
+    The folder is downloaded from the object store if it is not cached.
+    Its name is the hotel id, so that `Hotel.load_from_folder` finds it.
+    """
+    if not self.exists(hotelname):
+      raise FileNotFoundError("Unable to find hotel {} in {}.".format(
+          hotelname, self.bucket))
+    version = self.current_version(hotelname)
+    version_dir = os.path.join(self.cache_dir, version)
+    folder = os.path.join(version_dir, hotelname)
+    with self._cache_locked():
+      if os.path.isdir(folder):
+        # Directory modification time is used as the last access time
+        os.utime(version_dir)
+        return folder
+
+    tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, suffix=".tmp")
+    prefix = self._key(hotelname, version) + "/"
+    # Same modification time on all nodes, so that `data_version` agrees
+    published_ns = int(version.split("-")[0])
+    for key in self._list_keys(prefix):
+      path = os.path.join(tmp_dir, hotelname, *key[len(prefix):].split("/"))
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      self.client.download_file(self.bucket, key, path)
+      os.utime(path, ns=(published_ns, published_ns))
+    with self._cache_locked():
+      try:
+        os.rename(tmp_dir, version_dir)
+      except OSError:
+        # Another worker downloaded the same version first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+      os.utime(version_dir)
+      self._evict(keep=version)
+    return folder
+
+  @contextlib.contextmanager
+  def _cache_locked(self):
+    """Serializes changes of the cache between threads and processes."""
+    with self._lock:
+      if fcntl is None:
+        yield
+        return
+      with open(os.path.join(self.cache_dir, _LOCK_FILE), "w") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+          yield
+        finally:
+          fcntl.flock(file, fcntl.LOCK_UN)
+
+  def evict(self, keep: Optional[str] = None):
+    """Removes least recently used versions until the cache fits its size.
+
+    Versions used in the last `_IN_USE_SECONDS` are kept, since other
+    workers that share the cache directory may still be loading them.
+    """
+    with self._cache_locked():
+      self._evict(keep)
+
+  def _evict(self, keep: Optional[str] = None):
+    # Should be called with the cache lock held
+    entries = []
+    for name in os.listdir(self.cache_dir):
+      path = os.path.join(self.cache_dir, name)
+      if name.endswith(".tmp") or not os.path.isdir(path):
+        continue
+      size = sum(os.path.getsize(os.path.join(folder, file))
+                 for folder, _, files in os.walk(path) for file in files)
+      entries.append((os.path.getmtime(path), name, size))
+    total = sum(size for _, _, size in entries)
+    in_use_time = time.time() - _IN_USE_SECONDS
+    for last_access, name, size in sorted(entries):
+      if total <= self.cache_max_bytes or last_access > in_use_time:
+        break
+      if name != keep:
+        # Open memory maps of removed files stay valid until closed
+        shutil.rmtree(os.path.join(self.cache_dir, name),
+                      ignore_errors=True)
+        total -= size
+
+  def staging_dir(self) -> str:
+    folder = os.path.join(self.work_dir, "_staging")
+    os.makedirs(folder, exist_ok=True)
+    return tempfile.mkdtemp(dir=folder)
+
+  def _versions(self, hotelname: str) -> List[str]:
+    versions = []
+    for page in self._list(self._key(hotelname) + "/", delimiter="/"):
+      for item in page.get("CommonPrefixes", []):
+        versions.append(item["Prefix"].rstrip("/").split("/")[-1])
+    return sorted(versions)
+
+  def publish(self, hotelname: str, folder: str, replace: bool = False):
+    """Uploads a hotel folder as a new version and then points to it.
+
+    The local folder is removed after the upload. Older versions except the
+    last `keep_versions` are deleted from the object store.
+    """
+    if not replace and self.exists(hotelname):
+      raise FileExistsError("Hotel {} already exists in storage.".format(
+          hotelname))
+    # Versions sort by publish time
+    version = "{:020d}-{}".format(time.time_ns(), uuid.uuid4().hex[:8])
+    for parent, _, files in os.walk(folder):
+      for file in files:
+        path = os.path.join(parent, file)
+        relative = os.path.relpath(path, folder).replace(os.sep, "/")
+        self.client.upload_file(path, self.bucket,
+                                self._key(hotelname, version, relative))
+    self.client.put_object(Bucket=self.bucket,
+                           Key=self._key(hotelname, _POINTER),
+                           Body=version.encode("utf-8"))
+    self._pointers[hotelname] = (version, time.time())
+    shutil.rmtree(folder, ignore_errors=True)
+
+    versions = self._versions(hotelname)
+    for old_version in versions[:len(versions) - self.keep_versions]:
+      self._delete_keys(self._list_keys(
+          self._key(hotelname, old_version) + "/"))
+
+  def delete(self, hotelname: str):
+    """Unpublishes a hotel and deletes all its versions."""
+    # Remove the pointer first so that the hotel disappears atomically
+    self._delete_keys([self._key(hotelname, _POINTER)])
+    self._pointers.pop(hotelname, None)
+    self._delete_keys(self._list_keys(self._key(hotelname) + "/"))
+
+
+def create(storage_path: str, storage_url: Optional[str] = None,
+           cache_max_mb: int = 4096):
+  """Creates the storage of the app.
+
+  Args:
+    storage_path: Local storage directory. If `storage_url` is given it is
+      only used for uploads, scraping and the read-through cache.
+    storage_url: Optional object store URL:
+      * s3://<bucket>/<prefix>: S3-compatible store using boto3. The endpoint
+        of non-AWS stores is given by the `S3_ENDPOINT_URL` environment
+        variable.
+      * file://<directory>/<bucket>: `LocalObjectClient` stand-in.
+    cache_max_mb: Size of the local read-through cache in MB.
+  """
+  if not storage_url:
+    return LocalStorage(storage_path)
+
+  url = parse.urlparse(storage_url)
+  if url.scheme == "s3":
+    import boto3
+    client = boto3.client("s3",
+                          endpoint_url=os.environ.get("S3_ENDPOINT_URL"))
+    bucket, prefix = url.netloc, url.path
+  elif url.scheme == "file":
+    root, bucket = os.path.split(url.path.rstrip("/"))
+    client, prefix = LocalObjectClient(root), ""
+  else:
+    raise ValueError("Unknown storage URL scheme {}.".format(url.scheme))
+  os.makedirs(storage_path, exist_ok=True)
+  return ObjectStorage(client, bucket, prefix, work_dir=storage_path,
+                       cache_max_bytes=cache_max_mb * 2 ** 20)
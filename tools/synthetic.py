@@ -0,0 +1,121 @@
+"""Synthetic hotels for profiling and load testing the app.
+
+The generated reviews have the columns of scraped and processed reviews
+(see `scraping.aspects.process_reviews`) with random text, metadata and
+aspects. Aspect words follow a Zipf distribution so that, as in real
+hotels, a few words (room, staff, ...) appear in most reviews.
+"""
+import os
+import json
+import zlib
+import collections
+import numpy as np
+import pandas as pd
+from tools import mapped
+from typing import Dict, Optional
+
+_COMMON_WORDS = ["room", "staff", "breakfast", "location", "pool", "bed",
+                 "view", "wifi", "bar", "price", "service", "restaurant",
+                 "beach", "bathroom", "shower", "reception", "parking", "spa"]
+_FILLER = ["the", "was", "very", "and", "we", "our", "stay", "a", "it",
+           "really", "also", "but", "with", "at", "hotel", "time", "for"]
+_TRIP_TYPES = ["BUSINESS", "COUPLES", "FAMILY", "FRIENDS", "SOLO", None]
+_LANGUAGES = ["en", "en", "en", "en", "de", "fr", "it"]
+
+
+def _vocabulary(n_words: int):
+  extra = ["aspect{}".format(i) for i in range(n_words - len(_COMMON_WORDS))]
+  return np.array(_COMMON_WORDS + extra)
+
+
+def reviews(n_reviews: int, n_words: int = 2000, aspects_per_review: int = 6,
+            text_words: int = 120, seed: int = 0) -> pd.DataFrame:
+  """Creates a DataFrame of processed reviews with random content.
+
+  Args:
+    n_reviews: Number of reviews.
+    n_words: Number of distinct aspect words.
+    aspects_per_review: Average number of aspects of each review.
+    text_words: Average number of words in the text of each review.
+    seed: Seed of the random generator.
+  """
+  rng = np.random.default_rng(seed)
+  vocabulary = _vocabulary(n_words)
+  # Zipf-like frequencies of the aspect words
+  frequencies = 1.0 / np.arange(1, n_words + 1)
+  frequencies /= frequencies.sum()
+
+  rows = []
+  for i in range(n_reviews):
+    n_aspects = max(1, rng.poisson(aspects_per_review))
+    words = rng.choice(vocabulary, size=n_aspects, replace=False,
+                       p=frequencies)
+    scores = rng.choice([-2.0, -1.0, 1.0, 1.5, 2.0], size=n_aspects)
+    aspects = collections.Counter(
+        {str(w): float(s) for w, s in zip(words, scores)})
+    filler = rng.choice(_FILLER, size=max(10, rng.poisson(text_words)))
+    tokens = list(filler)
+    for word in aspects:
+      tokens.insert(rng.integers(len(tokens)), word)
+    text = " ".join(tokens).capitalize() + "."
+    year = int(rng.integers(2012, 2021))
+    rows.append({
+        "id": 100000 + i,
+        "absoluteUrl": "https://www.tripadvisor.com/ShowUserReviews-{}".format(
+            100000 + i),
+        "publishedDate": "{}-{:02d}-{:02d}".format(
+            year, int(rng.integers(1, 13)), int(rng.integers(1, 29))),
+        "originalLanguage": "en",
+        "language": _LANGUAGES[rng.integers(len(_LANGUAGES))],
+        "tripType": _TRIP_TYPES[rng.integers(len(_TRIP_TYPES))],
+        "helpfulVotes": int(rng.integers(0, 10)),
+        "title": "Review {}".format(i),
+        "text": text,
+        "rating": int(rng.integers(1, 6)),
+        "username": "user{}".format(i),
+        "user_hometownName": "Town {}".format(i % 50),
+        "processed_text": text.lower(),
+        "aspects": aspects,
+        "lemmatized_text": " ".join(sorted(aspects)),
+    })
+  return pd.DataFrame(rows)
+
+
+def metadata(hotelname: str) -> Dict:
+  """Hotel metadata with the keys of `TripAdvisorScraper.scrape_data`."""
+  return {"locationId": zlib.crc32(hotelname.encode("utf-8")) % 10 ** 7,
+          "name": hotelname.replace("_", " ").title(),
+          "accommodationCategory": "HOTEL",
+          "absoluteUrl": "https://www.tripadvisor.com/{}".format(hotelname),
+          "additionalRatings": {"Location": 4.5, "Rooms": 4.0,
+                                "Service": 4.5, "Value": 3.5}}
+
+
+def write_hotel(folder: str, hotelname: str, n_reviews: int,
+                mapped_store: bool = True, seed: Optional[int] = None,
+                **kwargs) -> str:
+  """Writes a synthetic hotel in the layout of scraped hotels.
+
+  Args:
+    folder: Storage directory in which the hotel folder is created.
+    hotelname: Id (folder name) of the hotel.
+    n_reviews: Number of reviews.
+    mapped_store: If True the memory-mapped store is also written.
+    seed: Seed of the random generator. Defaults to `n_reviews`.
+    kwargs: Additional arguments of `reviews`.
+
+  Returns:
+    Path to the hotel folder.
+  """
+  hotel_folder = os.path.join(folder, hotelname)
+  os.makedirs(hotel_folder, exist_ok=True)
+  with open(os.path.join(hotel_folder, "{}_meta.txt".format(hotelname)),
+            "w") as file:
+    json.dump(metadata(hotelname), file)
+  data = reviews(n_reviews, seed=n_reviews if seed is None else seed,
+                 **kwargs)
+  data.to_pickle(os.path.join(hotel_folder, "{}_{}reviews_withaspects.pkl"
+                              "".format(hotelname, n_reviews)))
+  if mapped_store:
+    mapped.write_store(hotel_folder, data)
+  return hotel_folder
@@ -0,0 +1,227 @@
+"""Opt-in request tracing and sampling profiler for the Flask routes.
+
+Every route phase (load, build, render, serialize) is wrapped in a `span`.
+Spans always feed the `app_route_phase_seconds` histogram. When tracing is
+enabled (`app.config["TRACING"]`) they are also recorded per request, and
+requests that run longer than `TRACING_SLOW_MS` are stack-sampled by a single
+background profiler thread. The slowest recent requests of the worker and
+their breakdowns are listed in `/debug/requests`.
+"""
+import sys
+import time
+import heapq
+import threading
+import contextlib
+import collections
+import flask
+from tools import metrics
+from typing import Dict, List, Optional
+
+
+class Trace:
+  """Timings of a single request.
+
+  Contains:
+    * self.route: Flask endpoint that served the request.
+    * self.spans: List of (name, depth, start offset, duration) in seconds.
+    * self.profile: Counter from collapsed stacks to number of samples.
+  """
+
+  def __init__(self, route: str, path: str):
+    self.route = route
+    self.path = path
+    self.start_time = time.perf_counter()
+    self.timestamp = time.time()
+    self.duration = None
+    self.status = None
+    self.spans = []
+    self.profile = collections.Counter()
+    self.thread_id = threading.get_ident()
+    self._depth = 0
+
+  @property
+  def elapsed(self) -> float:
+    return time.perf_counter() - self.start_time
+
+  @property
+  def breakdown(self) -> Dict[str, float]:
+    """Total time of top level spans grouped by name."""
+    totals = collections.OrderedDict()
+    for name, depth, _, duration in self.spans:
+      if depth == 0:
+        totals[name] = totals.get(name, 0.0) + duration
+    return totals
+
+  def top_stacks(self, n: int = 10) -> List:
+    return self.profile.most_common(n)
+
+  def finish(self, status: Optional[int] = None):
+    self.duration = self.elapsed
+    self.status = status
+
+
+class SamplingProfiler(threading.Thread):
+  """Samples the stacks of requests running longer than a threshold.
+
+  A single daemon thread serves all requests of the worker. Requests that
+  finish before `threshold` seconds are never sampled, so fast requests
+  pay nothing beyond registering themselves.
+
+  Args:
+    threshold: Number of seconds after which a request is sampled.
+    interval: Number of seconds between two samples.
+    max_depth: Maximum number of frames kept per sample.
+  """
+
+  def __init__(self, threshold: float, interval: float = 0.005,
+               max_depth: int = 40):
+    super().__init__(name="request-profiler", daemon=True)
+    self.threshold = threshold
+    self.interval = interval
+    self.max_depth = max_depth
+    self._active = {}
+    self._lock = threading.Lock()
+
+  def add(self, trace: Trace):
+    with self._lock:
+      self._active[trace.thread_id] = trace
+
+  def remove(self, trace: Trace):
+    with self._lock:
+      self._active.pop(trace.thread_id, None)
+
+  def run(self):
+    while True:
+      time.sleep(self.interval)
+      with self._lock:
+        slow = [t for t in self._active.values()
+                if t.elapsed > self.threshold]
+      if not slow:
+        continue
+      frames = sys._current_frames()
+      for trace in slow:
+        frame = frames.get(trace.thread_id)
+        if frame is not None:
+          trace.profile[self._collapse(frame)] += 1
+
+  def _collapse(self, frame) -> str:
+    """Collapses a stack to `file:function;...` from the root to the leaf."""
+    stack = []
+    while frame is not None and len(stack) < self.max_depth:
+      code = frame.f_code
+      stack.append("{}:{}".format(code.co_filename.split("/")[-1],
+                                  code.co_name))
+      frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class TraceLog:
+  """Bounded log of the slowest recently finished requests.
+
+  Args:
+    size: Number of requests to keep.
+    window: Number of seconds after which a request is no longer "recent".
+  """
+
+  def __init__(self, size: int = 50, window: float = 3600.0):
+    self.size = size
+    self.window = window
+    self._heap = []
+    self._counter = 0
+    self._lock = threading.Lock()
+
+  def add(self, trace: Trace):
+    with self._lock:
+      self._expire()
+      self._counter += 1
+      item = (trace.duration, self._counter, trace)
+      if len(self._heap) < self.size:
+        heapq.heappush(self._heap, item)
+      elif item[0] > self._heap[0][0]:
+        heapq.heapreplace(self._heap, item)
+
+  def slowest(self) -> List[Trace]:
+    with self._lock:
+      self._expire()
+      return [trace for _, _, trace in sorted(self._heap, reverse=True)]
+
+  def _expire(self):
+    cutoff = time.time() - self.window
+    if any(trace.timestamp < cutoff for _, _, trace in self._heap):
+      self._heap = [x for x in self._heap if x[2].timestamp >= cutoff]
+      heapq.heapify(self._heap)
+
+
+def current_trace() -> Optional[Trace]:
+  if not flask.has_request_context():
+    return None
+  return flask.g.get("trace")
+
+
+@contextlib.contextmanager
+def span(name: str):
+  """Times a phase of the current request.
+
+  Can be used outside a request (eg. when loading hotels offline),
+  in which case it is reported under the "offline" route.
+  """
+  trace = current_trace()
+  if flask.has_request_context():
+    route = flask.request.endpoint or "unknown"
+  else:
+    route = "offline"
+
+  start_time = time.perf_counter()
+  if trace is not None:
+    depth = trace._depth
+    trace._depth += 1
+  try:
+    yield
+  finally:
+    duration = time.perf_counter() - start_time
+    metrics.ROUTE_SECONDS.observe(duration, route=route, phase=name)
+    if trace is not None:
+      trace._depth -= 1
+      trace.spans.append((name, depth, start_time - trace.start_time,
+                          duration))
+
+
+def init_app(app: flask.Flask):
+  """Registers the tracing hooks and the debug page if tracing is enabled."""
+  if not app.config.get("TRACING"):
+    return
+
+  threshold = app.config.get("TRACING_SLOW_MS", 500) / 1000.0
+  profiler = SamplingProfiler(
+      threshold, interval=app.config.get("TRACING_PROFILE_INTERVAL_MS", 5) / 1000.0)
+  profiler.start()
+  log = TraceLog(size=app.config.get("TRACING_HISTORY", 50))
+  app.extensions["tracing"] = log
+
+  @app.before_request
+  def start_trace():
+    trace = Trace(flask.request.endpoint or "unknown", flask.request.full_path)
+    flask.g.trace = trace
+    profiler.add(trace)
+
+  @app.after_request
+  def record_status(response: flask.Response):
+    trace = current_trace()
+    if trace is not None:
+      trace.status = response.status_code
+    return response
+
+  @app.teardown_request
+  def finish_trace(exc: Optional[BaseException] = None):
+    trace = flask.g.pop("trace", None)
+    if trace is None:
+      return
+    profiler.remove(trace)
+    trace.finish(trace.status if exc is None else 500)
+    log.add(trace)
+
+  @app.route("/debug/requests")
+  def slow_requests():
+    """Lists the slowest recent requests served by this worker."""
+    return flask.render_template("debug_requests.html", traces=log.slowest(),
+                                 threshold_ms=threshold * 1000)
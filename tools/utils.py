@@ -65,6 +65,8 @@ def zipdir(folder_name: str, folder_dir: str):
   zipf = zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED)
   for file in os.listdir(folder_path):
     file_path = os.path.join(folder_path, file)
-    zipf.write(file_path, os.path.basename(file_path))
+    # Derived data (eg. the mapped store) are regenerated after upload
+    if os.path.isfile(file_path):
+      zipf.write(file_path, os.path.basename(file_path))
   zipf.close()
   return zip_path
\ No newline at end of file